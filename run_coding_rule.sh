@@ -2,12 +2,15 @@
 
 # Wrapper to run src/coding_rule_reviewer.py easily.
 # Usage:
-#   ./run_coding_rule.sh [-l language1,language2] <folder> <rules_file>
-#   ./run_coding_rule.sh [-l language1,language2] --diff-url <url> <rules_file>
+#   ./run_coding_rule.sh [-l language1,language2] [-b] [--cascade] <folder> <rules_file>
+#   ./run_coding_rule.sh [-l language1,language2] [-b] [--cascade] --diff-url <url> <rules_file>
+#
+# -b/--batch checks several rules per AI call (see coding_rule_reviewer.py --batch).
+# --cascade screens each rule with the fast model first (see coding_rule_reviewer.py --cascade).
 #
 # If a --diff-url (or other crawler args) is provided and no <folder> is given,
-# this script will invoke src/gitlib_diff_crawler.py, capture the created review
-# directory, then run src/coding_rule_reviewer.py against that directory.
+# this script will run src/pipeline.py, which crawls the changed code and checks
+# it against the rules in one process (output goes to a new coding_rule_* directory).
 # Note: if no <folder> is provided and no crawler args are given, the script
 # will use WORKSPACE_PATH from .env as the folder.
 
@@ -15,6 +18,7 @@ LANGUAGE="english,japanese"
 FOLDER=""
 RULES_FILE=""
 CRAWLER_ARGS=()
+REVIEWER_ARGS=()
 
 while [[ $# -gt 0 ]]; do
   key="$1"
@@ -23,8 +27,18 @@ while [[ $# -gt 0 ]]; do
       LANGUAGE="$2"
       shift; shift
       ;;
+    -b|--batch)
+      # check several rules per AI call
+      REVIEWER_ARGS+=("--batch")
+      shift
+      ;;
+    --cascade)
+      # screen rules with the fast model, check flagged ones with the strong model
+      REVIEWER_ARGS+=("--cascade")
+      shift
+      ;;
     -h|--help)
-      echo "Usage: $0 [-l language1,language2] [--diff-url <url>] <folder> <rules_file>"
+      echo "Usage: $0 [-l language1,language2] [-b] [--cascade] [--diff-url <url>] <folder> <rules_file>"
       echo "If <folder> is omitted, the script will use WORKSPACE_PATH from .env when available."
       exit 0
       ;;
@@ -98,7 +112,7 @@ if [[ -z "$FOLDER" && ${#CRAWLER_ARGS[@]} -eq 0 ]]; then
 fi
 
 # If crawler args were provided (e.g., --diff-url) and folder not supplied,
-# run the gitlab diff crawler to obtain a folder that contains diff.txt
+# crawl and check the rules in one process
 if [[ ${#CRAWLER_ARGS[@]} -gt 0 && -z "$FOLDER" ]]; then
   if [ -f "../myenv/bin/activate" ]; then
     source "../myenv/bin/activate"
@@ -107,24 +121,10 @@ if [[ ${#CRAWLER_ARGS[@]} -gt 0 && -z "$FOLDER" ]]; then
     PYTHON_EXEC="python"
   fi
 
-  echo "Running GitLab diff crawler..."
-  output=$($PYTHON_EXEC src/gitlib_diff_crawler.py "${CRAWLER_ARGS[@]}")
-  echo "$output"
-
-  # Try to extract the directory path from crawler output.
-  # Support messages like:
-  #   "Saved changed code to /path/to/outdir/diff.txt"
-  #   "Successfully saved diffs to /path/to/outdir/diff.txt"
-  review_dir=$(echo "$output" | grep -E "Saved changed code to|Successfully saved" | head -n1 | sed -E 's/.*(Saved changed code to|Successfully saved .* to) (.*)\/(comments|diff)\.txt.*/\2/')
-
-  if [ -n "$review_dir" ]; then
-    echo "Review directory found: $review_dir"
-    FOLDER="$review_dir"
-  else
-    echo "Could not determine the review directory from gitlib_diff_crawler.py output."
-    echo "Please check the crawler's output for errors."
-    exit 1
-  fi
+  echo "Running GitLab diff crawler and coding rule reviewer..."
+  echo "Rules file: $RULES_FILE"
+  $PYTHON_EXEC src/pipeline.py coding-rule "${CRAWLER_ARGS[@]}" "$RULES_FILE" -l "$LANGUAGE" "${REVIEWER_ARGS[@]}"
+  exit $?
 fi
 
 # Ensure we have a python executor (if not already set by crawler block)
@@ -139,6 +139,6 @@ fi
 
 echo "Running coding rule reviewer on folder: $FOLDER"
 echo "Rules file: $RULES_FILE"
-$PYTHON_EXEC src/coding_rule_reviewer.py "$FOLDER" "$RULES_FILE" -l "$LANGUAGE"
+$PYTHON_EXEC src/coding_rule_reviewer.py "$FOLDER" "$RULES_FILE" -l "$LANGUAGE" "${REVIEWER_ARGS[@]}"
 
 exit 0
\ No newline at end of file
@@ -1,8 +1,8 @@
 #!/bin/bash
 
 # This script runs the full code review process.
-# It first runs the gitlib_crawler.py to get comments and diffs from GitLab,
-# then runs the reviewer.py to get an AI-generated review.
+# src/pipeline.py crawls the comments and diffs from GitLab and runs the
+# AI review on them in a single Python process.
 
 # Default language parameter
 LANGUAGE="english,japanese"
@@ -41,26 +41,15 @@ else
     PYTHON_EXEC="python"
 fi
 
-# Run the gitlib_crawler.py and capture the output
-# The arguments passed to this script (e.g., --comments-url) are forwarded to the crawler.
-echo "Running GitLab crawler..."
-output=$($PYTHON_EXEC src/gitlib_crawler.py "${CRAWLER_ARGS[@]}")
+# Crawl and review in one process.
+# The arguments passed to this script (e.g., --comments-url) are forwarded to the pipeline.
+echo "Running GitLab crawler and AI reviewer..."
+$PYTHON_EXEC src/pipeline.py review "${CRAWLER_ARGS[@]}" --language "$LANGUAGE"
+status=$?
 
-# Echo the output from the crawler for debugging or information
-echo "$output"
-
-# Extract the review directory path from the crawler's output.
-# It looks for lines containing "Successfully saved" and extracts the directory path.
-review_dir=$(echo "$output" | grep "Successfully saved" | head -n 1 | sed -E 's/Successfully saved .* to (.*)\/(comments|diff)\.txt/\1/')
-
-if [ -n "$review_dir" ]; then
-  echo "Review directory found: $review_dir"
-  # Run the reviewer.py with the extracted directory path.
-  echo "Running AI reviewer..."
-  $PYTHON_EXEC src/reviewer.py "$review_dir" --language "$LANGUAGE"
-  echo "Review process completed. Results are in $review_dir/result.md"
+if [ $status -eq 0 ]; then
+  echo "Review process completed."
 else
-  echo "Could not determine the review directory from the gitlib_crawler.py output."
-  echo "Please check the crawler's output for errors."
-  exit 1
+  echo "Review process failed. Please check the output above for errors."
 fi
+exit $status
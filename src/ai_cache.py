@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from typing import Optional
+
+# Cache file lives in WORKSPACE_PATH so it survives across review runs
+CACHE_FILE_NAME = "ai_cache.sqlite3"
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_MAX_SIZE_MB = 200
+# Run size-based eviction every this many writes
+EVICT_EVERY = 50
+
+cache_db = None
+cache_enabled = True
+max_age_seconds = DEFAULT_MAX_AGE_DAYS * 86400
+max_size_bytes = DEFAULT_MAX_SIZE_MB * 1024 * 1024
+hits = 0
+misses = 0
+writes_since_evict = 0
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+def init_cache(enabled: bool = True, path: Optional[str] = None, clear_cache: bool = False) -> None:
+    """
+    Open (or create) the response cache.
+    Location defaults to WORKSPACE_PATH/ai_cache.sqlite3, limits come from
+    AI_CACHE_MAX_AGE_DAYS and AI_CACHE_MAX_SIZE_MB.
+    clear_cache=True empties it, also when it is not enabled for this run.
+    """
+    global cache_enabled
+    cache_enabled = enabled
+    if enabled or clear_cache:
+        _open(path)
+    if clear_cache:
+        clear()
+
+def _open(path: Optional[str]) -> None:
+    global cache_db, max_age_seconds, max_size_bytes
+    if cache_db is not None:
+        return
+
+    if path is None:
+        path = os.path.join(os.getenv("WORKSPACE_PATH") or ".", CACHE_FILE_NAME)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    max_age_seconds = _env_float("AI_CACHE_MAX_AGE_DAYS", DEFAULT_MAX_AGE_DAYS) * 86400
+    max_size_bytes = int(_env_float("AI_CACHE_MAX_SIZE_MB", DEFAULT_MAX_SIZE_MB) * 1024 * 1024)
+
+    cache_db = sqlite3.connect(path, check_same_thread=False)
+    cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        " key TEXT PRIMARY KEY,"
+        " response TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " last_used REAL NOT NULL)"
+    )
+    cache_db.commit()
+    evict()
+
+def make_key(params: dict) -> str:
+    """
+    Hash of the model, sampling parameters and rendered messages of one request.
+    """
+    canonical = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def get(key: str) -> Optional[str]:
+    global hits, misses
+    if not cache_enabled or cache_db is None:
+        return None
+    row = cache_db.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+    now = time.time()
+    if row is None or now - row[1] > max_age_seconds:
+        misses += 1
+        return None
+    cache_db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+    cache_db.commit()
+    hits += 1
+    return row[0]
+
+def put(key: str, response: Optional[str]) -> None:
+    global writes_since_evict
+    if not cache_enabled or cache_db is None or response is None:
+        return
+    now = time.time()
+    cache_db.execute(
+        "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+        (key, response, len(response.encode("utf-8")), now, now),
+    )
+    cache_db.commit()
+    writes_since_evict += 1
+    if writes_since_evict >= EVICT_EVERY:
+        evict()
+
+def evict() -> None:
+    """
+    Drop entries older than the max age, then least recently used entries
+    until the cache is within the size limit.
+    """
+    global writes_since_evict
+    if cache_db is None:
+        return
+    writes_since_evict = 0
+    cache_db.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - max_age_seconds,))
+    total = cache_db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total > max_size_bytes:
+        excess = total - max_size_bytes
+        doomed = []
+        for key, size in cache_db.execute("SELECT key, size FROM responses ORDER BY last_used ASC"):
+            if excess <= 0:
+                break
+            doomed.append((key,))
+            excess -= size
+        cache_db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+    cache_db.commit()
+
+def clear() -> None:
+    if cache_db is None:
+        return
+    cache_db.execute("DELETE FROM responses")
+    cache_db.commit()
+    cache_db.execute("VACUUM")
+
+def close_cache() -> None:
+    global cache_db
+    if cache_db is not None:
+        cache_db.close()
+        cache_db = None
+
+def stats() -> dict:
+    return {"enabled": cache_enabled, "hits": hits, "misses": misses}
+
+def print_stats() -> None:
+    if cache_enabled:
+        print(f"AI cache: {hits} hits, {misses} misses")
@@ -1,32 +1,290 @@
 import os
+import time
+import random
+import asyncio
 import logging
-import json
-from typing import Any, List
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from openai import AzureOpenAI
+import contextlib
+import collections
+from datetime import date
+from typing import Any, AsyncIterator, Callable, Optional
+# openai and azure.identity take about a second to import; they are loaded
+# on first use (see _openai and token_cache) so start-up stays fast
 # from mcp_client import call_tool
+import ai_cache
+import metrics
+from token_cache import CachedTokenProvider, get_token_cache_path
+from diff_sharder import count_tokens
 from dotenv import load_dotenv
 
 load_dotenv()
 
-global ai_client
+# Default number of model calls allowed in flight at once
+DEFAULT_MAX_CONCURRENCY = 4
+# Retries of a call that got a 429, timed out or hit a connection/server error
+DEFAULT_MAX_RETRIES = 5
+# Backoff when the error carries no Retry-After; doubled per retry, capped
+RETRY_BASE_SECONDS = 1.0
+RETRY_MAX_SECONDS = 60.0
+# Tokens/requests per minute are counted over a sliding window of this length
+RATE_WINDOW_SECONDS = 60.0
+# First API version that reports cached prompt tokens (usage.prompt_tokens_details)
+CACHED_TOKENS_API_VERSION = "2024-10-01-preview"
+DEFAULT_API_VERSION = "2024-10-21"
+# First API version that accepts stream_options (usage at the end of a stream)
+STREAM_USAGE_API_VERSION = "2024-09-01-preview"
+# Deployments of the two model tiers: "strong" for reviews and reports,
+# "fast" for cheap screening calls (see coding_rule_reviewer cascade)
+DEFAULT_MODELS = {"strong": "gpt-4o", "fast": "gpt-4o-mini"}
+MODEL_ENV_VARS = {"strong": "AI_MODEL", "fast": "AI_FAST_MODEL"}
+# Output tokens of a call unless the caller asks for fewer
+DEFAULT_MAX_TOKENS = 4000
 
-def init_ai_caller():
+ai_client = None
+# CachedTokenProvider of the Azure AD client; None with an API key
+token_provider = None
+# Process-wide RequestScheduler shared by every review, see get_scheduler
+scheduler = None
+
+def _openai():
+    return metrics.timed_import("openai")
+
+def retryable_errors() -> tuple:
+    """
+    429s, timeouts, connection and server errors: the errors a call is retried on.
+    """
+    openai = _openai()
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+def init_ai_caller(use_cache: bool = True, clear_cache: bool = False):
     """
     Initialize AI utilities by loading environment variables and setting up the Azure OpenAI client.
+    The client is async and owns a single pooled HTTP connection set shared by every call;
+    calling this again while a client exists reuses it.
+    use_cache=False bypasses the persistent response cache, clear_cache=True empties it first.
+    Azure AD tokens come from a CachedTokenProvider, so a token that is still
+    valid is reused across processes and the credential chain only runs when
+    it has expired.
     """
+    global ai_client, token_provider
+    ai_cache.init_cache(enabled=use_cache, clear_cache=clear_cache)
+    if ai_client is not None:
+        return
+    openai = _openai()
+    if not api_version_at_least(CACHED_TOKENS_API_VERSION):
+        print(f"Warning: AZURE_OPENAI_API_VERSION {get_api_version()} does not report cached prompt tokens; "
+              f"use {CACHED_TOKENS_API_VERSION} or later to see them in the metrics.")
 
-    # Azure credentials will be loaded from environment variables by DefaultAzureCredential
-    default_credential = DefaultAzureCredential()
+    # An API key (e.g. for a local endpoint such as the benchmark's fake server)
+    # replaces Azure AD authentication
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    if api_key:
+        ai_client = openai.AsyncAzureOpenAI(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=api_key,
+            api_version=get_api_version(),
+            max_retries=0,
+            http_client=openai.DefaultAsyncHttpxClient())
+        return
 
-    token_provider = get_bearer_token_provider(default_credential, "https://cognitiveservices.azure.com/.default")
+    # Azure credentials will be loaded from environment variables by DefaultAzureCredential,
+    # on the first call whose token is not in the token cache
+    token_provider = CachedTokenProvider(cache_path=get_token_cache_path())
 
-    global ai_client
-    ai_client = AzureOpenAI(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+    ai_client = openai.AsyncAzureOpenAI(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
         azure_ad_token_provider=token_provider,
-        api_version="2023-12-01-preview")
+        api_version=get_api_version(),
+        # Retries go through the scheduler, so it sees every 429
+        max_retries=0,
+        http_client=openai.DefaultAsyncHttpxClient())
+
+async def close_ai_caller():
+    """
+    Close the shared client, credential and response cache. Must run on the same event loop that used them.
+    """
+    global ai_client, token_provider
+    ai_cache.close_cache()
+    if ai_client is not None:
+        await ai_client.close()
+        ai_client = None
+    if token_provider is not None:
+        await token_provider.close()
+        token_provider = None
+
+def get_api_version() -> str:
+    return os.getenv("AZURE_OPENAI_API_VERSION") or DEFAULT_API_VERSION
+
+def _api_version_key(version: str) -> tuple:
+    """
+    Sort key of an API version: its date (YYYY-MM-DD), then GA after the
+    "-preview" of the same date. Raises ValueError without a leading date.
+    """
+    return date.fromisoformat(version[:10]), not version[10:].startswith("-preview")
+
+def api_version_at_least(minimum: str) -> bool:
+    """
+    Whether the configured API version is `minimum` or later (see _api_version_key).
+    Versions without a date ("preview", "latest") track the newest API and qualify.
+    """
+    try:
+        return _api_version_key(get_api_version()) >= _api_version_key(minimum)
+    except ValueError:
+        return True
+
+def _env_number(name: str, default, cast=int):
+    try:
+        return cast(os.getenv(name, default))
+    except ValueError:
+        return default
+
+class RequestScheduler:
+    """
+    Admits model calls so that every caller of the process shares the
+    deployment's quota:
+
+    * at most tokens_per_minute / requests_per_minute (0: unlimited) over a
+      sliding window; a call counts with its prompt tokens plus max_tokens,
+      the way Azure OpenAI charges it against the TPM quota
+    * after a 429 no call starts until its Retry-After has passed
+    * the number of calls in flight is halved on every 429 and raised by one
+      after that many calls succeeded, up to max_concurrency (None: no cap)
+    """
+
+    def __init__(self, tokens_per_minute: int = 0, requests_per_minute: int = 0,
+                 max_concurrency: Optional[int] = None):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrency = max_concurrency
+        # Current concurrency limit; None until the first 429 when there is no cap
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.throttled = 0
+        self.blocked_until = 0.0
+        self._successes = 0
+        # (admitted_at, tokens) of the calls inside the rate window
+        self._window = collections.deque()
+        self._waiters = set()
+
+    def set_max_concurrency(self, limit: Optional[int]) -> None:
+        self.max_concurrency = limit
+        self.limit = limit
+
+    def _wait_time(self, now: float, tokens: int) -> float:
+        while self._window and self._window[0][0] <= now - RATE_WINDOW_SECONDS:
+            self._window.popleft()
+        wait = self.blocked_until - now
+        if self.requests_per_minute and len(self._window) >= self.requests_per_minute:
+            wait = max(wait, self._window[0][0] + RATE_WINDOW_SECONDS - now)
+        if self.tokens_per_minute and self._window:
+            # A call larger than the whole budget still runs once the window is empty
+            excess = sum(t for _, t in self._window) + tokens - self.tokens_per_minute
+            for admitted_at, window_tokens in self._window:
+                if excess <= 0:
+                    break
+                excess -= window_tokens
+                wait = max(wait, admitted_at + RATE_WINDOW_SECONDS - now)
+        return wait
+
+    async def acquire(self, tokens: int) -> None:
+        while True:
+            now = time.monotonic()
+            wait = self._wait_time(now, tokens)
+            if wait <= 0 and (self.limit is None or self.in_flight < self.limit):
+                self.in_flight += 1
+                self._window.append((now, tokens))
+                return
+            # Woken up by a finished call, or when the window has room again
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=wait if wait > 0 else None)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiters.discard(waiter)
+
+    def release(self, outcome: str = "ok") -> None:
+        """
+        End a call admitted by acquire; outcome is "ok", "throttled" (429) or "error".
+        """
+        self.in_flight -= 1
+        if outcome == "throttled":
+            self.throttled += 1
+            self._successes = 0
+            current = self.limit if self.limit is not None else self.in_flight + 1
+            self.limit = max(1, current // 2)
+        elif outcome == "ok" and self.limit is not None:
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                if self.max_concurrency is None or self.limit < self.max_concurrency:
+                    self.limit += 1
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def block(self, seconds: float) -> None:
+        """
+        Start no call for the next `seconds` (the Retry-After of a 429).
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int):
+        """
+        Hold a call slot for the block; a RateLimitError raised inside lowers the concurrency.
+        """
+        await self.acquire(tokens)
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except Exception as e:
+            if isinstance(e, _openai().RateLimitError):
+                outcome = "throttled"
+            raise
+        finally:
+            self.release(outcome)
+
+def get_scheduler() -> RequestScheduler:
+    """
+    The process-wide RequestScheduler, created on first use with the budgets
+    from AI_TOKENS_PER_MINUTE and AI_REQUESTS_PER_MINUTE (default 0: unlimited).
+    """
+    global scheduler
+    if scheduler is None:
+        scheduler = RequestScheduler(max(0, _env_number("AI_TOKENS_PER_MINUTE", 0)),
+                                     max(0, _env_number("AI_REQUESTS_PER_MINUTE", 0)))
+    return scheduler
+
+def set_global_concurrency(limit: int = None):
+    """
+    Cap the number of model calls in flight across all callers (e.g. several
+    merge requests reviewed at once). None removes the cap.
+    """
+    get_scheduler().set_max_concurrency(limit)
+
+def get_max_concurrency() -> int:
+    """
+    Number of concurrent model calls, from AI_MAX_CONCURRENCY (default DEFAULT_MAX_CONCURRENCY).
+    """
+    try:
+        value = int(os.getenv("AI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+    except ValueError:
+        value = DEFAULT_MAX_CONCURRENCY
+    return max(1, value)
+
+def get_model(tier: str = "strong") -> str:
+    """
+    Deployment name of a model tier, from AI_MODEL / AI_FAST_MODEL (default DEFAULT_MODELS).
+    """
+    return os.getenv(MODEL_ENV_VARS[tier]) or DEFAULT_MODELS[tier]
 
-async def generate_response(messages: list, tools: Any = None, temprature:float=0.7) -> str:
+def build_request(messages: list, tools: Any = None, temprature: float = 0.7, response_format: Any = None,
+                  tier: str = "strong", max_tokens: Optional[int] = None) -> dict:
+    """
+    Build the chat.completions.create arguments shared by generate_response and stream_response.
+    `tier` selects the deployment (see get_model); a smaller max_tokens also
+    lowers what the call counts against the TPM budget.
+    """
     logging.debug(f"Tools: {tools}")
     messages_for_processing = messages.copy()  # Operate on a copy to avoid modifying the caller's list
 
@@ -39,20 +297,212 @@ async def generate_response(messages: list, tools: Any = None, temprature:float=
         available_tools = [{"type": "function", "function": tool} for tool in available_tools]
     else:
         available_tools = []
-    response = ai_client.chat.completions.create(model="gpt-4o",
+    request = dict(model=get_model(tier),
         messages=messages_for_processing,
         temperature=temprature,
-        max_tokens=4000,
+        max_tokens=max_tokens or DEFAULT_MAX_TOKENS,
         top_p=0.95,
         frequency_penalty=0,
         presence_penalty=0,
         tools=available_tools,
         tool_choice="auto",
         stop=None)
-    
-    return response.choices[0].message.content
+    if response_format:
+        request["response_format"] = response_format
+    return request
+
+def get_max_retries() -> int:
+    return max(0, _env_number("AI_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+
+def get_hedge_after() -> float:
+    """
+    Seconds after which a second copy of a slow call is sent, from
+    AI_HEDGE_AFTER_SECONDS (default 0: never).
+    """
+    return max(0.0, _env_number("AI_HEDGE_AFTER_SECONDS", 0.0, float))
+
+def estimate_tokens(request: dict) -> int:
+    """
+    Tokens a request counts against the TPM quota: its prompt plus max_tokens.
+    """
+    prompt_tokens = sum(count_tokens(str(message.get("content") or "")) + 4 for message in request["messages"])
+    return prompt_tokens + (request.get("max_tokens") or 0)
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    The wait the service asked for in the retry-after-ms / Retry-After headers of an error response.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name, divisor in (("retry-after-ms", 1000), ("retry-after", 1)):
+        try:
+            return float(headers[name]) / divisor
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+async def wait_before_retry(error: Exception, retries: int) -> None:
+    """
+    Wait before retry number `retries`: a 429 blocks the scheduler for its
+    Retry-After, other errors back off exponentially with jitter.
+    """
+    delay = retry_after_seconds(error)
+    if delay is None:
+        delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (retries - 1)) * (0.5 + random.random() / 2)
+    print(f"AI call failed ({type(error).__name__}); retry {retries}/{get_max_retries()} in {delay:.1f}s")
+    if isinstance(error, _openai().RateLimitError):
+        # Everyone waits, so the calls queued behind this one do not hit the limit too
+        get_scheduler().block(delay)
+    else:
+        await asyncio.sleep(delay)
+
+async def hedged(call: Callable, hedge_after: float):
+    """
+    Await call(); if it has not finished after hedge_after seconds, start a
+    second call() and return whichever succeeds first (the other is cancelled).
+    Returns (result, hedged).
+    """
+    first = asyncio.ensure_future(call())
+    if not hedge_after:
+        return await first, False
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result(), False
+
+    print(f"AI call still running after {hedge_after:.0f}s; sending a hedged request")
+    pending = {first, asyncio.ensure_future(call())}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), True
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def send_request(request: dict):
+    """
+    Send a (non-streamed) chat.completions request through the scheduler,
+    hedged after AI_HEDGE_AFTER_SECONDS and retried on 429s, timeouts,
+    connection and server errors. Returns (response, retries, hedged).
+    """
+    tokens = estimate_tokens(request)
+    retries = 0
+
+    async def attempt():
+        async with get_scheduler().slot(tokens):
+            return await ai_client.chat.completions.create(**request)
+
+    while True:
+        try:
+            response, was_hedged = await hedged(attempt, get_hedge_after())
+            return response, retries, was_hedged
+        except retryable_errors() as e:
+            if retries >= get_max_retries():
+                raise
+            retries += 1
+            await wait_before_retry(e, retries)
+
+def _cache_status() -> str:
+    return "miss" if ai_cache.cache_enabled else "off"
+
+def record_call(name: str, started: float, usage: Any = None, cache: str = "miss", **fields) -> dict:
+    """
+    Record one model call in the metrics trace, with token usage when the API returned it.
+    """
+    if usage is not None:
+        fields["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+        fields["completion_tokens"] = getattr(usage, "completion_tokens", None)
+        # Prompt tokens served from the service's prompt cache (newer API versions only)
+        details = getattr(usage, "prompt_tokens_details", None)
+        if getattr(details, "cached_tokens", None) is not None:
+            fields["cached_tokens"] = details.cached_tokens
+    fields.setdefault("retries", 0)
+    seconds = time.perf_counter() - started
+    if cache != "hit":
+        # Includes the connection set-up and, without a cached token, the credential
+        metrics.record_startup("first request", seconds)
+    return metrics.record("ai", name, seconds, cache=cache, **fields)
+
+async def generate_response(messages: list, tools: Any = None, temprature:float=0.7, response_format: Any = None,
+                            tier: str = "strong", max_tokens: Optional[int] = None) -> str:
+    request = build_request(messages, tools, temprature, response_format, tier, max_tokens)
+    started = time.perf_counter()
+
+    # Identical requests are answered from the persistent response cache
+    cache_key = ai_cache.make_key(request)
+    cached = ai_cache.get(cache_key)
+    if cached is not None:
+        record_call(request["model"], started, cache="hit")
+        return cached
+
+    response, retries, was_hedged = await send_request(request)
+
+    content = response.choices[0].message.content
+    ai_cache.put(cache_key, content)
+    record_call(request["model"], started, response.usage, _cache_status(), retries=retries, hedged=was_hedged)
+    return content
+
+async def stream_response(messages: list, tools: Any = None, temprature: float = 0.7) -> AsyncIterator[str]:
+    """
+    Like generate_response, but yields the answer text as it arrives.
+    Time to first token and total time of the call are printed and recorded in metrics.
+    A cached answer is yielded in one piece.
+    """
+    request = build_request(messages, tools, temprature)
+    started = time.perf_counter()
+
+    cache_key = ai_cache.make_key(request)
+    cached = ai_cache.get(cache_key)
+    if cached is not None:
+        record_call(request["model"], started, cache="hit")
+        yield cached
+        return
+
+    if api_version_at_least(STREAM_USAGE_API_VERSION):
+        # Token usage (and cached tokens) arrive in a last chunk without choices
+        request["stream_options"] = {"include_usage": True}
+
+    parts = []
+    usage = None
+    first_token_at = None
+    tokens = estimate_tokens(request)
+    retries = 0
+    while True:
+        try:
+            # The slot is held until the stream ends
+            async with get_scheduler().slot(tokens):
+                stream = await ai_client.chat.completions.create(stream=True, **request)
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage", None) or usage
+                    # Azure sends chunks without choices (e.g. content filter results)
+                    if not chunk.choices:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    if not text:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    parts.append(text)
+                    yield text
+            break
+        except retryable_errors() as e:
+            # Text already handed to the caller cannot be taken back
+            if parts or retries >= get_max_retries():
+                raise
+            retries += 1
+            await wait_before_retry(e, retries)
+    finished = time.perf_counter()
 
-    
+    time_to_first_token = (first_token_at or finished) - started
+    print(f"AI stream: first token after {time_to_first_token:.2f}s, done in {finished - started:.2f}s")
+    ai_cache.put(cache_key, "".join(parts))
+    record_call(request["model"], started, usage, _cache_status(), retries=retries,
+                time_to_first_token=round(time_to_first_token, 4), stream=True)
 
 def process_message(message: list, history: list, tools) -> tuple:
     """
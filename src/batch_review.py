@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from dotenv import load_dotenv
+
+import gitlib_crawler
+from gitlib_utils import create_gitlab_client, get_max_workers
+from azure_ai_caller import init_ai_caller, close_ai_caller, set_global_concurrency, get_max_concurrency
+from ai_prompts import init_prompt_map
+from coding_rule_reviewer import parse_rules, read_text_file
+from pipeline import review_merge_request, check_merge_request_rules, ai_options, run_options, review_options, coding_rule_options
+from diff_filter import get_diff_filter
+import ai_cache
+import metrics
+
+def read_mr_urls(path: str) -> list:
+    """
+    Read merge request URLs, one per line; '#' lines and blank lines are ignored.
+    A line may hold the MR URL, its /diffs URL, or both separated by whitespace.
+    Returns a list of (comments_url, diff_url) pairs.
+    """
+    merge_requests = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for raw in f:
+            line = raw.strip()
+            if not line or line.startswith('#'):
+                continue
+            urls = line.split()
+            diff_url = next((u for u in urls if u.rstrip('/').endswith('/diffs')), None)
+            comments_url = next((u for u in urls if not u.rstrip('/').endswith('/diffs')), None)
+            if comments_url is None:
+                comments_url = diff_url.rstrip('/')[:-len('/diffs')]
+            if diff_url is None:
+                diff_url = comments_url.rstrip('/') + '/diffs'
+            merge_requests.append((comments_url, diff_url))
+    return merge_requests
+
+async def review_one(gl, comments_url: str, diff_url: str, args, rules: Optional[list], prompts: dict,
+                     scope: Optional[str] = None) -> dict:
+    """
+    Review one merge request and return its summary row. Errors are recorded
+    in the row instead of being raised, so one MR cannot abort the batch.
+    Metrics are recorded under `scope` (default: the MR URL).
+    """
+    started = time.perf_counter()
+    row = {"url": comments_url, "status": "ok", "output": "", "seconds": 0.0}
+    scope = scope or comments_url
+    # Everything recorded for this MR (model calls, GitLab requests) carries its URL
+    with metrics.scope(scope):
+        try:
+            diff_filter = get_diff_filter(not args.no_filter)
+            if rules is None:
+                out_dir = await review_merge_request(gl, comments_url, diff_url, args.language,
+                                                     args.concurrency, args.shard_tokens, prompts, args.incremental,
+                                                     diff_filter, per_thread=args.per_thread)
+            else:
+                out_dir = await check_merge_request_rules(gl, diff_url, rules, args.language, args.concurrency,
+                                                          args.batch, args.batch_tokens, prompts, args.incremental,
+                                                          diff_filter, cascade=args.cascade)
+            if out_dir is None:
+                row["status"] = "nothing to review"
+            else:
+                row["output"] = out_dir
+        except Exception as e:
+            row["status"] = f"failed: {e}"
+            print(f"Review of {comments_url} failed: {e}", file=sys.stderr)
+    row["seconds"] = time.perf_counter() - started
+    row.update(metrics.totals(scope))
+    metrics.write_trace(row["output"], scope_filter=scope)
+    return row
+
+def format_summary(rows: list, wall_seconds: float) -> str:
+    lines = [
+        "| # | Merge request | Status | Time (s) | AI calls | Tokens | Output |",
+        "|---|---------------|--------|----------|----------|--------|--------|",
+    ]
+    for i, row in enumerate(rows, 1):
+        lines.append(f"| {i} | {row['url']} | {row['status']} | {row['seconds']:.1f} | "
+                     f"{row.get('ai_calls', 0)} | {row.get('tokens', 0)} | {row['output']} |")
+    ok = sum(1 for row in rows if row["status"] == "ok")
+    lines.append("")
+    lines.append(f"Reviewed {ok}/{len(rows)} merge requests in {wall_seconds:.1f}s")
+    return "\n".join(lines) + "\n"
+
+def multi_mr_options() -> argparse.ArgumentParser:
+    """
+    Parent parser (argparse parents=[...]) with the options of reviewing many
+    merge requests in one process, shared by batch_review and review_service.
+    The review and coding rule options apply to every merge request; the
+    coding rule ones only with --rules.
+    """
+    options = argparse.ArgumentParser(add_help=False, parents=[ai_options(), review_options(), coding_rule_options()])
+    options.add_argument("-r", "--rules", dest="rules_file", default=None, help="Check the diffs against this coding rules file instead of reviewing the unresolved comments.")
+    options.add_argument("--gitlab-workers", type=int, default=None, help="Maximum number of GitLab requests in flight across all merge requests (default: GITLAB_MAX_WORKERS or 8).")
+    options.add_argument("--ai-concurrency", type=int, default=None, help="Maximum number of AI calls in flight across all merge requests (default: AI_MAX_CONCURRENCY or 4).")
+    return options
+
+def parse_args(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Crawl and review many GitLab merge requests in one process.",
+                                     parents=[multi_mr_options(), run_options()])
+    parser.add_argument("mr_list", help="File with one merge request URL per line (MR URL and/or its /diffs URL)")
+    return parser.parse_args(argv)
+
+async def run(args) -> int:
+    merge_requests = read_mr_urls(args.mr_list)
+    if not merge_requests:
+        print(f"No merge request URLs found in {args.mr_list}")
+        return 1
+    rules = parse_rules(read_text_file(args.rules_file)) if args.rules_file else None
+
+    # Crawls run on the default executor; the client below caps their requests
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=args.gitlab_workers or get_max_workers()))
+    set_global_concurrency(args.ai_concurrency or get_max_concurrency())
+
+    # One request limit for the whole process: each crawl's own worker pools
+    # (discussions, file contents) share it instead of multiplying it
+    gl, request_counter = create_gitlab_client(gitlib_crawler.gitlab_url, gitlib_crawler.gitlab_private_token,
+                                               max_in_flight=args.gitlab_workers or get_max_workers())
+    init_ai_caller(use_cache=not args.no_cache, clear_cache=args.clear_cache)
+    prompts = init_prompt_map()
+
+    print(f"Reviewing {len(merge_requests)} merge requests...")
+    started = time.perf_counter()
+    try:
+        rows = await asyncio.gather(*(review_one(gl, comments_url, diff_url, args, rules, prompts)
+                                      for comments_url, diff_url in merge_requests))
+    finally:
+        await close_ai_caller()
+        set_global_concurrency(None)
+    wall_seconds = time.perf_counter() - started
+
+    summary = format_summary(rows, wall_seconds)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    summary_path = os.path.join(gitlib_crawler.workspace_path or '.', f"batch_summary_{timestamp}.md")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write(summary)
+    print(summary)
+    print(f"Summary saved to {summary_path}")
+    request_counter.print_summary()
+    ai_cache.print_stats()
+    metrics.print_summary()
+    return 0 if not any(row["status"].startswith("failed") for row in rows) else 1
+
+def main():
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+    args = parse_args()
+    if args.rules_file and not os.path.exists(args.rules_file):
+        print(f"Error: rules file not found at {args.rules_file}", file=sys.stderr)
+        sys.exit(1)
+    profile_path = os.path.join(gitlib_crawler.workspace_path or '.', metrics.PROFILE_FILE_NAME)
+    with metrics.profiled(args.profile, profile_path):
+        exit_code = asyncio.run(run(args))
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
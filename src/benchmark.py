@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import asyncio
+import tempfile
+import contextlib
+from typing import Optional
+
+import gitlib_crawler
+import gitlib_diff_crawler
+from gitlib_crawler import crawl_comments, format_diff
+from gitlib_diff_crawler import format_changed_code
+from gitlib_utils import create_gitlab_client, fetch_mr_diffs, write_diff_file, get_max_workers
+from azure_ai_caller import init_ai_caller, close_ai_caller, get_model
+from ai_prompts import init_prompt_map
+from reviewer import review_code, read_rules
+from coding_rule_reviewer import check_rules, read_text_file
+from diff_filter import get_diff_filter
+from fake_servers import FakeGitLab, FakeChatCompletions, make_merge_request
+import metrics
+
+# Generated merge request sizes: changed files, hunks per file, discussion threads, coding rules
+SIZES = {
+    "small": {"files": 3, "hunks": 2, "threads": 4, "rules": 5},
+    "medium": {"files": 20, "hunks": 4, "threads": 16, "rules": 15},
+    "large": {"files": 80, "hunks": 8, "threads": 48, "rules": 40},
+}
+STAGES = ("gitlib_crawler", "gitlib_diff_crawler", "reviewer", "coding_rule_reviewer")
+
+RULE_TEMPLATES = (
+    "Functions must not be longer than {n}0 lines.",
+    "Every public function needs a docstring (rule {n}).",
+    "Do not swallow exceptions silently (rule {n}).",
+    "Use descriptive variable names instead of value_{n}.",
+    "Avoid computing the same value twice in one expression (rule {n}).",
+)
+
+def make_rules(count: int) -> list:
+    return [RULE_TEMPLATES[n % len(RULE_TEMPLATES)].format(n=n + 1) for n in range(count)]
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Nearest-rank percentile; 0.0 for an empty list.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize_stage(size: str, stage: str, walls: list, events: list, rate_limited: int) -> dict:
+    latencies = [e["seconds"] for e in events]
+    return {
+        "size": size,
+        "stage": stage,
+        "runs": len(walls),
+        "mr_per_second": len(walls) / sum(walls) if sum(walls) else 0.0,
+        "run_p50": percentile(walls, 50),
+        "run_p95": percentile(walls, 95),
+        "requests": len(events),
+        "request_p50": percentile(latencies, 50),
+        "request_p95": percentile(latencies, 95),
+        "rate_limited": rate_limited,
+        "retries": sum(e.get("retries") or 0 for e in events),
+        "tokens": sum((e.get("prompt_tokens") or 0) + (e.get("completion_tokens") or 0) for e in events),
+        "cached_tokens": sum(e.get("cached_tokens") or 0 for e in events),
+    }
+
+@contextlib.contextmanager
+def quiet(verbose: bool):
+    # The crawlers and reviewers print progress for every call
+    if verbose:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+async def bench_size(size: str, spec: dict, args, gitlab_server: FakeGitLab, chat_server: FakeChatCompletions,
+                     gl, prompts: dict, workspace: str) -> list:
+    """
+    Run every stage `args.repeat` times on freshly generated merge requests
+    of one size and return a result row per stage.
+    """
+    rules = make_rules(spec["rules"])
+    review_rules = read_rules()
+    base_iid = len(gitlab_server.merge_requests) + 1
+    iids = list(range(base_iid, base_iid + args.repeat))
+    for iid in iids:
+        mr = make_merge_request(iid, spec["files"], spec["hunks"], spec["threads"], seed=args.seed)
+        gitlab_server.merge_requests[iid] = mr
+
+    crawled = {}
+    changed = {}
+    walls = {stage: [] for stage in STAGES}
+    stage_events = {stage: [] for stage in STAGES}
+    rate_limited = {stage: 0 for stage in STAGES}
+
+    async def timed(stage: str, server, coroutine):
+        server.reset_stats()
+        first_event = len(metrics.events)
+        started = time.perf_counter()
+        with quiet(args.verbose):
+            result = await coroutine
+        walls[stage].append(time.perf_counter() - started)
+        kind = "gitlab" if server is gitlab_server else "ai"
+        stage_events[stage].extend(e for e in metrics.events[first_event:] if e["kind"] == kind)
+        rate_limited[stage] += server.rate_limited
+        return result
+
+    def crawl_diff_file(diff_url: str, out_dir: str, format_diffs) -> str:
+        # Same path as the crawler CLIs: diffs streamed page by page into diff.txt
+        os.makedirs(out_dir, exist_ok=True)
+        mr_diffs = fetch_mr_diffs(gl, diff_url, gitlib_crawler.gitlab_url,
+                                  diff_filter=get_diff_filter(not args.no_filter), stream=True)
+        return read_text_file(write_diff_file(mr_diffs, out_dir, format_diffs))
+
+    for iid in iids:
+        mr_url = gitlab_server.mr_url(iid)
+        diff_url = f"{mr_url}/diffs"
+        out_dir = os.path.join(workspace, f"{size}_{iid}")
+
+        def crawl():
+            return crawl_comments(gl, mr_url), crawl_diff_file(diff_url, os.path.join(out_dir, "review"), format_diff)
+
+        crawled[iid] = await timed("gitlib_crawler", gitlab_server, asyncio.to_thread(crawl))
+        changed[iid] = await timed("gitlib_diff_crawler", gitlab_server,
+                                   asyncio.to_thread(crawl_diff_file, diff_url, os.path.join(out_dir, "coding_rule"),
+                                                     format_changed_code))
+        comments, diff = crawled[iid]
+        await timed("reviewer", chat_server,
+                    review_code(comments, diff, review_rules, args.language, args.concurrency, args.shard_tokens,
+                                prompts, output_path=os.path.join(out_dir, "review", "result.md"), per_thread=args.per_thread))
+        await timed("coding_rule_reviewer", chat_server,
+                    check_rules(changed[iid], rules, args.language, args.concurrency, batch=args.batch,
+                                batch_tokens=args.batch_tokens, prompts=prompts,
+                                output_path=os.path.join(out_dir, "coding_rule", "coding_rule_result.md"), cascade=args.cascade))
+
+    return [summarize_stage(size, stage, walls[stage], stage_events[stage], rate_limited[stage]) for stage in STAGES]
+
+def format_results(rows: list) -> str:
+    lines = [
+        "| Size | Stage | Runs | MR/s | Run p50 (s) | Run p95 (s) | Requests | Request p50 (s) | Request p95 (s) | 429s | Retries | Tokens | Cached |",
+        "|------|-------|------|------|-------------|-------------|----------|-----------------|-----------------|------|---------|--------|--------|",
+    ]
+    for row in rows:
+        lines.append(f"| {row['size']} | {row['stage']} | {row['runs']} | {row['mr_per_second']:.2f} | "
+                     f"{row['run_p50']:.3f} | {row['run_p95']:.3f} | {row['requests']} | "
+                     f"{row['request_p50']:.3f} | {row['request_p95']:.3f} | {row['rate_limited']} | {row['retries']} | {row['tokens']} | {row.get('cached_tokens', 0)} |")
+    return "\n".join(lines)
+
+def compare_with_baseline(rows: list, baseline_path: str, tolerance: float) -> list:
+    """
+    Return a message for every stage whose run p95 is more than `tolerance`
+    (a fraction) slower than in the baseline results file.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(row["size"], row["stage"]): row for row in json.load(f)["results"]}
+    regressions = []
+    for row in rows:
+        before = baseline.get((row["size"], row["stage"]))
+        if not before or not before["run_p95"]:
+            continue
+        change = row["run_p95"] / before["run_p95"] - 1
+        if change > tolerance:
+            regressions.append(f"{row['size']} {row['stage']}: run p95 {before['run_p95']:.3f}s -> "
+                               f"{row['run_p95']:.3f}s (+{change:.0%})")
+    return regressions
+
+def parse_args(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the crawlers and reviewers against local fake GitLab and Azure OpenAI servers.")
+    parser.add_argument("--sizes", default=",".join(SIZES), help=f"Comma-separated merge request sizes to generate ({', '.join(SIZES)}).")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Merge requests reviewed per size (default: 3).")
+    parser.add_argument("--gitlab-latency", type=float, default=0.02, help="Seconds the fake GitLab waits before each answer (default: 0.02).")
+    parser.add_argument("--ai-latency", type=float, default=0.5, help="Seconds the fake model waits before answering (default: 0.5).")
+    parser.add_argument("--ai-chunk-delay", type=float, default=0.005, help="Seconds between streamed words of the fake model (default: 0.005).")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- share of the latency (default: 0.2).")
+    parser.add_argument("--gitlab-rate-limit", type=float, default=0.0, help="Share of GitLab requests answered with 429 (default: 0).")
+    parser.add_argument("--gitlab-redirect", action="store_true", help="Reach the fake GitLab API through a URL that answers every request with a 302.")
+    parser.add_argument("--gitlab-workers", type=int, default=None, help="Maximum number of GitLab requests in flight (default: GITLAB_MAX_WORKERS or 8).")
+    parser.add_argument("--ai-rate-limit", type=float, default=0.0, help="Share of model requests answered with 429 (default: 0).")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with a 429 (default: 1).")
+    parser.add_argument("-l", "--language", default="english", help="Language passed to the reviewers.")
+    parser.add_argument("-j", "--concurrency", type=int, default=None, help="Maximum number of AI calls at the same time (default: AI_MAX_CONCURRENCY or 4).")
+    parser.add_argument("--shard-tokens", type=int, default=None, help="Token budget of the diff in one review request (default: REVIEW_SHARD_TOKENS or 60000).")
+    parser.add_argument("-t", "--per-thread", action="store_true", help="Review each thread in its own call with only the hunks that touch it.")
+    parser.add_argument("-b", "--batch", action="store_true", help="Check several coding rules per AI call.")
+    parser.add_argument("--batch-tokens", type=int, default=None, help="Prompt-token budget of one batched call (default: CODING_RULE_BATCH_TOKENS or 32000).")
+    parser.add_argument("--cascade", action="store_true", help="Screen coding rules with the fast model before checking flagged ones with the strong model.")
+    parser.add_argument("--flag-rate", type=float, default=0.2, help="Share of rules the fake fast model flags with --cascade (default: 0.2).")
+    parser.add_argument("--no-filter", action="store_true", help="Send the generated lockfile and bundle changes to the reviewers too.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the generated merge requests, jitter and 429s.")
+    parser.add_argument("--save", default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", default=None, help="Results JSON of an earlier run; exit with 1 if a stage got slower.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown of run p95 against the baseline (default: 0.2 = 20%%).")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the output of the crawlers and reviewers.")
+    args = parser.parse_args(argv)
+    unknown = [size for size in args.sizes.split(",") if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown size(s): {', '.join(unknown)}")
+    return args
+
+async def run(args) -> int:
+    gitlab_server = FakeGitLab(latency=args.gitlab_latency, jitter=args.jitter, rate_limit=args.gitlab_rate_limit,
+                               retry_after=args.retry_after, seed=args.seed)
+    chat_server = FakeChatCompletions(latency=args.ai_latency, jitter=args.jitter, rate_limit=args.ai_rate_limit,
+                                      retry_after=args.retry_after, chunk_delay=args.ai_chunk_delay, seed=args.seed,
+                                      flag_rate=args.flag_rate, fast_model=get_model("fast"))
+    rows = []
+    with gitlab_server, chat_server, tempfile.TemporaryDirectory(prefix="review_bench_") as workspace:
+        # Point every module at the fake servers and a throwaway workspace
+        gitlib_crawler.gitlab_url = gitlib_diff_crawler.gitlab_url = gitlab_server.url
+        os.environ["WORKSPACE_PATH"] = workspace
+        os.environ["AZURE_OPENAI_ENDPOINT"] = chat_server.url
+        os.environ["AZURE_OPENAI_API_KEY"] = "benchmark"
+        # --gitlab-redirect sends every API request through one 302 hop, as an
+        # http:// GITLAB_URL redirecting to https:// would
+        api_url = gitlab_server.redirect_url if args.gitlab_redirect else gitlab_server.url
+        gl, _ = create_gitlab_client(api_url, "benchmark", max_in_flight=args.gitlab_workers or get_max_workers())
+        # Every call must reach the fake model
+        init_ai_caller(use_cache=False)
+        prompts = init_prompt_map()
+        try:
+            for size in args.sizes.split(","):
+                print(f"Benchmarking {size} merge requests ({SIZES[size]})...")
+                rows.extend(await bench_size(size, SIZES[size], args, gitlab_server, chat_server, gl, prompts, workspace))
+        finally:
+            await close_ai_caller()
+
+    print(format_results(rows))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.baseline:
+        regressions = compare_with_baseline(rows, args.baseline, args.tolerance)
+        for message in regressions:
+            print(f"Regression: {message}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No stage is more than {args.tolerance:.0%} slower than {args.baseline}")
+    return 0
+
+def main():
+    args = parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
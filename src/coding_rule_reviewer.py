@@ -3,34 +3,112 @@ import os
 import sys
 import argparse
 import asyncio
+import json
 from dotenv import load_dotenv
 from typing import Optional
 
-from azure_ai_caller import init_ai_caller, generate_response
+from azure_ai_caller import init_ai_caller, close_ai_caller, generate_response, get_max_concurrency, get_model
 from ai_prompts import init_prompt_map
+from diff_sharder import count_tokens
+from rule_filter import plan_rules, format_skipped_rules
+from diff_dedup import dedupe_diff, groups_in_report, format_copies
+import ai_cache
+import metrics
+
+# Prompt-token budget of one batched call (rules + diff), see plan_batches
+DEFAULT_BATCH_TOKENS = 32000
+# Output tokens available per call (generate_response max_tokens)
+OUTPUT_TOKENS = 4000
+# Answers of coding_rule_screen_prompt; only CLEAN rules skip the strong model
+SCREEN_VERDICTS = ("CLEAN", "VIOLATION", "UNSURE")
+# Output tokens of a screening call: one word is expected
+SCREEN_OUTPUT_TOKENS = 8
 
 def read_text_file(path: str) -> str:
     with open(path, 'r', encoding='utf-8') as f:
         return f.read()
 
-async def run_review(folder: str, rules_path: str, languages: str = "english") -> None:
+def get_batch_tokens() -> int:
+    try:
+        return int(os.getenv("CODING_RULE_BATCH_TOKENS", DEFAULT_BATCH_TOKENS))
+    except ValueError:
+        return DEFAULT_BATCH_TOKENS
+
+def plan_batches(rules: list, diff_tokens: int, batch_tokens: int) -> list:
     """
-    Read diff.txt from folder and rules from rules_path, call AI to check
-    whether the diff matches each coding rule, and write aggregated results
-    to coding_rule_result.md inside the folder.
+    Group rule indexes into batches for coding_rule_batch_prompt.
+    A batch is limited by the prompt budget left after the diff, and by the
+    output budget: the larger the diff, the longer each rule's report can be,
+    so fewer rules share one response.
     """
-    diff_path = os.path.join(folder, "diff.txt")
-    if not os.path.exists(diff_path):
-        print(f"Error: diff file not found at {diff_path}", file=sys.stderr)
-        sys.exit(1)
-    if not os.path.exists(rules_path):
-        print(f"Error: rules file not found at {rules_path}", file=sys.stderr)
-        sys.exit(1)
+    rule_budget = max(0, batch_tokens - diff_tokens)
+    expected_report_tokens = min(OUTPUT_TOKENS, 150 + diff_tokens // 20)
+    max_rules = max(1, OUTPUT_TOKENS // expected_report_tokens)
 
-    diff_content = read_text_file(diff_path)
-    rules_content = read_text_file(rules_path)
+    batches = []
+    current = []
+    current_tokens = 0
+    for index, rule in enumerate(rules):
+        rule_tokens = count_tokens(rule) + 4
+        if current and (len(current) >= max_rules or current_tokens + rule_tokens > rule_budget):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(index)
+        current_tokens += rule_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def parse_batch_response(response: Optional[str], rule_ids: list) -> Optional[dict]:
+    """
+    Parse the JSON verdicts of a batched call into {rule id: report}.
+    Returns None when the output is not valid or misses a rule.
+    """
+    if not response:
+        return None
+    text = response.strip()
+    # Tolerate a fenced ```json block around the object
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:]
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    results = data.get("results") if isinstance(data, dict) else None
+    if not isinstance(results, list):
+        return None
+
+    reports = {}
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        try:
+            rule_id = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        report = item.get("report")
+        reports[rule_id] = report if isinstance(report, str) else ""
+    if any(rule_id not in reports for rule_id in rule_ids):
+        return None
+    return reports
 
-    # Parse rules: one rule per line; ignore empty lines and lines that start with '#'
+def parse_screen_verdict(response: Optional[str]) -> str:
+    """
+    First word of a screening answer as one of SCREEN_VERDICTS; anything
+    else (empty, chatty, unknown word) counts as UNSURE.
+    """
+    words = (response or "").split()
+    verdict = words[0].strip(".,:;!*`'\"").upper() if words else ""
+    return verdict if verdict in SCREEN_VERDICTS else "UNSURE"
+
+def parse_rules(rules_content: str) -> list:
+    """
+    Parse rules: one rule per line; ignore empty lines and lines that start with '#'.
+    A rule line may end with applicability metadata, see rule_filter.parse_rule.
+    """
     rules = []
     for raw in rules_content.splitlines():
         line = raw.strip()
@@ -39,71 +117,275 @@ async def run_review(folder: str, rules_path: str, languages: str = "english") -
         if line.lstrip().startswith('#'):
             continue
         rules.append(line)
+    return rules
 
-    # Initialize AI caller (load env from repo .env by convention)
-    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
-    init_ai_caller()
-    prompts = init_prompt_map()
+async def check_rules(diff_content: str, rules: list, languages: str = "english", concurrency: Optional[int] = None,
+                      batch: bool = False, batch_tokens: Optional[int] = None, prompts: Optional[dict] = None,
+                      output_path: Optional[str] = None, cascade: bool = False) -> str:
+    """
+    Call AI to check whether the diff matches each coding rule and return the
+    aggregated coding_rule_result.md text. init_ai_caller() must have run.
+    Raises ValueError when the prompt is missing or a rule cannot be parsed.
+    With output_path, each rule's section is appended to that file as soon as
+    it and all rules before it are done.
+    Rules are checked concurrently, at most `concurrency` at a time
+    (default: AI_MAX_CONCURRENCY); results keep the order of the rules file.
+    With batch=True, as many rules as fit the token budget are checked in one
+    coding_rule_batch_prompt call; a batch whose JSON cannot be parsed falls
+    back to one call per rule.
+    Rules with applicability metadata (see rule_filter) only get the files
+    they apply to; rules that cannot apply to any file are not sent and are
+    listed under "Skipped rules" at the end of the result.
+    Hunks that repeat the same change are checked once per rule (see
+    diff_dedup), after the rule's files are selected; a finding on such a
+    hunk is followed by the other locations it stands for.
+    With cascade=True, the fast model tier (AI_FAST_MODEL) first screens
+    every rule with coding_rule_screen_prompt; only rules it does not answer
+    CLEAN (or whose screening call fails) are checked by the strong model.
+    Screened-out rules are left out of the result like a "No issues found."
+    answer.
+    """
+    if prompts is None:
+        prompts = init_prompt_map()
 
     # Prefer a dedicated coding_rule_prompt in ai_prompts.yaml, fall back to code_review_prompt.
     coding_rule_template = prompts.get("coding_rule_prompt")
 
     if not coding_rule_template:
-        print("Error: no coding_rule_prompt or code_review_prompt found in prompts.", file=sys.stderr)
-        sys.exit(1)
+        raise ValueError("'coding_rule_prompt' not found in ai_prompts.yaml")
 
-    aggregated_results = []
+    # Invalid rule metadata raises ValueError
+    plans = plan_rules(rules, diff_content)
+    skipped = [plan for plan in plans if plan.diff is None]
+    checked = [i for i, plan in enumerate(plans) if plan.diff is not None]
+    rules = [plan.spec.text for plan in plans]
+
+    # Repeats are grouped in each rule's own (full or narrowed) diff, so a
+    # path-scoped rule still sees the copies in the files it applies to;
+    # rules that share a diff share its deduplicated text
+    deduped = {}
+    repeat_groups = {}
+    for i in checked:
+        if plans[i].diff not in deduped:
+            deduped[plans[i].diff] = dedupe_diff(plans[i].diff, report=False)
+        plans[i].diff, repeat_groups[i] = deduped[plans[i].diff]
+    repeated = {group.location: group for _, groups in deduped.values() for group in groups}
+    if repeated:
+        print(f"Grouped {sum(len(group.copies) for group in repeated.values())} repeated hunks "
+              f"into {len(repeated)} changes checked once per rule.")
 
-    # Loop through each rule and call AI with that single rule and the full diff
-    print(f"Checking {len(rules)} rules...")
-    for rule in rules:
-        print(f"Checking rule: {rule}")
-        messages = []
-        # Fill the template for this single rule
-        for message in coding_rule_template:
-            content = message.get("content", "").format(comments="", diff=diff_content, rules=rule)
-            if message.get("role") == "system":
-                content += f"\n\nYour answer should be in the following languages, in this order: {languages}."
-            messages.append({"role": message.get("role", "user"), "content": content})
+    semaphore = asyncio.Semaphore(concurrency or get_max_concurrency())
 
+    async def screen_rule(rule: str, diff: str) -> str:
         try:
-            print(f"==========\n Calling AI...{messages} ==========\n")
-            response = await generate_response(messages)
+            async with semaphore:
+                messages = [{"role": message.get("role", "user"),
+                             "content": message.get("content", "").format(comments="", diff=diff, rules=rule)}
+                            for message in screen_template]
+                with metrics.label(f"screen: {rule}"):
+                    response = await generate_response(messages, temprature=0, tier="fast",
+                                                       max_tokens=SCREEN_OUTPUT_TOKENS)
         except Exception as e:
-            print(f"AI call failed for rule '{rule}': {e}", file=sys.stderr)
-            sys.exit(1)
+            print(f"Screening failed for rule '{rule}': {e}", file=sys.stderr)
+            return "UNSURE"
+        return parse_screen_verdict(response)
 
-        # Skip responses that contain "no issues found" (case-insensitive) or are empty
-        if response is not None:
-            resp_trim = response.strip()
-            if resp_trim and "no issues found" not in resp_trim.lower():
-                header = f"### Rule: {rule}\n\n"
-                aggregated_results.append(header + response)
+    async def check_rule(rule: str, diff: str) -> str:
+        # Messages are built once a slot is free, so at most `concurrency`
+        # copies of the diff exist at a time however many rules there are
+        async with semaphore:
+            messages = []
+            # Fill the template for this single rule
+            for message in coding_rule_template:
+                content = message.get("content", "").format(comments="", diff=diff, rules=rule)
+                messages.append({"role": message.get("role", "user"), "content": content})
+            # The diff comes before the rule, and the language line last, so all
+            # rule calls share the instructions + diff as a cached prompt prefix
+            messages[-1]["content"] += f"\n\nYour answer should be in the following languages, in this order: {languages}."
 
-    output_path = os.path.join(folder, "coding_rule_result.md")
+            print(f"Checking rule: {rule}")
+            with metrics.label(f"rule: {rule}"):
+                return await generate_response(messages)
+
+    async def check_batch(indexes: list, diff: str) -> list:
+        # Rule ids in the prompt are 1-based positions inside the batch
+        rule_ids = list(range(1, len(indexes) + 1))
+        numbered_rules = "\n".join(f"{rule_id}: {rules[i]}" for rule_id, i in zip(rule_ids, indexes))
+
+        reports = None
+        try:
+            async with semaphore:
+                messages = []
+                for message in batch_template:
+                    content = message.get("content", "").format(comments="", diff=diff, rules=numbered_rules)
+                    messages.append({"role": message.get("role", "user"), "content": content})
+                messages[-1]["content"] += f"\n\nThe reports should be in the following languages, in this order: {languages}."
+                print(f"Checking {len(indexes)} rules in one call: {[rules[i] for i in indexes]}")
+                with metrics.label(f"rules {indexes[0] + 1}-{indexes[-1] + 1} (batch)"):
+                    response = await generate_response(messages, response_format={"type": "json_object"})
+            reports = parse_batch_response(response, rule_ids)
+        except Exception as e:
+            print(f"Batched AI call failed: {e}", file=sys.stderr)
+        if reports is None:
+            print(f"Could not use the batched answer; checking these {len(indexes)} rules one by one.")
+            return list(await asyncio.gather(*(check_rule(rules[i], diff) for i in indexes), return_exceptions=True))
+        return [reports[rule_id] for rule_id in rule_ids]
+
+    screen_template = prompts.get("coding_rule_screen_prompt") if cascade else None
+    if cascade and not screen_template:
+        print("Warning: coding_rule_screen_prompt not found in prompts; checking every rule with the strong model.",
+              file=sys.stderr)
+    if screen_template and checked:
+        verdicts = await asyncio.gather(*(screen_rule(rules[i], plans[i].diff) for i in checked))
+        screened = len(checked)
+        checked = [i for i, verdict in zip(checked, verdicts) if verdict != "CLEAN"]
+        print(f"Screened {screened} rules with {get_model('fast')}: "
+              f"{len(checked)} sent to {get_model('strong')}.")
+
+    print(f"Checking {len(checked)} rules...")
+    if skipped:
+        print(f"Skipping {len(skipped)} rules that cannot apply to the changed files.")
+    batch_template = prompts.get("coding_rule_batch_prompt") if batch else None
+    if batch and not batch_template:
+        print("Warning: coding_rule_batch_prompt not found in prompts; checking rules one by one.", file=sys.stderr)
+    if batch_template:
+        # Only rules that see the same (full or narrowed) diff can share a call
+        by_diff = {}
+        for i in checked:
+            by_diff.setdefault(plans[i].diff, []).append(i)
+        batches = []
+        for diff, indexes in by_diff.items():
+            group = plan_batches([rules[i] for i in indexes], count_tokens(diff), batch_tokens or get_batch_tokens())
+            batches.extend(([indexes[j] for j in batch], diff) for batch in group)
+        print(f"Packed {len(checked)} rules into {len(batches)} calls.")
+        batch_tasks = [asyncio.ensure_future(check_batch(indexes, diff)) for indexes, diff in batches]
+        position = {}
+        for batch_task, (indexes, _) in zip(batch_tasks, batches):
+            for offset, i in enumerate(indexes):
+                position[i] = (batch_task, offset)
+
+        async def rule_response(i: int):
+            batch_task, offset = position[i]
+            return (await batch_task)[offset]
+    else:
+        # Call AI with each single rule and the full diff
+        rule_tasks = {i: asyncio.ensure_future(check_rule(rules[i], plans[i].diff)) for i in checked}
+
+        async def rule_response(i: int):
+            return await rule_tasks[i]
+
+    # All calls are already running; awaiting them in rule order keeps the
+    # result in rule order while each finished section is written right away
+    out = open(output_path, 'w', encoding='utf-8') if output_path else None
+    aggregated_results = []
+    failed_rules = []
     try:
-        if aggregated_results:
-            final = "\n\n".join(aggregated_results)
-        else:
-            final = "No issues found."
-        with open(output_path, 'w', encoding='utf-8') as out:
+        for i in checked:
+            rule = rules[i]
+            try:
+                response = await rule_response(i)
+            except Exception as e:
+                response = e
+            if isinstance(response, Exception):
+                # Keep the other rules' results; the failed rule is listed as not checked
+                print(f"AI call failed for rule '{rule}': {response}", file=sys.stderr)
+                failed_rules.append(rule)
+                response = f"Not checked: the AI call failed after retries ({type(response).__name__}: {response})."
+
+            # Skip responses that contain "no issues found" (case-insensitive) or are empty
+            if response is not None:
+                resp_trim = response.strip()
+                if resp_trim and "no issues found" not in resp_trim.lower():
+                    header = f"### Rule: {rule}\n\n"
+                    copies = groups_in_report(response, repeat_groups[i])
+                    if copies:
+                        response = response.rstrip() + "\n\n" + format_copies(copies)
+                    if out is not None:
+                        out.write(("\n\n" if aggregated_results else "") + header + response)
+                        out.flush()
+                    aggregated_results.append(header + response)
+
+        final = "\n\n".join(aggregated_results) if aggregated_results else "No issues found."
+        if out is not None and not aggregated_results:
             out.write(final)
-    except Exception as e:
+        if skipped:
+            section = format_skipped_rules(skipped)
+            final += "\n\n" + section
+            if out is not None:
+                out.write("\n\n" + section)
+    finally:
+        if out is not None:
+            out.close()
+    if failed_rules:
+        print(f"Warning: {len(failed_rules)} of {len(checked)} rules could not be checked.", file=sys.stderr)
+    return final
+
+async def run_review(folder: str, rules_path: str, languages: str = "english", concurrency: Optional[int] = None,
+                     use_cache: bool = True, clear_cache: bool = False, batch: bool = False,
+                     batch_tokens: Optional[int] = None, cascade: bool = False) -> None:
+    """
+    Read diff.txt from folder and rules from rules_path, check the diff
+    against each coding rule (see check_rules), and write aggregated results
+    to coding_rule_result.md inside the folder.
+    Responses are cached on disk, so only rules whose prompt changed call the API again.
+    """
+    diff_path = os.path.join(folder, "diff.txt")
+    if not os.path.exists(diff_path):
+        print(f"Error: diff file not found at {diff_path}", file=sys.stderr)
+        sys.exit(1)
+    if not os.path.exists(rules_path):
+        print(f"Error: rules file not found at {rules_path}", file=sys.stderr)
+        sys.exit(1)
+
+    diff_content = read_text_file(diff_path)
+    rules = parse_rules(read_text_file(rules_path))
+
+    # Initialize AI caller (load env from repo .env by convention)
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+    init_ai_caller(use_cache=use_cache, clear_cache=clear_cache)
+
+    output_path = os.path.join(folder, "coding_rule_result.md")
+    try:
+        await check_rules(diff_content, rules, languages, concurrency, batch=batch, batch_tokens=batch_tokens,
+                          output_path=output_path, cascade=cascade)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    except OSError as e:
         print(f"Failed to write result file: {e}", file=sys.stderr)
         sys.exit(1)
 
     print(f"Result written to {output_path}")
+    ai_cache.print_stats()
 
 def parse_args(argv: Optional[list] = None):
     parser = argparse.ArgumentParser(description="Check diff against coding rules using AI.")
     parser.add_argument("folder", help="Folder that contains diff.txt")
     parser.add_argument("rules_file", help="Path to the file that contains coding rules")
     parser.add_argument("-l", "--language", help="Comma-separated list of languages for the AI response (e.g., japanese,english,chinese).", default="english")
+    parser.add_argument("-j", "--concurrency", type=int, default=None, help="Maximum number of rules checked at the same time (default: AI_MAX_CONCURRENCY or 4).")
+    parser.add_argument("-b", "--batch", action="store_true", help="Check several rules per AI call and split the JSON answer back into per-rule sections.")
+    parser.add_argument("--batch-tokens", type=int, default=None, help="Prompt-token budget of one batched call (default: CODING_RULE_BATCH_TOKENS or 32000).")
+    parser.add_argument("--cascade", action="store_true", help="Screen each rule with the fast model (AI_FAST_MODEL) first and send only flagged or unsure rules to the strong model (AI_MODEL).")
+    parser.add_argument("--profile", action="store_true", help="Run under cProfile and save the stats to profile.prof in the folder.")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the AI response cache for this run.")
+    parser.add_argument("--clear-cache", action="store_true", help="Empty the AI response cache before running.")
     return parser.parse_args(argv)
 
+async def run_and_close(args) -> None:
+    try:
+        await run_review(args.folder, args.rules_file, args.language, args.concurrency,
+                         use_cache=not args.no_cache, clear_cache=args.clear_cache,
+                         batch=args.batch, batch_tokens=args.batch_tokens, cascade=args.cascade)
+    finally:
+        await close_ai_caller()
+        metrics.write_trace(args.folder)
+        metrics.print_summary()
+
 def main():
     args = parse_args()
-    asyncio.run(run_review(args.folder, args.rules_file, args.language))
+    with metrics.profiled(args.profile, os.path.join(args.folder, metrics.PROFILE_FILE_NAME)):
+        asyncio.run(run_and_close(args))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import re
+import hashlib
+from typing import List
+
+from diff_model import HUNK_HEADER_RE, NUMBERED_LINE_RE, SEPARATOR_RE
+from diff_sharder import split_files
+
+# Changes shorter than this (after normalization) are too generic to group, e.g. a lone "+}"
+MIN_DEDUP_CHARS = 40
+# Written after the first copy of a repeated hunk; parse_diff_text skips it
+REPEAT_NOTE_PREFIX = "~ Same change also in: "
+
+class RepeatGroup:
+    """
+    Identical changes: `location` ("path:line") is the copy kept in the
+    diff, `copies` the locations it stands for. `path` and `lines` (first,
+    last line number shown) identify the kept hunk in a finding.
+    """
+
+    def __init__(self, location: str, path: str = "", lines: tuple = (0, 0)):
+        self.location = location
+        self.path = path
+        self.lines = lines
+        self.copies = []
+
+def _changed_lines(body: List[str]) -> List[tuple]:
+    # (kind, line number or None, code) of every +/- line of a hunk body
+    changed = []
+    for line in body:
+        numbered = NUMBERED_LINE_RE.match(line.rstrip("\n"))
+        if numbered:
+            kind, number, code = numbered.group(1), int(numbered.group(2)), numbered.group(3) or ""
+        elif line[:1] in ("+", "-"):
+            kind, number, code = line[0], None, line[1:]
+        else:
+            continue
+        if kind in ("+", "-"):
+            changed.append((kind, number, code))
+    return changed
+
+def hunk_key(path: str, body: List[str]):
+    """
+    Hash of the changed lines of a hunk with whitespace collapsed, or None
+    when the change is too small to group. Context lines and line numbers
+    are left out, so the same edit in differently placed code matches; the
+    file extension is kept, so a rule for one language still sees its files.
+    """
+    normalized = "\n".join(f"{kind}{' '.join(code.split())}" for kind, _, code in _changed_lines(body))
+    if len(normalized) < MIN_DEDUP_CHARS:
+        return None
+    extension = os.path.splitext(path)[1].lower()
+    return hashlib.sha256(f"{extension}\0{normalized}".encode("utf-8")).hexdigest()
+
+def _split_block(block: str) -> tuple:
+    # (path, header lines, [(hunk header, body lines)], trailing lines) of one "File:" block
+    lines = block.splitlines(keepends=True)
+    path = lines[0][len("File: "):].strip()
+    header = []
+    hunks = []
+    for line in lines:
+        if HUNK_HEADER_RE.match(line.rstrip("\n")):
+            hunks.append((line, []))
+        elif hunks:
+            hunks[-1][1].append(line)
+        else:
+            header.append(line)
+    # The blank line and separator after the last hunk belong to the block, not the hunk
+    trailing = []
+    if hunks:
+        body = hunks[-1][1]
+        while body and (body[-1].rstrip("\n") == "" or SEPARATOR_RE.match(body[-1].rstrip("\n"))):
+            trailing.insert(0, body.pop())
+    return path, header, hunks, trailing
+
+def _location(path: str, hunk_header: str, body: List[str]) -> str:
+    numbers = [number for _, number, _ in _changed_lines(body) if number is not None]
+    if numbers:
+        return f"{path}:{numbers[0]}"
+    match = HUNK_HEADER_RE.match(hunk_header.rstrip("\n"))
+    return f"{path}:{match.group(3)}" if match else path
+
+def _line_range(body: List[str]) -> tuple:
+    numbers = [int(match.group(2)) for match in (NUMBERED_LINE_RE.match(line.rstrip("\n")) for line in body) if match]
+    return (min(numbers), max(numbers)) if numbers else (0, 0)
+
+def dedupe_diff(diff_content: str, report: bool = True) -> tuple:
+    """
+    Keep only the first copy of hunks that repeat the same change across
+    diff.txt (codemods, renames, API migrations). The kept copy gets a note
+    listing the other locations; files left without hunks are dropped.
+    Returns (diff text, [RepeatGroup]); the text is returned unchanged when
+    nothing repeats. report=False leaves the summary line to the caller.
+    """
+    blocks = split_files(diff_content)
+
+    # First pass keeps only the hash of every hunk; blocks are split again
+    # in the second pass when one of their hunks is dropped or annotated
+    groups = {}
+    first_seen = {}
+    duplicate = set()
+    for b, block in enumerate(blocks):
+        if not block.startswith("File: "):
+            continue
+        path, _, hunks, _ = _split_block(block)
+        for h, (hunk_header, body) in enumerate(hunks):
+            key = hunk_key(path, body)
+            if key is None:
+                continue
+            location = _location(path, hunk_header, body)
+            if key not in first_seen:
+                first_seen[key] = (b, h)
+                groups[key] = RepeatGroup(location, path, _line_range(body))
+            else:
+                groups[key].copies.append(location)
+                duplicate.add((b, h))
+    if not duplicate:
+        return diff_content, []
+
+    notes = {first_seen[key]: group for key, group in groups.items() if group.copies}
+    touched = {b for b, _ in duplicate} | {b for b, _ in notes}
+    out = []
+    for b, block in enumerate(blocks):
+        if b not in touched:
+            out.append(block)
+            continue
+        path, header, hunks, trailing = _split_block(block)
+        kept = []
+        for h, (hunk_header, body) in enumerate(hunks):
+            if (b, h) in duplicate:
+                continue
+            kept.append(hunk_header)
+            kept.extend(body)
+            group = notes.get((b, h))
+            if group is not None:
+                kept.append(REPEAT_NOTE_PREFIX + ", ".join(group.copies) + "\n")
+        if hunks and not kept:
+            continue
+        out.append("".join(header) + "".join(kept) + "".join(trailing))
+    repeated = [group for group in groups.values() if group.copies]
+    if report:
+        print(f"Grouped {sum(len(group.copies) for group in repeated)} repeated hunks "
+              f"into {len(repeated)} changes reviewed once.")
+    return "".join(out), repeated
+
+def _mentions(report: str, path: str) -> bool:
+    if path in report:
+        return True
+    name = os.path.basename(path)
+    return bool(name) and re.search(rf"(?<![\w./-]){re.escape(name)}(?![\w-])", report) is not None
+
+def groups_in_report(report: str, groups: List[RepeatGroup]) -> List[RepeatGroup]:
+    """
+    The groups whose kept copy a finding points at: the report names the
+    copy's file and one of the hunk's line numbers, or names a file that
+    has only that one repeated hunk.
+    """
+    numbers = {int(n) for n in re.findall(r"\d+", report)}
+    per_file = {}
+    for group in groups:
+        per_file[group.path] = per_file.get(group.path, 0) + 1
+    found = []
+    for group in groups:
+        if not _mentions(report, group.path):
+            continue
+        first, last = group.lines
+        if per_file[group.path] == 1 or any(first <= n <= last for n in numbers):
+            found.append(group)
+    return found
+
+def format_copies(groups: List[RepeatGroup]) -> str:
+    """
+    Note under a finding: the other locations of the repeated hunks it is about.
+    """
+    lines = ["The same change, and so any finding above on it, is also in:"]
+    lines.extend(f"- {group.location}: {', '.join(group.copies)}" for group in groups)
+    return "\n".join(lines)
+
+def format_repeat_groups(groups: List[RepeatGroup]) -> str:
+    lines = ["### Repeated changes", "",
+             "These changes appear in several places and were reviewed once, at the first location. "
+             "Findings there apply to every location listed with it:", ""]
+    lines.extend(f"- {group.location}: also {', '.join(group.copies)}" for group in groups)
+    return "\n".join(lines)
@@ -0,0 +1,186 @@
+import os
+import re
+import fnmatch
+from typing import Iterable, Iterator, List, Optional
+
+# Files that are never worth reviewing: lockfiles, minified bundles, source
+# maps, snapshots, vendored and generated code. DIFF_IGNORE_GLOBS adds more.
+DEFAULT_IGNORE_GLOBS = (
+    "package-lock.json", "yarn.lock", "pnpm-lock.yaml", "npm-shrinkwrap.json", "poetry.lock", "Pipfile.lock",
+    "uv.lock", "Cargo.lock", "Gemfile.lock", "composer.lock", "go.sum", "*.lock",
+    "*.min.js", "*.min.css", "*.map", "*.snap", "__snapshots__/*",
+    "vendor/*", "node_modules/*", "third_party/*", "dist/*",
+    "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.generated.*", "*.g.dart", "*.designer.cs",
+)
+# Largest per-file diff kept in diff.txt (DIFF_MAX_FILE_BYTES, 0 = no limit)
+DEFAULT_MAX_FILE_BYTES = 100000
+# File manifest written next to diff.txt
+MANIFEST_FILE_NAME = "skipped_files.txt"
+
+# Markers generators put at the top of the files they write
+GENERATED_MARKER_RE = re.compile(r"@generated|do not edit|code generated by|auto-?generated", re.IGNORECASE)
+GENERATED_MARKER_LINES = 5
+# Languages where indentation is syntax: only trailing whitespace and blank lines are ignorable
+INDENTATION_SENSITIVE_GLOBS = ("*.py", "*.pyi", "*.yaml", "*.yml", "Makefile", "*.mk", "*.haml", "*.pug",
+                               "*.coffee", "*.sass", "*.nim", "*.fs")
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+def parse_hunks(diff_text: str) -> list:
+    """
+    Split a unified diff into (header line, body lines) per hunk; text before
+    the first @@ is returned as a hunk with header None.
+    """
+    hunks = []
+    header, body = None, []
+    for line in diff_text.splitlines():
+        if line.startswith("@@"):
+            if header is not None or body:
+                hunks.append((header, body))
+            header, body = line, []
+        else:
+            body.append(line)
+    if header is not None or body:
+        hunks.append((header, body))
+    return hunks
+
+def is_whitespace_only(body: list, keep_indentation: bool = False) -> bool:
+    """
+    True when the removed and added lines of a hunk differ only in whitespace
+    (indentation, trailing spaces, blank lines, line wrapping). With
+    keep_indentation, only trailing spaces and blank lines are ignored.
+    """
+    if keep_indentation:
+        def normalize(prefix):
+            return [line[1:].rstrip() for line in body if line.startswith(prefix) and line[1:].strip()]
+    else:
+        def normalize(prefix):
+            return "".join("".join(line[1:].split()) for line in body if line.startswith(prefix))
+    has_changes = any(line[:1] in ("+", "-") for line in body)
+    return has_changes and normalize("-") == normalize("+")
+
+def looks_generated(diff: dict) -> bool:
+    """
+    GitLab's generated_file flag, or a generator marker in the first lines of the file.
+    """
+    if diff.get("generated_file"):
+        return True
+    for header, body in parse_hunks(diff.get("diff") or ""):
+        match = HUNK_HEADER_RE.match(header or "")
+        if not match or int(match.group(1)) > 1:
+            return False
+        added = [line[1:] for line in body if line.startswith("+")][:GENERATED_MARKER_LINES]
+        return any(GENERATED_MARKER_RE.search(line) for line in added)
+    return False
+
+class DiffFilter:
+    """
+    Drops the parts of an MR diff that only cost tokens: ignored paths
+    (glob patterns, matched against the path and any trailing part of it),
+    per-file diffs over max_file_bytes, binary and generated files, rename-only
+    entries and whitespace-only hunks.
+    """
+
+    def __init__(self, ignore_globs=DEFAULT_IGNORE_GLOBS, max_file_bytes: int = DEFAULT_MAX_FILE_BYTES,
+                 skip_generated: bool = True, skip_whitespace: bool = True):
+        self.ignore_globs = tuple(ignore_globs)
+        self.max_file_bytes = max_file_bytes
+        self.skip_generated = skip_generated
+        self.skip_whitespace = skip_whitespace
+
+    @classmethod
+    def from_env(cls) -> "DiffFilter":
+        """
+        Default filter extended by DIFF_IGNORE_GLOBS (comma-separated) and
+        limited by DIFF_MAX_FILE_BYTES.
+        """
+        extra = [glob.strip() for glob in (os.getenv("DIFF_IGNORE_GLOBS") or "").split(",") if glob.strip()]
+        try:
+            max_file_bytes = int(os.getenv("DIFF_MAX_FILE_BYTES", DEFAULT_MAX_FILE_BYTES))
+        except ValueError:
+            max_file_bytes = DEFAULT_MAX_FILE_BYTES
+        return cls(DEFAULT_IGNORE_GLOBS + tuple(extra), max_file_bytes)
+
+    def ignored_by(self, path: str) -> Optional[str]:
+        for glob in self.ignore_globs:
+            if fnmatch.fnmatch(path, glob) or fnmatch.fnmatch(path, f"*/{glob}"):
+                return glob
+        return None
+
+    def skip_reason(self, diff: dict) -> Optional[str]:
+        path = diff.get("new_path") or diff.get("old_path") or ""
+        text = diff.get("diff") or ""
+        glob = self.ignored_by(path)
+        if glob:
+            return f"ignored by pattern '{glob}'"
+        if not text.strip():
+            if diff.get("renamed_file"):
+                return "rename only"
+            if diff.get("too_large") or diff.get("collapsed"):
+                return "diff not returned by GitLab (too large)"
+            return "binary or empty diff"
+        if text.startswith("Binary files "):
+            return "binary file"
+        if self.max_file_bytes and len(text.encode("utf-8")) > self.max_file_bytes:
+            return f"diff too large ({len(text.encode('utf-8'))} bytes > {self.max_file_bytes})"
+        if self.skip_generated and looks_generated(diff):
+            return "generated file"
+        return None
+
+    def apply(self, diffs: list) -> tuple:
+        """
+        Returns (kept diffs, skipped entries). Kept diffs are copies whose
+        whitespace-only hunks are removed; skipped entries are
+        {"path", "reason"} dicts, also for files that only lost some hunks.
+        """
+        skipped = []
+        kept = list(self.iter_apply(diffs, skipped))
+        return kept, skipped
+
+    def iter_apply(self, diffs: Iterable[dict], skipped: list) -> Iterator[dict]:
+        """
+        Lazy form of apply for streamed diffs: yields the kept diffs and
+        appends the skipped entries to `skipped` as it goes.
+        """
+        for diff in diffs:
+            path = diff.get("new_path") or diff.get("old_path") or "<unknown>"
+            reason = self.skip_reason(diff)
+            if reason:
+                skipped.append({"path": path, "reason": reason})
+                continue
+            if not self.skip_whitespace:
+                yield diff
+                continue
+
+            hunks = parse_hunks(diff.get("diff") or "")
+            keep_indentation = any(fnmatch.fnmatch(os.path.basename(path), glob) for glob in INDENTATION_SENSITIVE_GLOBS)
+            remaining = [(header, body) for header, body in hunks
+                         if header is None or not is_whitespace_only(body, keep_indentation)]
+            removed = len(hunks) - len(remaining)
+            if removed == 0:
+                yield diff
+                continue
+            if not any(header is not None for header, _ in remaining):
+                skipped.append({"path": path, "reason": "whitespace-only changes"})
+                continue
+            lines = []
+            for header, body in remaining:
+                if header is not None:
+                    lines.append(header)
+                lines.extend(body)
+            skipped.append({"path": path, "reason": f"{removed} whitespace-only hunk(s) removed"})
+            yield dict(diff, diff="\n".join(lines) + "\n")
+
+def get_diff_filter(enabled: bool = True) -> Optional[DiffFilter]:
+    """
+    The filter the crawlers apply before writing diff.txt, or None when disabled.
+    """
+    return DiffFilter.from_env() if enabled else None
+
+def format_manifest(skipped: List[dict]) -> str:
+    lines = ["# Left out of diff.txt by the diff filter"]
+    lines.extend(f"{entry['path']}: {entry['reason']}" for entry in skipped)
+    return "\n".join(lines) + "\n"
+
+def report_skipped(skipped: List[dict]) -> None:
+    if skipped:
+        print(f"Diff filter: left out or trimmed {len(skipped)} files (see skipped_files.txt).")
@@ -0,0 +1,242 @@
+import os
+import re
+from typing import Iterable, List, Optional
+
+# Context lines GitLab sends around every change
+GITLAB_CONTEXT_LINES = 3
+# Context lines around each hunk in diff.txt (DIFF_CONTEXT_LINES)
+DEFAULT_CONTEXT_LINES = 3
+
+HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?(.*)$")
+# "+  12 | code" as written by format_file_diffs
+NUMBERED_LINE_RE = re.compile(r"^([+\- ]) *(\d+) \|(?: (.*))?$")
+SEPARATOR_RE = re.compile(r"^-{20,}$")
+
+class DiffLine:
+    """
+    One line of a hunk: kind is "+", "-" or " " (context); old_no/new_no are
+    its line numbers in the old/new file (None on the side it does not exist).
+    """
+
+    __slots__ = ("kind", "old_no", "new_no", "text")
+
+    def __init__(self, kind: str, old_no: Optional[int], new_no: Optional[int], text: str):
+        self.kind = kind
+        self.old_no = old_no
+        self.new_no = new_no
+        self.text = text
+
+    @property
+    def number(self) -> int:
+        # Removed lines are numbered in the old file, the others in the new one
+        return self.old_no if self.kind == "-" else self.new_no
+
+class Hunk:
+    __slots__ = ("old_start", "new_start", "section", "lines")
+
+    def __init__(self, old_start: int, new_start: int, section: str = "", lines: Optional[List[DiffLine]] = None):
+        self.old_start = old_start
+        self.new_start = new_start
+        self.section = section
+        self.lines = lines if lines is not None else []
+
+    @property
+    def old_count(self) -> int:
+        return sum(1 for line in self.lines if line.kind != "+")
+
+    @property
+    def new_count(self) -> int:
+        return sum(1 for line in self.lines if line.kind != "-")
+
+    @property
+    def new_end(self) -> int:
+        return self.new_start + self.new_count - 1
+
+    def header(self) -> str:
+        # Like unified diff, a side with zero lines names the line before the change
+        old_count, new_count = self.old_count, self.new_count
+        old_start = self.old_start if old_count else self.old_start - 1
+        new_start = self.new_start if new_count else self.new_start - 1
+        header = f"@@ -{old_start},{old_count} +{new_start},{new_count} @@"
+        return f"{header} {self.section}" if self.section else header
+
+    def changed_lines(self) -> List[DiffLine]:
+        return [line for line in self.lines if line.kind != " "]
+
+class FileDiff:
+    __slots__ = ("old_path", "new_path", "new_file", "deleted_file", "renamed_file", "hunks")
+
+    def __init__(self, old_path: str, new_path: str, hunks: Optional[List[Hunk]] = None, new_file: bool = False,
+                 deleted_file: bool = False, renamed_file: bool = False):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks = hunks if hunks is not None else []
+        self.new_file = new_file
+        self.deleted_file = deleted_file
+        self.renamed_file = renamed_file
+
+    @property
+    def path(self) -> str:
+        return self.new_path or self.old_path or "<unknown>"
+
+def get_context_lines() -> int:
+    try:
+        return max(0, int(os.getenv("DIFF_CONTEXT_LINES", DEFAULT_CONTEXT_LINES)))
+    except ValueError:
+        return DEFAULT_CONTEXT_LINES
+
+def parse_unified(diff_text: str) -> List[Hunk]:
+    """
+    Parse the hunks of a unified diff (the "diff" field of a GitLab diff).
+    """
+    hunks = []
+    hunk = None
+    old_no = new_no = 0
+    for raw in diff_text.splitlines():
+        match = HUNK_HEADER_RE.match(raw)
+        if match:
+            old_no, new_no = int(match.group(1)), int(match.group(3))
+            # A side with zero lines names the line before the change
+            if match.group(2) == "0":
+                old_no += 1
+            if match.group(4) == "0":
+                new_no += 1
+            hunk = Hunk(old_no, new_no, match.group(5))
+            hunks.append(hunk)
+            continue
+        if hunk is None or raw.startswith("\\"):
+            # Text before the first hunk, "\ No newline at end of file"
+            continue
+        kind, text = (raw[0], raw[1:]) if raw and raw[0] in "+- " else (" ", raw)
+        if kind == "+":
+            hunk.lines.append(DiffLine("+", None, new_no, text))
+            new_no += 1
+        elif kind == "-":
+            hunk.lines.append(DiffLine("-", old_no, None, text))
+            old_no += 1
+        else:
+            hunk.lines.append(DiffLine(" ", old_no, new_no, text))
+            old_no += 1
+            new_no += 1
+    return hunks
+
+def from_gitlab(diff: dict) -> FileDiff:
+    return FileDiff(diff.get("old_path"), diff.get("new_path"), parse_unified(diff.get("diff") or ""),
+                    new_file=bool(diff.get("new_file")), deleted_file=bool(diff.get("deleted_file")),
+                    renamed_file=bool(diff.get("renamed_file")))
+
+def parse_gitlab_diffs(diffs: Iterable[dict]) -> List[FileDiff]:
+    return [from_gitlab(diff) for diff in diffs]
+
+def _trim(hunk: Hunk, context: int) -> Hunk:
+    # Drop the context lines GitLab sent beyond `context` on either side
+    changed = [i for i, line in enumerate(hunk.lines) if line.kind != " "]
+    if not changed:
+        return hunk
+    first, last = changed[0], changed[-1]
+    skip = first - min(first, context)
+    lines = hunk.lines[skip:last + 1 + min(len(hunk.lines) - 1 - last, context)]
+    return Hunk(hunk.old_start + skip, hunk.new_start + skip, hunk.section, lines)
+
+def _context_lines(file_lines: list, old_no: int, new_no: int, count: int) -> List[DiffLine]:
+    # Unchanged lines between hunks, numbered from (old_no, new_no)
+    return [DiffLine(" ", old_no + i, new_no + i, file_lines[new_no + i - 1]) for i in range(max(0, count))]
+
+def with_context(file_diff: FileDiff, context: int, file_lines: Optional[list] = None) -> FileDiff:
+    """
+    Return a copy of file_diff whose hunks carry exactly `context` lines
+    before and after their changes: extra context from GitLab is dropped,
+    missing context is taken from file_lines (the new file, when given).
+    Added and removed lines always come from the original hunks; context
+    read from file_lines never reaches into a neighbouring hunk, and hunks
+    whose context meets are merged.
+    """
+    trimmed = [_trim(hunk, context) for hunk in file_diff.hunks]
+    hunks = []
+    for index, hunk in enumerate(trimmed):
+        previous = hunks[-1] if hunks else None
+        if file_lines is not None:
+            lines = list(hunk.lines)
+            leading = next((i for i, line in enumerate(lines) if line.kind != " "), len(lines))
+            trailing = next((i for i, line in enumerate(reversed(lines)) if line.kind != " "), len(lines))
+            # Before: down to line 1, or the line after the previous (extended) hunk
+            floor = previous.new_end if previous is not None else 0
+            count = min(context - leading, hunk.new_start - 1 - floor)
+            old_start, new_start = hunk.old_start - max(0, count), hunk.new_start - max(0, count)
+            lines = _context_lines(file_lines, old_start, new_start, count) + lines
+            # After: up to the end of the file, or the line before the next hunk
+            next_old, next_new = hunk.old_start + hunk.old_count, hunk.new_start + hunk.new_count
+            ceiling = trimmed[index + 1].new_start - 1 if index + 1 < len(trimmed) else len(file_lines)
+            lines += _context_lines(file_lines, next_old, next_new, min(context - trailing, ceiling - next_new + 1))
+            hunk = Hunk(old_start, new_start, hunk.section, lines)
+        if previous is not None and previous.lines and hunk.new_start <= previous.new_end + 1:
+            # Neighbouring hunks never overlap, so the lines just follow on
+            previous.lines.extend(hunk.lines)
+            continue
+        hunks.append(hunk)
+    return FileDiff(file_diff.old_path, file_diff.new_path, hunks, file_diff.new_file,
+                    file_diff.deleted_file, file_diff.renamed_file)
+
+def format_file_diffs(file_diffs: Iterable[FileDiff], section_header: str = "Changes:", separator: str = "-" * 20) -> str:
+    """
+    Write files as diff.txt sections: "File:", the section header, then each
+    hunk header followed by "<+|-| ><line number> | <code>" lines.
+    """
+    out = []
+    for file_diff in file_diffs:
+        out.append(f"File: {file_diff.path}")
+        out.append(section_header)
+        width = len(str(max((line.number or 0 for hunk in file_diff.hunks for line in hunk.lines), default=0)))
+        for hunk in file_diff.hunks:
+            out.append(hunk.header())
+            for line in hunk.lines:
+                out.append(f"{line.kind}{line.number:>{width}} | {line.text}")
+        out.append("")
+        out.append(separator)
+    return "\n".join(out) + "\n" if out else ""
+
+def parse_diff_text(text: str) -> List[FileDiff]:
+    """
+    Read diff.txt (as written by format_file_diffs, or with raw unified
+    hunks) back into FileDiff objects.
+    """
+    file_diffs = []
+    file_diff = None
+    hunk = None
+    old_no = new_no = 0
+    for raw in text.splitlines():
+        if raw.startswith("File: "):
+            path = raw[len("File: "):].strip()
+            file_diff = FileDiff(path, path)
+            file_diffs.append(file_diff)
+            hunk = None
+            continue
+        if file_diff is None or SEPARATOR_RE.match(raw):
+            continue
+        match = HUNK_HEADER_RE.match(raw)
+        if match:
+            old_no, new_no = int(match.group(1)), int(match.group(3))
+            if match.group(2) == "0":
+                old_no += 1
+            if match.group(4) == "0":
+                new_no += 1
+            hunk = Hunk(old_no, new_no, match.group(5))
+            file_diff.hunks.append(hunk)
+            continue
+        if hunk is None or not raw:
+            continue
+        numbered = NUMBERED_LINE_RE.match(raw)
+        kind, text_part = (numbered.group(1), numbered.group(3) or "") if numbered else (raw[0], raw[1:])
+        if kind not in "+- ":
+            continue
+        if kind == "+":
+            hunk.lines.append(DiffLine("+", None, new_no, text_part))
+            new_no += 1
+        elif kind == "-":
+            hunk.lines.append(DiffLine("-", old_no, None, text_part))
+            old_no += 1
+        else:
+            hunk.lines.append(DiffLine(" ", old_no, new_no, text_part))
+            old_no += 1
+            new_no += 1
+    return file_diffs
@@ -0,0 +1,140 @@
+import os
+from typing import List
+
+import metrics
+
+# Default token budget for the diff part of one review request
+DEFAULT_SHARD_TOKENS = 60000
+# Lines the crawlers write between "File:" and the diff body
+SECTION_HEADERS = ("Changes:", "Changed lines:")
+
+# Loaded on the first count_tokens call: importing tiktoken and its encoding is slow
+_encoding = None
+_encoding_loaded = False
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            _encoding = metrics.timed_import("tiktoken").get_encoding("o200k_base")
+        except Exception:
+            # tiktoken is optional; fall back to the usual ~4 characters per token estimate
+            _encoding = None
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens locally (tiktoken when installed, otherwise an estimate).
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def get_shard_tokens() -> int:
+    """
+    Token budget per shard, from REVIEW_SHARD_TOKENS (default DEFAULT_SHARD_TOKENS).
+    """
+    try:
+        return max(1000, int(os.getenv("REVIEW_SHARD_TOKENS", DEFAULT_SHARD_TOKENS)))
+    except ValueError:
+        return DEFAULT_SHARD_TOKENS
+
+def split_files(diff_content: str) -> List[str]:
+    """
+    Split diff.txt content into one block per "File:" section written by the crawlers.
+    """
+    blocks = []
+    current = []
+    for line in diff_content.splitlines(keepends=True):
+        if line.startswith("File: ") and current:
+            blocks.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        blocks.append("".join(current))
+    return blocks
+
+def _split_lines(text: str, max_tokens: int) -> List[str]:
+    # Last resort for a single hunk that is larger than the budget
+    pieces = []
+    current = []
+    current_tokens = 0
+    for line in text.splitlines(keepends=True):
+        line_tokens = count_tokens(line)
+        if current and current_tokens + line_tokens > max_tokens:
+            pieces.append("".join(current))
+            current = []
+            current_tokens = 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+def split_hunks(file_block: str, max_tokens: int) -> List[str]:
+    """
+    Split one file block on its "@@" hunk headers. Every piece keeps the
+    "File:" header so it can be reviewed on its own.
+    """
+    lines = file_block.splitlines(keepends=True)
+    body_start = 0
+    while body_start < len(lines) and (lines[body_start].startswith("File: ") or lines[body_start].strip() in SECTION_HEADERS):
+        body_start += 1
+    header_text = "".join(lines[:body_start])
+    body_budget = max(1, max_tokens - count_tokens(header_text))
+
+    hunks = []
+    current = []
+    for line in lines[body_start:]:
+        if line.startswith("@@") and current:
+            hunks.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        hunks.append("".join(current))
+
+    pieces = []
+    for hunk in hunks:
+        if count_tokens(hunk) > body_budget:
+            pieces.extend(_split_lines(hunk, body_budget))
+        else:
+            pieces.append(hunk)
+
+    # Pack consecutive hunks of the same file back together while they fit
+    packed = []
+    current = ""
+    for piece in pieces:
+        if current and count_tokens(current) + count_tokens(piece) > body_budget:
+            packed.append(header_text + current)
+            current = ""
+        current += piece
+    if current or not packed:
+        packed.append(header_text + current)
+    return packed
+
+def shard_diff(diff_content: str, max_tokens: int) -> List[str]:
+    """
+    Split a diff into shards of at most max_tokens tokens: whole files first,
+    then hunks for files that do not fit on their own.
+    """
+    shards = []
+    current = []
+    current_tokens = 0
+    for block in split_files(diff_content):
+        block_tokens = count_tokens(block)
+        pieces = [block] if block_tokens <= max_tokens else split_hunks(block, max_tokens)
+        for piece in pieces:
+            piece_tokens = count_tokens(piece) if len(pieces) > 1 else block_tokens
+            if current and current_tokens + piece_tokens > max_tokens:
+                shards.append("".join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        shards.append("".join(current))
+    return shards
@@ -0,0 +1,456 @@
+import re
+import json
+import time
+import base64
+import hashlib
+import random
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Local stand-ins for the GitLab REST API and the Azure OpenAI chat-completions
+# API, used by benchmark.py. Both inject a configurable latency and answer a
+# share of the requests with 429 Too Many Requests.
+
+BENCH_PROJECT_PATH = "bench/project"
+BENCH_PROJECT_ID = 1
+DEFAULT_PER_PAGE = 20
+# Paths below this prefix redirect to the same path without it
+REDIRECT_PREFIX = "/redirect"
+# Prompt caching as Azure OpenAI does it: prefixes of at least 1024 tokens, in 128-token steps
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_BLOCK_TOKENS = 128
+
+def make_merge_request(iid: int, files: int, hunks: int, threads: int, hunk_lines: int = 6, seed: int = 0,
+                       noise: bool = True) -> dict:
+    """
+    Generate a merge request with `files` changed files of `hunks` hunks each
+    and `threads` DiffNote discussions spread over the files (every fourth
+    one resolved). With noise, a lockfile and a minified bundle that the diff
+    filter drops are changed as well. Returns the data served by FakeGitLab.
+    """
+    rng = random.Random(seed * 1000 + iid)
+    head_sha = f"{iid:08x}".ljust(40, "a")
+    base_sha = "b" * 40
+    # Room for every hunk plus unchanged lines between them
+    file_lines = hunks * (hunk_lines + 10) + 10
+
+    contents = {}
+    diffs = []
+    for file_index in range(files):
+        path = f"src/module_{file_index:03d}.py"
+        lines = [f"value_{file_index}_{n} = compute({n}, {rng.randint(0, 999)})" for n in range(1, file_lines + 1)]
+        contents[path] = "\n".join(lines) + "\n"
+
+        diff = []
+        for hunk_index in range(hunks):
+            start = hunk_index * (hunk_lines + 10) + 5
+            diff.append(f"@@ -{start},{hunk_lines} +{start},{hunk_lines} @@")
+            for n in range(start, start + hunk_lines):
+                if n % 3 == 0:
+                    diff.append(f"-value_{file_index}_{n} = old_compute({n})")
+                    diff.append(f"+{lines[n - 1]}")
+                else:
+                    diff.append(f" {lines[n - 1]}")
+        diffs.append({"old_path": path, "new_path": path, "new_file": False, "renamed_file": False,
+                      "deleted_file": False, "diff": "\n".join(diff) + "\n"})
+
+    if noise:
+        lock_lines = [f'+    "node_modules/pkg-{n}": {{"version": "1.{n}.0", "integrity": "sha512-{n:064x}"}},'
+                      for n in range(files * hunks * 20)]
+        bundle = "+" + ";".join(f"function f{n}(a){{return a*{n}}}" for n in range(files * hunks * 20))
+        for path, lines in (("package-lock.json", lock_lines), ("dist/app.min.js", [bundle])):
+            diffs.append({"old_path": path, "new_path": path, "new_file": False, "renamed_file": False,
+                          "deleted_file": False, "diff": f"@@ -1,0 +1,{len(lines)} @@\n" + "\n".join(lines) + "\n"})
+
+    discussions = []
+    for thread_index in range(threads):
+        path = f"src/module_{thread_index % max(1, files):03d}.py"
+        start = 5 + (thread_index % max(1, hunks)) * (hunk_lines + 10)
+        resolved = thread_index % 4 == 3
+        notes = []
+        for note_index in range(2):
+            notes.append({
+                "id": thread_index * 10 + note_index,
+                "type": "DiffNote",
+                "body": f"Please check the handling of value_{thread_index} (note {note_index + 1}).",
+                "author": {"name": f"reviewer{note_index}"},
+                "created_at": "2024-01-01T00:00:00.000Z",
+                "updated_at": "2024-01-01T00:00:00.000Z",
+                "resolvable": True,
+                "resolved": resolved,
+                "position": {
+                    "new_path": path,
+                    "line_range": {"start": {"new_line": start}, "end": {"new_line": start + 2}},
+                },
+            })
+        discussions.append({"id": f"{iid:04x}{thread_index:036x}", "individual_note": False, "notes": notes})
+
+    return {
+        "iid": iid,
+        "head_sha": head_sha,
+        "base_sha": base_sha,
+        "contents": contents,
+        "diffs": diffs,
+        "discussions": discussions,
+    }
+
+def _common_prefix_length(a: str, b: str) -> int:
+    # Binary search on slice comparisons; much faster than a per-character loop on long prompts
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class FakeServer:
+    """
+    A ThreadingHTTPServer on 127.0.0.1 running in a daemon thread.
+    Each request waits `latency` seconds (+/- `jitter` of it); a `rate_limit`
+    share of them is answered with 429 and a Retry-After of `retry_after` seconds.
+    """
+
+    handler_class = None
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0,
+                 retry_after: float = 1.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.requests = 0
+            self.rate_limited = 0
+
+    def admit(self, latency_scale: float = 1.0) -> bool:
+        """
+        Count one request and decide whether it gets a 429.
+        latency_scale shortens (or stretches) the wait of this request.
+        """
+        with self._lock:
+            self.requests += 1
+            limited = self.random.random() < self.rate_limit
+            if limited:
+                self.rate_limited += 1
+            delay = latency_scale * self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+        if delay > 0:
+            time.sleep(delay)
+        return not limited
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real services; without TCP_NODELAY the separate
+    # header and body writes wait for a delayed ACK on every response
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the request (a cancelled or hedged call)
+            self.close_connection = True
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def send_json(self, obj, status: int = 200, headers: dict = None) -> None:
+        body = json.dumps(obj).encode("utf-8")
+        headers = dict(headers or {})
+        if status == 200 and self.command == "GET":
+            # Weak ETag like GitLab's Rack::ETag; a matching If-None-Match gets an empty 304
+            headers["ETag"] = 'W/"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_rate_limited(self) -> None:
+        retry_after = self.fake.retry_after
+        self.send_json({"message": "429 Too Many Requests"}, status=429, headers={
+            # python-gitlab reads whole seconds, the openai client milliseconds
+            "Retry-After": str(int(retry_after + 0.999)),
+            "retry-after-ms": str(int(retry_after * 1000)),
+        })
+
+class _GitLabHandler(_Handler):
+
+    def send_page(self, items: list, query: dict) -> None:
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", [str(DEFAULT_PER_PAGE)])[0])
+        start = (page - 1) * per_page
+        headers = {"X-Page": str(page), "X-Per-Page": str(per_page), "X-Total": str(len(items))}
+        if start + per_page < len(items):
+            next_query = {key: values[0] for key, values in query.items()}
+            next_query.update(page=str(page + 1), per_page=str(per_page))
+            next_url = f"{self.fake.url}{urlparse(self.path).path}?" + "&".join(f"{k}={v}" for k, v in next_query.items())
+            headers["X-Next-Page"] = str(page + 1)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        self.send_json(items[start:start + per_page], headers=headers)
+
+    def do_GET(self):
+        if not self.fake.admit():
+            return self.send_rate_limited()
+        if self.path.startswith(REDIRECT_PREFIX + "/"):
+            # An old URL of the instance, e.g. http:// moved to https://
+            self.send_response(302)
+            self.send_header("Location", self.path[len(REDIRECT_PREFIX):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = url.path[len("/api/v4"):] if url.path.startswith("/api/v4") else url.path
+        project = f"/projects/{BENCH_PROJECT_ID}"
+
+        if re.fullmatch(r"/projects/[^/]+", path):
+            return self.send_json({"id": BENCH_PROJECT_ID, "path_with_namespace": BENCH_PROJECT_PATH})
+
+        match = re.fullmatch(re.escape(project) + r"/merge_requests/(\d+)(/.*)?", path)
+        if match:
+            mr = self.fake.merge_requests.get(int(match.group(1)))
+            if mr is None:
+                return self.send_json({"message": "404 Not found"}, status=404)
+            return self.handle_merge_request(mr, match.group(2) or "", query)
+
+        match = re.fullmatch(re.escape(project) + r"/repository/files/(.+)", path)
+        if match:
+            file_path = unquote(match.group(1))
+            ref = query.get("ref", [""])[0]
+            for mr in self.fake.merge_requests.values():
+                if mr["head_sha"] == ref and file_path in mr["contents"]:
+                    content = mr["contents"][file_path].encode("utf-8")
+                    return self.send_json({"file_path": file_path, "ref": ref, "encoding": "base64",
+                                           "content": base64.b64encode(content).decode("ascii")})
+            return self.send_json({"message": "404 File Not Found"}, status=404)
+
+        if path == f"{project}/repository/merge_base":
+            refs = query.get("refs[]", [])
+            for mr in self.fake.merge_requests.values():
+                if refs and mr["head_sha"] == refs[-1]:
+                    # The first ref is its own merge base with the head when the head descends from it
+                    in_history = refs[0] == mr["head_sha"] or refs[0] in mr.get("earlier_heads", [])
+                    return self.send_json({"id": refs[0] if in_history else mr["base_sha"]})
+            return self.send_json({"message": "404 Not found"}, status=404)
+
+        if path == f"{project}/repository/compare":
+            head = query.get("to", [""])[0]
+            for mr in self.fake.merge_requests.values():
+                if mr["head_sha"] == head:
+                    return self.send_json({"commits": [], "diffs": mr["diffs"]})
+            return self.send_json({"message": "404 Not found"}, status=404)
+
+        self.send_json({"message": "404 Not found"}, status=404)
+
+    def handle_merge_request(self, mr: dict, rest: str, query: dict):
+        version = {"id": mr["iid"], "head_commit_sha": mr["head_sha"], "base_commit_sha": mr["base_sha"],
+                   "start_commit_sha": mr["base_sha"], "state": "collected"}
+        if rest == "":
+            return self.send_json({"id": 1000 + mr["iid"], "iid": mr["iid"], "project_id": BENCH_PROJECT_ID,
+                                   "title": f"Benchmark MR {mr['iid']}", "sha": mr["head_sha"],
+                                   "diff_refs": {"base_sha": mr["base_sha"], "head_sha": mr["head_sha"],
+                                                 "start_sha": mr["base_sha"]}})
+        if rest == "/discussions":
+            return self.send_page(mr["discussions"], query)
+        match = re.fullmatch(r"/discussions/([0-9a-f]+)", rest)
+        if match:
+            for discussion in mr["discussions"]:
+                if discussion["id"] == match.group(1):
+                    return self.send_json(discussion)
+        if rest == "/diffs":
+            return self.send_page(mr["diffs"], query)
+        if rest == "/versions":
+            return self.send_page([version], query)
+        if rest == f"/versions/{mr['iid']}":
+            return self.send_json(dict(version, diffs=mr["diffs"]))
+        self.send_json({"message": "404 Not found"}, status=404)
+
+class FakeGitLab(FakeServer):
+    """
+    Serves the project, merge request, discussions, diff versions, compare
+    and repository files endpoints for generated merge requests
+    (see make_merge_request), under the project BENCH_PROJECT_PATH.
+    Every GET below `redirect_url` is answered with a 302 to the same path
+    without the REDIRECT_PREFIX.
+    """
+
+    handler_class = _GitLabHandler
+
+    def __init__(self, merge_requests: list = (), **kwargs):
+        super().__init__(**kwargs)
+        self.merge_requests = {mr["iid"]: mr for mr in merge_requests}
+
+    @property
+    def redirect_url(self) -> str:
+        return self.url + REDIRECT_PREFIX
+
+    def mr_url(self, iid: int) -> str:
+        return f"{self.url}/{BENCH_PROJECT_PATH}/-/merge_requests/{iid}"
+
+    def push(self, iid: int, head_sha: str, force: bool = False) -> None:
+        """
+        Move a merge request to a new head commit, as a push would. The old
+        head stays in its history unless `force` (a rebase or force-push).
+        """
+        mr = self.merge_requests[iid]
+        earlier = [] if force else mr.get("earlier_heads", []) + [mr["head_sha"]]
+        mr["earlier_heads"] = earlier
+        mr["head_sha"] = head_sha
+
+    def merge_request_hook(self, iid: int, action: str = "update") -> dict:
+        """
+        The "Merge Request Hook" payload GitLab sends for a merge request
+        at its current head (see review_service).
+        """
+        mr = self.merge_requests[iid]
+        return {
+            "object_kind": "merge_request",
+            "event_type": "merge_request",
+            "project": {"id": BENCH_PROJECT_ID, "path_with_namespace": BENCH_PROJECT_PATH},
+            "object_attributes": {
+                "iid": iid,
+                "url": self.mr_url(iid),
+                "action": action,
+                "state": "merged" if action == "merge" else "closed" if action == "close" else "opened",
+                "last_commit": {"id": mr["head_sha"]},
+            },
+        }
+
+class _ChatHandler(_Handler):
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.split("?", 1)[0].endswith("/chat/completions"):
+            return self.send_json({"error": {"message": "Not found"}}, status=404)
+        model = request.get("model") or "gpt-4o"
+        if not self.fake.admit(1 / self.fake.fast_speedup if model == self.fake.fast_model else 1.0):
+            return self.send_rate_limited()
+
+        answer = self.fake.answer(request)
+        prompt = "".join(f"{m.get('role')}\n{m.get('content') or ''}\n" for m in request.get("messages", []))
+        prompt_tokens = len(prompt) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": max(1, len(answer) // 4),
+                 "total_tokens": prompt_tokens + max(1, len(answer) // 4),
+                 "prompt_tokens_details": {"cached_tokens": self.fake.cached_tokens(prompt)}}
+        if request.get("stream"):
+            include_usage = (request.get("stream_options") or {}).get("include_usage")
+            return self.stream(answer, model, usage if include_usage else None)
+        self.send_json({
+            "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": answer}}],
+            "usage": usage,
+        })
+
+    def stream(self, answer: str, model: str, usage: dict = None) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = answer.split(" ")
+        for i, word in enumerate(words):
+            text = word if i == len(words) - 1 else word + " "
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            if self.fake.chunk_delay:
+                time.sleep(self.fake.chunk_delay)
+        if usage is not None:
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [], "usage": usage}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text: str) -> None:
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+class FakeChatCompletions(FakeServer):
+    """
+    Answers POST .../chat/completions like Azure OpenAI, streamed or not.
+    JSON-mode requests (batched coding rules) get a "No issues found." report
+    for every "<id>: <rule>" line of the prompt; coding-rule screening
+    requests get VIOLATION for a `flag_rate` share of the prompts (chosen by
+    prompt hash, so repeated runs agree) and CLEAN otherwise; other requests
+    get `reply`. Requests to `fast_model` wait `fast_speedup` times less.
+    Streamed answers are sent word by word, `chunk_delay` seconds apart.
+    Usage reports cached_tokens for the prompt prefix shared with a recent request.
+    """
+
+    handler_class = _ChatHandler
+
+    def __init__(self, reply: str = None, chunk_delay: float = 0.0, flag_rate: float = 0.2,
+                 fast_model: str = "gpt-4o-mini", fast_speedup: float = 4.0, **kwargs):
+        super().__init__(**kwargs)
+        self.flag_rate = flag_rate
+        self.fast_model = fast_model
+        self.fast_speedup = fast_speedup
+        self.reply = reply or ("- [SHOULD] The new value is computed twice; reuse the result of compute().\n"
+                               "- [INFO] The unresolved comment is addressed by this change.")
+        self.chunk_delay = chunk_delay
+        self._recent_prompts = collections.deque(maxlen=64)
+
+    def cached_tokens(self, prompt: str) -> int:
+        with self._lock:
+            shared = max((_common_prefix_length(prompt, seen) for seen in self._recent_prompts), default=0)
+            self._recent_prompts.append(prompt)
+        tokens = shared // 4
+        if tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0
+        return PROMPT_CACHE_MIN_TOKENS + (tokens - PROMPT_CACHE_MIN_TOKENS) // PROMPT_CACHE_BLOCK_TOKENS * PROMPT_CACHE_BLOCK_TOKENS
+
+    def answer(self, request: dict) -> str:
+        prompt = "\n".join(str(m.get("content") or "") for m in request.get("messages", []))
+        if "CLEAN, VIOLATION or UNSURE" in prompt:
+            share = int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+            return "VIOLATION" if share < self.flag_rate else "CLEAN"
+        response_format = request.get("response_format") or {}
+        if response_format.get("type") != "json_object":
+            return self.reply
+        rule_ids = sorted({int(n) for n in re.findall(r"^(\d+): ", prompt, re.MULTILINE)})
+        return json.dumps({"results": [{"id": rule_id, "report": "No issues found."} for rule_id in rule_ids]})
@@ -0,0 +1,79 @@
+import os
+import re
+import hashlib
+import threading
+import collections
+
+# On-disk store for file contents, inside WORKSPACE_PATH
+CACHE_DIR_NAME = "file_cache"
+
+# Content at a full commit SHA never changes, so only those refs go to disk
+COMMIT_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+# Recently used files kept in memory, least recently used first; their
+# total content size stays under MEMORY_CACHE_MAX_BYTES so a long-running
+# batch or review service does not hold every file it ever read
+MEMORY_CACHE_MAX_BYTES = 32 * 1024 * 1024
+memory_cache = collections.OrderedDict()
+memory_bytes = 0
+memory_lock = threading.Lock()
+
+def _disk_path(project_id, ref: str, path: str) -> str:
+    key = hashlib.sha256(f"{project_id}\0{ref}\0{path}".encode("utf-8")).hexdigest()
+    cache_dir = os.path.join(os.getenv("WORKSPACE_PATH") or ".", CACHE_DIR_NAME, key[:2])
+    return os.path.join(cache_dir, key)
+
+def _read_disk(project_id, ref: str, path: str):
+    if not COMMIT_SHA_RE.match(ref or ""):
+        return None
+    try:
+        with open(_disk_path(project_id, ref, path), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _write_disk(project_id, ref: str, path: str, content: bytes) -> None:
+    if not COMMIT_SHA_RE.match(ref or ""):
+        return
+    disk_path = _disk_path(project_id, ref, path)
+    try:
+        os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+        # Write to a temp file first so a concurrent reader never sees a partial file
+        tmp_path = f"{disk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, disk_path)
+    except OSError:
+        pass
+
+def get_file_lines(project, ref: str, path: str) -> list:
+    """
+    Return the lines of `path` at `ref` in a GitLab project.
+    Recently used files are kept in memory (up to MEMORY_CACHE_MAX_BYTES),
+    and files at a commit SHA are also stored under WORKSPACE_PATH/file_cache
+    for later runs.
+    Raises gitlab.exceptions.GitlabError when the file cannot be fetched.
+    """
+    global memory_bytes
+    key = (project.id, ref, path)
+    with memory_lock:
+        entry = memory_cache.get(key)
+        if entry is not None:
+            memory_cache.move_to_end(key)
+            return entry[0]
+
+    content = _read_disk(project.id, ref, path)
+    if content is None:
+        content = project.files.get(file_path=path, ref=ref).decode()
+        _write_disk(project.id, ref, path, content)
+
+    lines = content.decode("utf-8", errors="replace").splitlines()
+    size = len(content)
+    with memory_lock:
+        if key not in memory_cache and size <= MEMORY_CACHE_MAX_BYTES:
+            memory_cache[key] = (lines, size)
+            memory_bytes += size
+            while memory_bytes > MEMORY_CACHE_MAX_BYTES:
+                _, (_, evicted) = memory_cache.popitem(last=False)
+                memory_bytes -= evicted
+    return lines
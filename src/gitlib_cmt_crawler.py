@@ -5,6 +5,10 @@ import argparse
 import re
 from dotenv import load_dotenv
 
+from gitlib_utils import create_gitlab_client, load_discussions
+from file_cache import get_file_lines
+import metrics
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -52,7 +56,8 @@ if not match:
 project_path, merge_request_iid = match.groups()
 
 # Authenticate with GitLab
-gl = gitlab.Gitlab(gitlab_url, private_token=gitlab_private_token)
+gl, request_counter = create_gitlab_client(gitlab_url, gitlab_private_token)
+review_dir = None
 
 try:
     # Get the project
@@ -61,8 +66,8 @@ try:
     # Get the merge request
     mr = project.mergerequests.get(merge_request_iid)
 
-    # Get all discussion threads for the merge request
-    discussions = mr.discussions.list(all=True)
+    # Get all discussion threads for the merge request (notes come with the list)
+    discussions = load_discussions(mr)
 
     if discussions:
         # Create a directory with the format review_<timestamp>
@@ -84,9 +89,7 @@ try:
             f.write(f"Created at: {mr.created_at}\n")
             f.write("=" * 80 + "\n\n")
             
-            for d in discussions:
-                discussion = mr.discussions.get(d.id)
-                
+            for discussion in discussions:
                 # Determine if the discussion is resolved
                 is_resolved = False
                 is_resolvable = False
@@ -133,7 +136,7 @@ try:
                             f.write(f"Lines: {start_line}-{end_line}\n")
                             
                             try:
-                                file_content = project.files.get(file_path=file_path, ref=mr.sha).decode().splitlines()
+                                file_content = get_file_lines(project, mr.sha, file_path)
                                 f.write("Code:\n")
                                 for i in range(start_line - 1, end_line):
                                     if i < len(file_content):
@@ -182,3 +185,7 @@ except gitlab.exceptions.GitlabError as e:
     print(f"An error occurred: {e}")
 except Exception as e:
     print(f"An unexpected error occurred: {e}")
+
+request_counter.print_summary()
+metrics.write_trace(review_dir)
+metrics.print_summary()
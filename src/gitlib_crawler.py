@@ -1,10 +1,18 @@
 import os
+import io
 import gitlab
-import datetime
 import argparse
-import re
+import contextlib
 from dotenv import load_dotenv
 
+from gitlib_utils import (create_gitlab_client, parse_mr_url, make_output_dir, load_discussions, fetch_mr_diffs,
+                          write_diff_file)
+from file_cache import get_file_lines
+from diff_model import format_file_diffs
+from local_git import GitRepo, fetch_local_diffs
+from diff_filter import get_diff_filter, report_skipped
+import metrics
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -13,160 +21,164 @@ gitlab_private_token = os.getenv("GITLAB_PRIVATE_TOKEN")
 workspace_path = os.getenv("WORKSPACE_PATH")
 gitlab_url = os.getenv("GITLAB_URL")
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description='GitLab MR Unresolved Threads Crawler')
-parser.add_argument('-c', '--comments-url', dest='mr_url', type=str, help='The URL of the merge request for comments')
-parser.add_argument('-d', '--diff-url', dest='diff_url', type=str, help='The URL of the merge request for diffs')
-args = parser.parse_args()
-mr_url = args.mr_url
-diff_url = args.diff_url
-
-if not mr_url and not diff_url:
-    print("Error: At least one URL (--comments-url or --diff-url) must be provided.")
-    parser.print_help()
-    exit(1)
-
-# --- Comment Processing ---
-if mr_url:
-    # Extract project path and MR IID from comment URL
-    url_prefix = f"{gitlab_url}/"
-    if not mr_url.startswith(url_prefix):
-        print(f"MR URL for comments must start with {url_prefix}")
+def crawl_comments(gl, mr_url: str):
+    """
+    Fetch the unresolved threads of a merge request and format them the way
+    comments.txt is written. Returns None when there are no unresolved threads.
+    """
+    project_path, merge_request_iid = parse_mr_url(mr_url, gitlab_url)
+
+    # Get the project
+    project = gl.projects.get(project_path)
+
+    # Get the merge request
+    mr = project.mergerequests.get(merge_request_iid)
+
+    # Get all discussion threads for the merge request (notes come with the list)
+    discussions = load_discussions(mr)
+
+    # Filter for unresolved threads
+    unresolved_threads = []
+    for discussion in discussions:
+        is_unresolved = False
+        if discussion.attributes.get('individual_note') is False:
+            for note in discussion.attributes['notes']:
+                if note.get('resolvable') and not note.get('resolved'):
+                    is_unresolved = True
+                    break
+        if is_unresolved:
+            unresolved_threads.append(discussion)
+
+    if not unresolved_threads:
+        return None
+
+    f = io.StringIO()
+    for discussion in unresolved_threads:
+        # Marks where each thread starts, see thread_index.parse_comment_threads
+        f.write(f"Thread: {discussion.id}\n")
+        # Find the first note in the discussion to get context if it's a DiffNote
+        first_note = discussion.attributes['notes'][0]
+        if first_note.get('type') == 'DiffNote':
+            position = first_note.get('position')
+            if position:
+                file_path = position.get('new_path')
+                line_range = position.get('line_range')
+
+                f.write(f"File: {file_path}\n")
+                if line_range:
+                    start_line = line_range['start']['new_line']
+                    end_line = line_range['end']['new_line']
+                    f.write(f"Lines: {start_line}-{end_line}\n")
+
+                    try:
+                        file_content = get_file_lines(project, mr.sha, file_path)
+                        f.write("Code:\n")
+                        for i in range(start_line - 1, end_line):
+                            f.write(f"  {file_content[i]}\n")
+                    except gitlab.exceptions.GitlabError as e:
+                        f.write("Could not retrieve code snippet.\n")
+            f.write("-" * 20 + "\n")
+
+        for note in discussion.attributes['notes']:
+            # Write each note's body to the file
+            f.write(f"Author: {note['author']['name']}\n")
+            f.write(f"Comment: {note['body']}\n")
+            f.write(f"Created at: {note['created_at']}\n")
+            f.write("-" * 20 + "\n")
+    return f.getvalue()
+
+def format_diff(file_diffs: list) -> str:
+    """
+    Format diff_model.FileDiff objects the way diff.txt is written: every
+    hunk with its header and numbered lines.
+    """
+    return format_file_diffs(file_diffs, "Changes:", "-" * 20)
+
+def save_text(review_dir: str, file_name: str, content: str) -> str:
+    file_path = os.path.join(review_dir, file_name)
+    with open(file_path, "w") as f:
+        f.write(content)
+    return file_path
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description='GitLab MR Unresolved Threads Crawler')
+    parser.add_argument('-c', '--comments-url', dest='mr_url', type=str, help='The URL of the merge request for comments')
+    parser.add_argument('-d', '--diff-url', dest='diff_url', type=str, help='The URL of the merge request for diffs')
+    parser.add_argument('--repo', type=str, help='Compute the diff with git in this local clone instead of the GitLab API')
+    parser.add_argument('--base', type=str, help='Target branch or commit the changes are compared with (with --repo)')
+    parser.add_argument('--head', type=str, default='HEAD', help='Branch or commit with the changes (with --repo, default: HEAD)')
+    parser.add_argument('--no-filter', action='store_true', help='Keep lockfiles, generated, vendored and whitespace-only changes in diff.txt')
+    args = parser.parse_args()
+    mr_url = args.mr_url
+    diff_url = args.diff_url
+
+    if not mr_url and not diff_url and not args.repo:
+        print("Error: At least one URL (--comments-url or --diff-url) or --repo must be provided.")
+        parser.print_help()
         exit(1)
-
-    path_and_iid = mr_url[len(url_prefix):]
-    match = re.match(r'(.+)/-/merge_requests/(\d+)', path_and_iid)
-    if not match:
-        print("Invalid Merge Request URL format for comments.")
+    if args.repo and not args.base:
+        parser.error("--repo requires --base")
+
+    # Authenticate with GitLab
+    gl, request_counter = create_gitlab_client(gitlab_url, gitlab_private_token) if mr_url or not args.repo else (None, None)
+    review_dir = None
+
+    try:
+        # --- Comment Processing ---
+        if mr_url:
+            comments = crawl_comments(gl, mr_url)
+            if comments is not None:
+                # Create a directory with the format review_<timestamp>
+                review_dir = make_output_dir(workspace_path)
+                comments_file_path = save_text(review_dir, "comments.txt", comments)
+                print(f"Successfully saved unresolved threads to {comments_file_path}")
+            else:
+                print("No unresolved threads found.")
+
+        # --- Diff Processing ---
+        if diff_url or args.repo:
+            try:
+                # Diffs are streamed into diff.txt a page at a time, however large the MR
+                with contextlib.ExitStack() as stack:
+                    diff_filter = get_diff_filter(not args.no_filter)
+                    if args.repo:
+                        repo = stack.enter_context(GitRepo(args.repo))
+                        mr_diffs = fetch_local_diffs(repo, args.base, args.head, diff_filter=diff_filter, stream=True)
+                    else:
+                        mr_diffs = fetch_mr_diffs(gl, diff_url, gitlab_url, diff_filter=diff_filter, stream=True)
+                    if mr_diffs is not None:
+                        # Use the same review_dir as for comments
+                        if review_dir is None:
+                            review_dir = make_output_dir(workspace_path)
+                        diff_file_path = write_diff_file(mr_diffs, review_dir, format_diff)
+                        print(f"Successfully saved diffs to {diff_file_path}")
+                        report_skipped(mr_diffs["skipped"])
+                    else:
+                        print("No diffs found for the provided URL.")
+
+            except ValueError as e:
+                print(e)
+                exit(1)
+            except gitlab.exceptions.GitlabError as e:
+                print(f"An error occurred while processing diffs: {e}")
+            except Exception as e:
+                print(f"An unexpected error occurred while processing diffs: {e}")
+
+    except ValueError as e:
+        print(e)
         exit(1)
 
-    project_path, merge_request_iid = match.groups()
-
-# Authenticate with GitLab
-gl = gitlab.Gitlab(gitlab_url, private_token=gitlab_private_token)
-
-try:
-    if mr_url:
-        # Get the project
-        project = gl.projects.get(project_path)
-
-        # Get the merge request
-        mr = project.mergerequests.get(merge_request_iid)
-
-        # Get all discussion threads for the merge request
-        discussions = mr.discussions.list(all=True)
-
-        # Filter for unresolved threads
-        unresolved_threads = []
-        for d in discussions:
-            discussion = mr.discussions.get(d.id)
-            is_unresolved = False
-            if discussion.attributes.get('individual_note') is False:
-                for note in discussion.attributes['notes']:
-                    if note.get('resolvable') and not note.get('resolved'):
-                        is_unresolved = True
-                        break
-            if is_unresolved:
-                unresolved_threads.append(discussion)
-
-        if unresolved_threads:
-            # Create a directory with the format review_<timestamp>
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            review_dir = os.path.join(workspace_path, f"review_{timestamp}")
-            os.makedirs(review_dir, exist_ok=True)
-
-            # Save the unresolved threads to comments.txt
-            comments_file_path = os.path.join(review_dir, "comments.txt")
-            with open(comments_file_path, "w") as f:
-                for discussion in unresolved_threads:
-                    # Find the first note in the discussion to get context if it's a DiffNote
-                    first_note = discussion.attributes['notes'][0]
-                    if first_note.get('type') == 'DiffNote':
-                        position = first_note.get('position')
-                        if position:
-                            file_path = position.get('new_path')
-                            line_range = position.get('line_range')
-                            
-                            f.write(f"File: {file_path}\n")
-                            if line_range:
-                                start_line = line_range['start']['new_line']
-                                end_line = line_range['end']['new_line']
-                                f.write(f"Lines: {start_line}-{end_line}\n")
-                                
-                                try:
-                                    file_content = project.files.get(file_path=file_path, ref=mr.sha).decode().splitlines()
-                                    f.write("Code:\n")
-                                    for i in range(start_line - 1, end_line):
-                                        f.write(f"  {file_content[i]}\n")
-                                except gitlab.exceptions.GitlabError as e:
-                                    f.write("Could not retrieve code snippet.\n")
-                        f.write("-" * 20 + "\n")
-
-                    for note in discussion.attributes['notes']:
-                        # Write each note's body to the file
-                        f.write(f"Author: {note['author']['name']}\n")
-                        f.write(f"Comment: {note['body']}\n")
-                        f.write(f"Created at: {note['created_at']}\n")
-                        f.write("-" * 20 + "\n")
-            
-            print(f"Successfully saved unresolved threads to {comments_file_path}")
-        else:
-            print("No unresolved threads found.")
-    else:
-        # This block is to ensure review_dir is created when only diff_url is provided
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        review_dir = os.path.join(workspace_path, f"review_{timestamp}")
-        os.makedirs(review_dir, exist_ok=True)
-
-
-    # --- Diff Processing ---
-    if diff_url:
-        # Extract project path and MR IID from diff URL
-        diff_path_and_iid = diff_url[len(url_prefix):]
-        diff_match = re.match(r'(.+)/-/merge_requests/(\d+)/diffs', diff_path_and_iid)
-        if not diff_match:
-            print("Invalid Merge Request URL format for diffs.")
-            exit(1)
-
-        diff_project_path, diff_merge_request_iid = diff_match.groups()
-
-        try:
-            # Get the project and merge request for the diff
-            diff_project = gl.projects.get(diff_project_path)
-            diff_mr = diff_project.mergerequests.get(diff_merge_request_iid)
-            
-            # Get the diffs
-            diff_list = diff_mr.diffs.list()
-            
-            if diff_list:
-                # Get the latest diff object to access its 'diffs' attribute
-                latest_diff = diff_mr.diffs.get(diff_list[0].id)
-
-                # Use the same review_dir as for comments
-                if not 'review_dir' in locals():
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    review_dir = os.path.join(workspace_path, f"review_{timestamp}")
-                    os.makedirs(review_dir, exist_ok=True)
-
-                diff_file_path = os.path.join(review_dir, "diff.txt")
-                with open(diff_file_path, "w") as f:
-                    for diff in latest_diff.diffs:
-                        f.write(f"File: {diff['new_path']}\n")
-                        f.write("Changes:\n")
-                        f.write(diff['diff'])
-                        f.write("\n" + "-" * 20 + "\n")
-                
-                print(f"Successfully saved diffs to {diff_file_path}")
-            else:
-                print("No diffs found for the provided URL.")
+    except gitlab.exceptions.GitlabError as e:
+        print(f"An error occurred: {e}")
 
-        except gitlab.exceptions.GitlabError as e:
-            print(f"An error occurred while processing diffs: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred while processing diffs: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
 
-except gitlab.exceptions.GitlabError as e:
-    print(f"An error occurred: {e}")
+    if request_counter is not None:
+        request_counter.print_summary()
+    metrics.write_trace(review_dir)
+    metrics.print_summary()
 
-except Exception as e:
-    print(f"An unexpected error occurred: {e}")
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 import os
-import re
 import argparse
-import datetime
+import contextlib
 import gitlab
 from dotenv import load_dotenv
 
+from gitlib_utils import create_gitlab_client, make_output_dir, fetch_mr_diffs, write_diff_file
+from diff_model import format_file_diffs
+from local_git import GitRepo, fetch_local_diffs
+from diff_filter import get_diff_filter, report_skipped
+import metrics
+
 load_dotenv()
 
 gitlab_private_token = os.getenv("GITLAB_PRIVATE_TOKEN")
@@ -12,65 +17,60 @@ workspace_path = os.getenv("WORKSPACE_PATH")
 gitlab_url = os.getenv("GITLAB_URL")
 
 
+def format_changed_code(file_diffs: list) -> str:
+    """
+    Format the changed hunks of diff_model.FileDiff objects, with their
+    line numbers and the context lines each hunk carries.
+    """
+    return format_file_diffs(file_diffs, "Changed lines:", "-" * 40)
+
+
 def main():
     parser = argparse.ArgumentParser(description='Fetch only changed code from GitLab MR diffs')
-    parser.add_argument('-d', '--diff-url', dest='diff_url', type=str, required=True, help='The URL of the merge request diffs')
+    parser.add_argument('-d', '--diff-url', dest='diff_url', type=str, help='The URL of the merge request diffs')
+    parser.add_argument('--repo', type=str, help='Compute the diff with git in this local clone instead of the GitLab API')
+    parser.add_argument('--base', type=str, help='Target branch or commit the changes are compared with (with --repo)')
+    parser.add_argument('--head', type=str, default='HEAD', help='Branch or commit with the changes (with --repo, default: HEAD)')
+    parser.add_argument('--no-filter', action='store_true', help='Keep lockfiles, generated, vendored and whitespace-only changes in diff.txt')
     args = parser.parse_args()
     diff_url = args.diff_url
+    if not diff_url and not (args.repo and args.base):
+        parser.error("either --diff-url or --repo with --base is required")
 
-    url_prefix = f"{gitlab_url}/" if gitlab_url else None
-    if not url_prefix or not diff_url.startswith(url_prefix):
-        print(f"Diff URL must start with {url_prefix}")
-        return
-
-    path_and_iid = diff_url[len(url_prefix):]
-    m = re.match(r'(.+)/-/merge_requests/(\d+)/diffs', path_and_iid)
-    if not m:
-        print("Invalid Merge Request URL format for diffs.")
-        return
-
-    project_path, merge_request_iid = m.groups()
-
-    gl = gitlab.Gitlab(gitlab_url, private_token=gitlab_private_token)
+    gl, request_counter = create_gitlab_client(gitlab_url, gitlab_private_token) if not args.repo else (None, None)
+    out_dir = None
 
     try:
-        project = gl.projects.get(project_path)
-        mr = project.mergerequests.get(merge_request_iid)
-
-        diff_list = mr.diffs.list()
-        if not diff_list:
-            print("No diffs found for the provided URL.")
-            return
-
-        latest_diff = mr.diffs.get(diff_list[0].id)
-
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        out_dir = os.path.join(workspace_path or '.', f"coding_rule_{timestamp}")
-        os.makedirs(out_dir, exist_ok=True)
-
-        diff_file_path = os.path.join(out_dir, "diff.txt")
-        with open(diff_file_path, "w") as out:
-            for diff in latest_diff.diffs:
-                new_path = diff.get('new_path') or diff.get('old_path') or '<unknown>'
-                out.write(f"File: {new_path}\n")
-                out.write("Changed lines:\n")
-                diff_text = diff.get('diff') or ''
-                for line in diff_text.splitlines():
-                    # Skip diff metadata lines
-                    if line.startswith('+++') or line.startswith('---') or line.startswith('@@'):
-                        continue
-                    # Collect added or removed code lines only
-                    if line.startswith('+') or line.startswith('-'):
-                        out.write(f"{line}\n")
-                out.write("\n" + "-" * 40 + "\n")
+        # Diffs are streamed into diff.txt a page at a time, however large the MR
+        with contextlib.ExitStack() as stack:
+            diff_filter = get_diff_filter(not args.no_filter)
+            if args.repo:
+                repo = stack.enter_context(GitRepo(args.repo))
+                mr_diffs = fetch_local_diffs(repo, args.base, args.head, diff_filter=diff_filter, stream=True)
+            else:
+                mr_diffs = fetch_mr_diffs(gl, diff_url, gitlab_url, diff_filter=diff_filter, stream=True)
+            if mr_diffs is None:
+                print("No diffs found for the provided URL.")
+                return
+
+            out_dir = make_output_dir(workspace_path, "coding_rule")
+            diff_file_path = write_diff_file(mr_diffs, out_dir, format_changed_code)
 
         print(f"Saved changed code to {diff_file_path}")
+        report_skipped(mr_diffs["skipped"])
 
+    except ValueError as e:
+        print(e)
     except gitlab.exceptions.GitlabError as e:
         print(f"GitLab API error: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
+    finally:
+        if request_counter is not None:
+            request_counter.print_summary()
+        metrics.write_trace(out_dir)
+        metrics.print_summary()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,295 @@
+import os
+import re
+import time
+import datetime
+import itertools
+import threading
+import contextvars
+from typing import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import gitlab
+
+import metrics
+from http_cache import create_session
+from file_cache import get_file_lines
+from diff_filter import MANIFEST_FILE_NAME, format_manifest
+from diff_model import GITLAB_CONTEXT_LINES, get_context_lines, parse_gitlab_diffs, with_context
+
+# Default size of the worker pool used for concurrent GitLab requests
+DEFAULT_MAX_WORKERS = 8
+# Files per page when diffs are streamed (GitLab's largest per_page), and per
+# chunk when they are written to diff.txt
+DIFF_PAGE_SIZE = 100
+
+class RequestCounter:
+    """
+    Counts the HTTP requests made through a gitlab.Gitlab session, how many
+    of them were answered 304 Not Modified, and the wall time since it was
+    attached.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.not_modified = 0
+        self.started_at = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, response, *args, **kwargs):
+        # requests response hook; may run on worker threads
+        with self._lock:
+            self.count += 1
+            if response.status_code == 304:
+                self.not_modified += 1
+        return response
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def print_summary(self, label: str = "GitLab") -> None:
+        cached = f" ({self.not_modified} not modified)" if self.not_modified else ""
+        print(f"{label}: {self.count} requests{cached} in {self.elapsed():.2f}s")
+
+def count_requests(gl) -> RequestCounter:
+    """
+    Attach a RequestCounter to the session of a gitlab.Gitlab client, and
+    record every request in the metrics trace.
+    """
+    counter = RequestCounter()
+    hooks = gl.session.hooks.setdefault("response", [])
+    hooks.append(counter)
+    hooks.append(metrics.gitlab_hook)
+    return counter
+
+def create_gitlab_client(gitlab_url: str, private_token: str, max_in_flight: int = None):
+    """
+    Create the gitlab.Gitlab client shared by every crawl of a run. Its
+    session revalidates cached GET responses with ETags (see http_cache) and
+    keeps one pooled connection per worker. With max_in_flight, no more than
+    that many GitLab requests run at once across all crawls using the client.
+    Returns (client, RequestCounter).
+    """
+    session = create_session(pool_size=max_in_flight or get_max_workers(), max_in_flight=max_in_flight)
+    gl = gitlab.Gitlab(gitlab_url, private_token=private_token, session=session)
+    return gl, count_requests(gl)
+
+def parse_mr_url(mr_url: str, gitlab_url: str, diffs: bool = False) -> tuple:
+    """
+    Extract (project_path, merge_request_iid) from a merge request URL.
+    With diffs=True the URL must point at the MR's /diffs page.
+    Raises ValueError with a printable message for URLs that do not match.
+    """
+    url_prefix = f"{gitlab_url}/"
+    if not gitlab_url or not mr_url.startswith(url_prefix):
+        raise ValueError(f"MR URL must start with {url_prefix}")
+    pattern = r'(.+)/-/merge_requests/(\d+)/diffs' if diffs else r'(.+)/-/merge_requests/(\d+)'
+    match = re.match(pattern, mr_url[len(url_prefix):])
+    if not match:
+        kind = "diffs" if diffs else "comments"
+        raise ValueError(f"Invalid Merge Request URL format for {kind}.")
+    return match.groups()
+
+def iter_mr_diffs(gl, project, mr, version_id) -> Iterator[dict]:
+    """
+    Yield the file diffs of the latest version of a merge request one page
+    at a time from /merge_requests/:iid/diffs, so only DIFF_PAGE_SIZE files
+    are held in memory. GitLab before 15.7 has no such endpoint; the whole
+    version `version_id` is downloaded instead.
+    """
+    try:
+        pages = gl.http_list(f"/projects/{project.id}/merge_requests/{mr.iid}/diffs", iterator=True,
+                             per_page=DIFF_PAGE_SIZE)
+    except gitlab.exceptions.GitlabHttpError as e:
+        if e.response_code != 404:
+            raise
+        pages = mr.diffs.get(version_id).diffs
+    yield from pages
+
+def is_ancestor(project, ancestor_sha: str, head_sha: str) -> bool:
+    """
+    Whether ancestor_sha is in the history of head_sha. After a rebase or
+    force-push the earlier head no longer is, and comparing with it would
+    pull in the target branch's commits.
+    """
+    merge_base = project.repository_merge_base([ancestor_sha, head_sha])
+    return (merge_base.get("id") or "").startswith(ancestor_sha)
+
+def fetch_mr_diffs(gl, diff_url: str, gitlab_url: str, since_sha: str = None, diff_filter=None, stream: bool = False):
+    """
+    Fetch the file diffs of the latest version of a merge request.
+    With since_sha (the head commit of an earlier reviewed version), only the
+    changes from that commit to the current head are returned; if it is not
+    an ancestor of the head any more (the branch was rebased or force-pushed)
+    or GitLab cannot compare them, the full diff is returned instead.
+    With a diff_filter.DiffFilter, ignored files and whitespace-only hunks
+    are dropped and listed in "skipped".
+    Returns None when the MR has no diffs, otherwise a dict with "project"
+    (the python-gitlab project), "project_path", "iid", "head_sha",
+    "since_sha" (None for a full diff),
+    "diffs" (GitLab diff dicts with new_path/old_path/diff) and "skipped"
+    ({"path", "reason"} dicts).
+    With stream=True, "diffs" is an iterator over the pages of iter_mr_diffs
+    (the changes since since_sha are still one list) and diff_filter runs as
+    it is consumed, filling "skipped" along the way; write it with
+    write_diff_file.
+    """
+    project_path, merge_request_iid = parse_mr_url(diff_url, gitlab_url, diffs=True)
+
+    project = gl.projects.get(project_path)
+    mr = project.mergerequests.get(merge_request_iid)
+
+    diff_list = mr.diffs.list()
+    if not diff_list:
+        return None
+
+    # The first entry is the latest diff version
+    if stream:
+        latest_diff = diff_list[0]
+        diffs = iter_mr_diffs(gl, project, mr, latest_diff.id)
+    else:
+        latest_diff = mr.diffs.get(diff_list[0].id)
+        diffs = latest_diff.diffs
+    head_sha = getattr(latest_diff, "head_commit_sha", None) or mr.sha
+    result = {
+        "project": project,
+        "project_path": project_path,
+        "iid": merge_request_iid,
+        "head_sha": head_sha,
+        "since_sha": None,
+        "diffs": diffs,
+        "skipped": [],
+    }
+
+    if since_sha:
+        if since_sha == head_sha:
+            result["since_sha"] = since_sha
+            result["diffs"] = []
+            return result
+        try:
+            if is_ancestor(project, since_sha, head_sha):
+                compare = project.repository_compare(since_sha, head_sha)
+                result["since_sha"] = since_sha
+                result["diffs"] = compare.get("diffs") or []
+            else:
+                print(f"{since_sha[:8]} is no longer in the history of {head_sha[:8]} (rebased or force-pushed); "
+                      "reviewing the full diff.")
+        except gitlab.exceptions.GitlabError as e:
+            print(f"Could not compare {since_sha[:8]}..{head_sha[:8]} ({e}); reviewing the full diff.")
+
+    if diff_filter is not None and isinstance(result["diffs"], list):
+        result["diffs"], result["skipped"] = diff_filter.apply(result["diffs"])
+    elif diff_filter is not None:
+        # Streamed pages are filtered as they are read
+        result["diffs"] = diff_filter.iter_apply(result["diffs"], result["skipped"])
+    return result
+
+def load_file_diffs(mr_diffs: dict, context: int = None, max_workers: int = None) -> list:
+    """
+    Parse the diffs returned by fetch_mr_diffs into diff_model.FileDiff
+    objects with `context` lines (default DIFF_CONTEXT_LINES) around each
+    hunk. Context beyond what the diffs carry ("context_lines", GitLab's 3
+    by default) is read from the files at the head commit, through
+    file_cache or the local clone in "repo", concurrently on a bounded
+    worker pool; files that cannot be fetched keep the context they have.
+    """
+    context = get_context_lines() if context is None else context
+    file_diffs = parse_gitlab_diffs(mr_diffs["diffs"])
+    file_lines = [None] * len(file_diffs)
+    given = mr_diffs.get("context_lines", GITLAB_CONTEXT_LINES)
+    wanted = [i for i, file_diff in enumerate(file_diffs)
+              if context > given and file_diff.hunks and not file_diff.deleted_file]
+    if wanted:
+        def read_lines(file_diff):
+            if mr_diffs.get("repo") is not None:
+                return mr_diffs["repo"].file_lines(mr_diffs["head_sha"], file_diff.new_path)
+            try:
+                return get_file_lines(mr_diffs["project"], mr_diffs["head_sha"], file_diff.new_path)
+            except gitlab.exceptions.GitlabError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers or get_max_workers()) as pool:
+            for i, lines in zip(wanted, pool.map(in_caller_context(lambda i: read_lines(file_diffs[i])), wanted)):
+                file_lines[i] = lines
+    return [with_context(file_diff, context, lines) for file_diff, lines in zip(file_diffs, file_lines)]
+
+def write_diff_file(mr_diffs: dict, out_dir: str, format_diffs: Callable[[list], str], context: int = None,
+                    chunk_size: int = DIFF_PAGE_SIZE) -> str:
+    """
+    Write the diffs of fetch_mr_diffs or fetch_local_diffs to out_dir/diff.txt
+    chunk_size files at a time: each chunk is parsed, given its context (see
+    load_file_diffs), formatted with format_diffs and written before the next
+    one is read, so memory does not grow with the size of the MR. Files left
+    out by the diff filter go to skipped_files.txt. Returns the diff.txt path.
+    """
+    diff_path = os.path.join(out_dir, "diff.txt")
+    diffs = iter(mr_diffs["diffs"])
+    with open(diff_path, "w") as out:
+        while True:
+            chunk = list(itertools.islice(diffs, chunk_size))
+            if not chunk:
+                break
+            out.write(format_diffs(load_file_diffs(dict(mr_diffs, diffs=chunk), context)))
+    if mr_diffs["skipped"]:
+        with open(os.path.join(out_dir, MANIFEST_FILE_NAME), "w") as out:
+            out.write(format_manifest(mr_diffs["skipped"]))
+    return diff_path
+
+def make_output_dir(workspace_path: str, prefix: str = "review") -> str:
+    """
+    Create <workspace_path>/<prefix>_<timestamp> and return its path.
+    Directories created in the same second get a _2, _3, ... suffix.
+    """
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    base_dir = os.path.join(workspace_path or '.', f"{prefix}_{timestamp}")
+    os.makedirs(os.path.dirname(base_dir), exist_ok=True)
+    out_dir = base_dir
+    suffix = 1
+    while True:
+        try:
+            os.mkdir(out_dir)
+            return out_dir
+        except FileExistsError:
+            suffix += 1
+            out_dir = f"{base_dir}_{suffix}"
+
+def in_caller_context(fn: Callable) -> Callable:
+    """
+    Wrap fn for a worker pool so every call runs in a copy of the caller's
+    contextvars: GitLab requests made by pool threads keep the metrics
+    scope and label of the crawl that started them.
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
+
+def get_max_workers() -> int:
+    """
+    Worker pool size for GitLab requests, from GITLAB_MAX_WORKERS (default DEFAULT_MAX_WORKERS).
+    """
+    try:
+        return max(1, int(os.getenv("GITLAB_MAX_WORKERS", DEFAULT_MAX_WORKERS)))
+    except ValueError:
+        return DEFAULT_MAX_WORKERS
+
+def _has_complete_notes(discussion) -> bool:
+    notes = discussion.attributes.get("notes")
+    if not isinstance(notes, list) or not notes:
+        return False
+    return all("body" in note and "author" in note for note in notes)
+
+def load_discussions(mr, max_workers: int = None) -> list:
+    """
+    Return all discussions of a merge request, in list order.
+    The list payload already carries the notes, so a discussion is only
+    fetched again when its notes are missing; those re-fetches run
+    concurrently on a bounded worker pool.
+    """
+    discussions = mr.discussions.list(all=True)
+    incomplete = [i for i, d in enumerate(discussions) if not _has_complete_notes(d)]
+    if incomplete:
+        with ThreadPoolExecutor(max_workers=max_workers or get_max_workers()) as pool:
+            refetched = pool.map(in_caller_context(lambda i: mr.discussions.get(discussions[i].id)),
+                                 incomplete)
+            for i, discussion in zip(incomplete, refetched):
+                discussions[i] = discussion
+        print(f"Re-fetched {len(incomplete)} of {len(discussions)} discussions with incomplete notes.")
+    return discussions
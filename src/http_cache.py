@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# On-disk store for GitLab API responses, inside WORKSPACE_PATH
+CACHE_DIR_NAME = "http_cache"
+# Headers kept with a cached body; pagination headers matter to python-gitlab lists
+STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Link", "X-Page", "X-Per-Page", "X-Next-Page",
+                  "X-Prev-Page", "X-Total", "X-Total-Pages")
+
+def is_enabled() -> bool:
+    """
+    False when GITLAB_HTTP_CACHE is "off" (or 0/false/no).
+    """
+    return (os.getenv("GITLAB_HTTP_CACHE") or "on").lower() not in ("off", "0", "false", "no")
+
+class CachingSession(requests.Session):
+    """
+    requests session for python-gitlab that revalidates instead of
+    re-downloading. GET responses carrying an ETag or Last-Modified header are
+    stored under WORKSPACE_PATH/http_cache, keyed by URL and token. The next
+    GET of the same URL sends If-None-Match / If-Modified-Since, and a 304 is
+    answered with the stored body, so an unchanged MR costs only header-sized
+    round-trips. Connections are pooled and kept alive for up to pool_size
+    concurrent workers. With max_in_flight, at most that many requests are
+    sent at once across every thread using the session, however many worker
+    pools the crawls start; the redirect hops of a request share its slot.
+    Counts stored-body reuses in `revalidated`.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, pool_size: int = 10, max_in_flight: Optional[int] = None):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else contextlib.nullcontext()
+        # send() depth per thread: resolve_redirects calls send() again for every hop
+        self._depth = threading.local()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def _path(self, request: requests.PreparedRequest) -> str:
+        # The token is part of the key: a response is only reused for the identity that could read it
+        token = request.headers.get("PRIVATE-TOKEN") or request.headers.get("Authorization") or ""
+        key = hashlib.sha256(f"{request.url}\0{token}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _read(self, path: str) -> Optional[tuple]:
+        # (metadata dict, body bytes): one JSON line followed by the raw body
+        try:
+            with open(path, "rb") as f:
+                meta = json.loads(f.readline())
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path: str, response: requests.Response) -> None:
+        meta = {"url": response.url, "status": response.status_code,
+                "headers": {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file first so a concurrent reader never sees a partial entry
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta).encode("utf-8") + b"\n")
+                f.write(response.content)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        depth = getattr(self._depth, "value", 0)
+        # Only the outermost send takes a slot; a redirect hop waiting for
+        # one would wait on itself
+        slot = self._slots if depth == 0 else contextlib.nullcontext()
+        with slot:
+            self._depth.value = depth + 1
+            try:
+                return self._send(request, **kwargs)
+            finally:
+                self._depth.value = depth
+
+    def _send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        if (not self.cache_dir or request.method != "GET" or kwargs.get("stream")
+                or "Range" in request.headers):
+            return super().send(request, **kwargs)
+
+        path = self._path(request)
+        entry = self._read(path)
+        if entry is not None:
+            headers = entry[0]["headers"]
+            if "ETag" in headers:
+                request.headers["If-None-Match"] = headers["ETag"]
+            if "Last-Modified" in headers:
+                request.headers["If-Modified-Since"] = headers["Last-Modified"]
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self.revalidated += 1
+            return _from_entry(entry, response)
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            self._write(path, response)
+        return response
+
+def _from_entry(entry: tuple, not_modified: requests.Response) -> requests.Response:
+    # The stored response, with the request and timing of the 304 that confirmed it
+    meta, body = entry
+    response = requests.Response()
+    response.status_code = meta["status"]
+    response.headers.update(meta["headers"])
+    response._content = body
+    response.encoding = not_modified.encoding
+    response.url = meta.get("url") or not_modified.url
+    response.request = not_modified.request
+    response.elapsed = not_modified.elapsed
+    response.connection = not_modified.connection
+    response.from_cache = True
+    return response
+
+def create_session(pool_size: int = 10, max_in_flight: Optional[int] = None) -> CachingSession:
+    """
+    A CachingSession storing into WORKSPACE_PATH/http_cache, or only pooling
+    connections when GITLAB_HTTP_CACHE is off.
+    """
+    cache_dir = os.path.join(os.getenv("WORKSPACE_PATH") or ".", CACHE_DIR_NAME) if is_enabled() else None
+    return CachingSession(cache_dir, pool_size=pool_size, max_in_flight=max_in_flight)
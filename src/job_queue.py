@@ -0,0 +1,104 @@
+import os
+import sqlite3
+import datetime
+from typing import List, Optional
+
+# Queue file lives in WORKSPACE_PATH so jobs survive a restart of the service
+QUEUE_FILE_NAME = "review_queue.sqlite3"
+# Jobs that are waiting or being reviewed; at most one of them per MR
+ACTIVE_STATES = ("queued", "running")
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+class JobQueue:
+    """
+    Persistent FIFO of review jobs, one row per merge request version
+    (mr_key + head_sha). States: queued, running, done, failed, superseded
+    (a newer head arrived) and cancelled (the MR was closed or merged).
+    Jobs left running by a stopped service are queued again on open.
+    Not thread-safe: use it from one thread (the service's event loop).
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            path = os.path.join(os.getenv("WORKSPACE_PATH") or ".", QUEUE_FILE_NAME)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " mr_key TEXT NOT NULL,"
+            " comments_url TEXT NOT NULL,"
+            " diff_url TEXT NOT NULL,"
+            " head_sha TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " created_at TEXT NOT NULL,"
+            " updated_at TEXT NOT NULL,"
+            " output TEXT NOT NULL DEFAULT '',"
+            " detail TEXT NOT NULL DEFAULT '')"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_mr ON jobs (mr_key, status)")
+        self.requeued = self.db.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'",
+                                        (_now(),)).rowcount
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _set_status(self, job_ids: List[int], status: str, detail: str = "") -> None:
+        self.db.executemany("UPDATE jobs SET status = ?, detail = ?, updated_at = ? WHERE id = ?",
+                            [(status, detail, _now(), job_id) for job_id in job_ids])
+
+    def _ids(self, mr_key: str, status: str) -> List[int]:
+        return [row["id"] for row in
+                self.db.execute("SELECT id FROM jobs WHERE mr_key = ? AND status = ? ORDER BY id", (mr_key, status))]
+
+    def enqueue(self, mr_key: str, comments_url: str, diff_url: str, head_sha: str) -> tuple:
+        """
+        Queue a review of the MR at head_sha. Queued jobs of older heads are
+        marked superseded. Returns (new job id, ids of the MR's running jobs,
+        which the caller should cancel); the id is None when this head is
+        already queued, running or reviewed.
+        """
+        latest = self.db.execute("SELECT head_sha, status FROM jobs WHERE mr_key = ? AND status != 'superseded' "
+                                 "ORDER BY id DESC LIMIT 1", (mr_key,)).fetchone()
+        if latest is not None and latest["head_sha"] == head_sha and latest["status"] in ACTIVE_STATES + ("done",):
+            return None, []
+        queued = self._ids(mr_key, "queued")
+        running = self._ids(mr_key, "running")
+        self._set_status(queued, "superseded", f"newer head {head_sha[:8]}")
+        cursor = self.db.execute(
+            "INSERT INTO jobs (mr_key, comments_url, diff_url, head_sha, status, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+            (mr_key, comments_url, diff_url, head_sha, _now(), _now()))
+        self.db.commit()
+        return cursor.lastrowid, running
+
+    def cancel(self, mr_key: str, reason: str) -> List[int]:
+        """
+        Cancel the queued jobs of an MR. Returns the ids of its running jobs.
+        """
+        self._set_status(self._ids(mr_key, "queued"), "cancelled", reason)
+        self.db.commit()
+        return self._ids(mr_key, "running")
+
+    def claim(self) -> Optional[dict]:
+        """
+        Mark the oldest queued job as running and return it, or None.
+        """
+        row = self.db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+        if row is None:
+            return None
+        self._set_status([row["id"]], "running")
+        self.db.commit()
+        return dict(row, status="running")
+
+    def finish(self, job_id: int, status: str, output: str = "", detail: str = "") -> None:
+        self.db.execute("UPDATE jobs SET status = ?, output = ?, detail = ?, updated_at = ? WHERE id = ?",
+                        (status, output or "", detail, _now(), job_id))
+        self.db.commit()
+
+    def recent(self, limit: int = 50) -> List[dict]:
+        return [dict(row) for row in self.db.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))]
@@ -0,0 +1,201 @@
+import os
+import itertools
+import threading
+import subprocess
+from typing import Iterator, Optional
+
+from diff_model import GITLAB_CONTEXT_LINES
+
+class GitRepo:
+    """
+    A local clone read with the git CLI: diffs are streamed from `git diff`
+    and file contents come from one long-running `git cat-file --batch`.
+    Git failures raise ValueError with a printable message.
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self._cat_file = None
+        self._cat_file_lock = threading.Lock()
+        if not os.path.isdir(self.path):
+            raise ValueError(f"Repository path not found: {self.path}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def git(self, *args: str) -> str:
+        result = subprocess.run(["git", "-C", self.path, *args], capture_output=True)
+        if result.returncode != 0:
+            message = result.stderr.decode("utf-8", errors="replace").strip()
+            raise ValueError(f"git {args[0]} failed: {message}")
+        return result.stdout.decode("utf-8", errors="replace")
+
+    def resolve(self, ref: str) -> str:
+        return self.git("rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}").strip()
+
+    def merge_base(self, base: str, head: str) -> str:
+        return self.git("merge-base", base, head).strip()
+
+    def is_ancestor(self, ancestor: str, head: str) -> bool:
+        return subprocess.run(["git", "-C", self.path, "merge-base", "--is-ancestor", ancestor, head],
+                              capture_output=True).returncode == 0
+
+    def iter_diffs(self, base: str, head: str, context: int) -> Iterator[dict]:
+        """
+        Stream `git diff base head` and yield one GitLab-style diff dict
+        (old_path, new_path, new_file, deleted_file, renamed_file, diff) per
+        file as soon as its patch has been read.
+        """
+        command = ["git", "-C", self.path, "-c", "core.quotePath=false", "diff", "--no-color", "--no-ext-diff",
+                   "-M", f"-U{context}", base, head]
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        current = None
+        try:
+            for raw in process.stdout:
+                line = raw.decode("utf-8", errors="replace").rstrip("\n")
+                if line.startswith("diff --git "):
+                    if current is not None:
+                        yield _finish(current)
+                    current = _start(line)
+                elif current is None:
+                    continue
+                elif current["lines"]:
+                    current["lines"].append(line)
+                elif line.startswith("@@"):
+                    current["lines"].append(line)
+                else:
+                    _read_header(current, line)
+            if current is not None:
+                yield _finish(current)
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode("utf-8", errors="replace").strip()
+            process.stderr.close()
+            if process.wait() != 0:
+                raise ValueError(f"git diff failed: {stderr}")
+
+    def read_blob(self, ref: str, path: str) -> Optional[bytes]:
+        """
+        Content of `path` at `ref`, or None when it does not exist there.
+        """
+        with self._cat_file_lock:
+            if self._cat_file is None:
+                self._cat_file = subprocess.Popen(["git", "-C", self.path, "cat-file", "--batch"],
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._cat_file.stdin.write(f"{ref}:{path}\n".encode("utf-8"))
+            self._cat_file.stdin.flush()
+            header = self._cat_file.stdout.readline().decode("utf-8", errors="replace").split()
+            if len(header) != 3:
+                # "<object> missing" or "<object> ambiguous"
+                return None
+            content = self._cat_file.stdout.read(int(header[2]))
+            # Every object is followed by a newline
+            self._cat_file.stdout.read(1)
+            return content if header[1] == "blob" else None
+
+    def file_lines(self, ref: str, path: str) -> Optional[list]:
+        content = self.read_blob(ref, path)
+        return None if content is None else content.decode("utf-8", errors="replace").splitlines()
+
+    def close(self) -> None:
+        with self._cat_file_lock:
+            if self._cat_file is not None:
+                self._cat_file.stdin.close()
+                self._cat_file.wait()
+                self._cat_file.stdout.close()
+                self._cat_file = None
+
+def _start(header: str) -> dict:
+    # "diff --git a/<old> b/<new>"; exact paths come from the ---/+++ or rename lines when present
+    paths = header[len("diff --git "):]
+    old_path, _, new_path = paths.partition(" b/")
+    old_path = old_path[2:] if old_path.startswith("a/") else old_path
+    return {"old_path": old_path, "new_path": new_path or old_path, "new_file": False, "deleted_file": False,
+            "renamed_file": False, "binary": None, "lines": []}
+
+def _read_header(current: dict, line: str) -> None:
+    if line.startswith("new file mode"):
+        current["new_file"] = True
+    elif line.startswith("deleted file mode"):
+        current["deleted_file"] = True
+    elif line.startswith("rename from "):
+        current["renamed_file"] = True
+        current["old_path"] = line[len("rename from "):]
+    elif line.startswith("rename to "):
+        current["new_path"] = line[len("rename to "):]
+    elif line.startswith("--- a/"):
+        current["old_path"] = line[len("--- a/"):]
+    elif line.startswith("+++ b/"):
+        current["new_path"] = line[len("+++ b/"):]
+    elif line.startswith("Binary files "):
+        current["binary"] = line
+
+def _finish(current: dict) -> dict:
+    if current["deleted_file"]:
+        current["new_path"] = current["new_path"] or current["old_path"]
+    lines = current.pop("lines")
+    binary = current.pop("binary")
+    current["diff"] = binary if binary else ("\n".join(lines) + "\n" if lines else "")
+    return current
+
+def fetch_local_diffs(repo: GitRepo, base: str, head: str = "HEAD", since_sha: str = None, diff_filter=None,
+                      stream: bool = False):
+    """
+    The local counterpart of gitlib_utils.fetch_mr_diffs: the changes of
+    `head` since its merge base with `base`, computed by git in `repo` with
+    GitLab's GITLAB_CONTEXT_LINES around each hunk. As for GitLab diffs,
+    load_file_diffs reads any further DIFF_CONTEXT_LINES from the files at
+    head, here through the repo's `git cat-file --batch` process.
+    With since_sha, only the changes from that commit to head are returned;
+    if it is not in the clone, or no longer in the history of head (a rebase
+    or force-push), the full diff is returned instead.
+    Returns None when there are no changes, otherwise the same dict as
+    fetch_mr_diffs, with "repo" set instead of "project". With stream=True,
+    "diffs" is read from `git diff` as it is consumed, like fetch_mr_diffs.
+    """
+    head_sha = repo.resolve(head)
+    base_sha = repo.merge_base(repo.resolve(base), head_sha)
+    result = {
+        "project": None,
+        "repo": repo,
+        "project_path": repo.path,
+        "iid": base,
+        "head_sha": head_sha,
+        "since_sha": None,
+        "diffs": [],
+        "skipped": [],
+        "context_lines": GITLAB_CONTEXT_LINES,
+    }
+
+    if since_sha == head_sha:
+        result["since_sha"] = since_sha
+        return result
+    from_sha = base_sha
+    if since_sha:
+        try:
+            since = repo.resolve(since_sha)
+            if repo.is_ancestor(since, head_sha):
+                from_sha = since
+                result["since_sha"] = since_sha
+            else:
+                print(f"{since_sha[:8]} is no longer in the history of {head_sha[:8]} (rebased or force-pushed); "
+                      "reviewing the full diff.")
+        except ValueError as e:
+            print(f"Could not compare {since_sha[:8]}..{head_sha[:8]} ({e}); reviewing the full diff.")
+
+    diffs = repo.iter_diffs(from_sha, head_sha, GITLAB_CONTEXT_LINES)
+    if stream:
+        first = next(diffs, None)
+        result["diffs"] = itertools.chain([first], diffs) if first is not None else []
+    else:
+        result["diffs"] = list(diffs)
+    if not result["diffs"] and not result["since_sha"]:
+        return None
+    if diff_filter is not None and isinstance(result["diffs"], list):
+        result["diffs"], result["skipped"] = diff_filter.apply(result["diffs"])
+    elif diff_filter is not None:
+        result["diffs"] = diff_filter.iter_apply(result["diffs"], result["skipped"])
+    return result
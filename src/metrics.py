@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import importlib
+import pstats
+import cProfile
+import contextlib
+import contextvars
+from typing import Optional
+
+# File written into each review directory, one JSON event per line
+TRACE_FILE_NAME = "trace.jsonl"
+PROFILE_FILE_NAME = "profile.prof"
+
+# Every model call and GitLab request of the process, in completion order
+events = []
+
+# What the current work belongs to: scope is the merge request (batch runs),
+# label the rule, shard or thread being reviewed
+current_scope = contextvars.ContextVar("metrics_scope", default=None)
+current_label = contextvars.ContextVar("metrics_label", default=None)
+
+def record(kind: str, name: str, seconds: float, **fields) -> dict:
+    """
+    Record one model call (kind "ai") or GitLab request (kind "gitlab").
+    Extra fields: prompt_tokens, completion_tokens, retries, hedged, cache, status, ...
+    """
+    event = {
+        "ts": time.time(),
+        "kind": kind,
+        "name": name,
+        "seconds": round(seconds, 4),
+        "scope": current_scope.get(),
+        "label": current_label.get(),
+    }
+    event.update(fields)
+    events.append(event)
+    return event
+
+def record_startup(stage: str, seconds: float) -> None:
+    """
+    Record a one-time start-up cost (kind "startup"): a deferred import, the
+    first credential token, the first model request. Later calls of the same
+    stage are ignored.
+    """
+    if not any(e["kind"] == "startup" and e["name"] == stage for e in events):
+        record("startup", stage, seconds)
+
+def timed_import(module_name: str):
+    """
+    Import a heavy module on first use and record how long that took.
+    """
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    started = time.perf_counter()
+    module = importlib.import_module(module_name)
+    record_startup(f"import {module_name}", time.perf_counter() - started)
+    return module
+
+@contextlib.contextmanager
+def label(text: str):
+    """
+    Tag the events recorded inside the block with a label (e.g. "rule: ...").
+    """
+    token = current_label.set(text)
+    try:
+        yield
+    finally:
+        current_label.reset(token)
+
+@contextlib.contextmanager
+def scope(text: str):
+    """
+    Tag the events recorded inside the block with a scope (e.g. the MR URL).
+    """
+    token = current_scope.set(text)
+    try:
+        yield
+    finally:
+        current_scope.reset(token)
+
+def gitlab_hook(response, *args, **kwargs):
+    """
+    requests response hook that records every GitLab API request.
+    """
+    request = response.request
+    path = request.path_url.split("?", 1)[0] if request is not None else response.url
+    record("gitlab", f"{request.method if request is not None else 'GET'} {path}",
+           response.elapsed.total_seconds(), status=response.status_code)
+    return response
+
+def _selected(scope_filter: Optional[str]) -> list:
+    if scope_filter is None:
+        return list(events)
+    return [event for event in events if event["scope"] == scope_filter]
+
+def write_trace(output_dir: str, scope_filter: Optional[str] = None) -> Optional[str]:
+    """
+    Write the recorded events (optionally only one scope) to output_dir/trace.jsonl.
+    """
+    selected = _selected(scope_filter)
+    if not output_dir or not selected or not os.path.isdir(output_dir):
+        return None
+    trace_path = os.path.join(output_dir, TRACE_FILE_NAME)
+    with open(trace_path, "w", encoding="utf-8") as f:
+        for event in selected:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+    return trace_path
+
+def totals(scope_filter: Optional[str] = None) -> dict:
+    """
+    AI call count and token totals of the recorded events (optionally one scope).
+    """
+    ai_events = [e for e in _selected(scope_filter) if e["kind"] == "ai"]
+    return {
+        "ai_calls": len(ai_events),
+        "tokens": sum((e.get("prompt_tokens") or 0) + (e.get("completion_tokens") or 0) for e in ai_events),
+    }
+
+def summarize(scope_filter: Optional[str] = None, slowest: int = 5) -> str:
+    selected = _selected(scope_filter)
+    lines = []
+    ai_events = [e for e in selected if e["kind"] == "ai"]
+    gitlab_events = [e for e in selected if e["kind"] == "gitlab"]
+    startup_events = [e for e in selected if e["kind"] == "startup"]
+    if startup_events:
+        lines.append("Start-up: " + ", ".join(f"{e['name']} {e['seconds']:.2f}s" for e in startup_events))
+    if ai_events:
+        prompt_tokens = sum(e.get("prompt_tokens") or 0 for e in ai_events)
+        completion_tokens = sum(e.get("completion_tokens") or 0 for e in ai_events)
+        cached_tokens = sum(e.get("cached_tokens") or 0 for e in ai_events)
+        cache_hits = sum(1 for e in ai_events if e.get("cache") == "hit")
+        retries = sum(e.get("retries") or 0 for e in ai_events)
+        hedged = sum(1 for e in ai_events if e.get("hedged"))
+        lines.append(
+            f"AI calls: {len(ai_events)} ({cache_hits} from cache, {retries} retries, {hedged} hedged), "
+            f"{sum(e['seconds'] for e in ai_events):.2f}s total, "
+            f"{prompt_tokens} prompt / {completion_tokens} completion tokens"
+            + (f", {cached_tokens} cached prompt tokens" if cached_tokens else "")
+        )
+    if gitlab_events:
+        not_modified = sum(1 for e in gitlab_events if e.get("status") == 304)
+        lines.append(f"GitLab requests: {len(gitlab_events)}"
+                     + (f" ({not_modified} not modified)" if not_modified else "")
+                     + f", {sum(e['seconds'] for e in gitlab_events):.2f}s total")
+    timed = sorted((e for e in selected if e["kind"] != "startup"), key=lambda e: e["seconds"], reverse=True)[:slowest]
+    if timed:
+        lines.append("Slowest:")
+        for e in timed:
+            where = f" [{e['label']}]" if e.get("label") else ""
+            lines.append(f"  {e['seconds']:8.2f}s  {e['kind']:6s} {e['name']}{where}")
+    return "\n".join(lines)
+
+def discard(scope_filter: str) -> None:
+    """
+    Forget the events of one scope once they are written, so a long-running
+    process does not keep every call it ever made.
+    """
+    events[:] = [event for event in events if event["scope"] != scope_filter]
+
+def print_summary(scope_filter: Optional[str] = None) -> None:
+    summary = summarize(scope_filter)
+    if summary:
+        print(summary)
+
+@contextlib.contextmanager
+def profiled(enabled: bool, output_path: Optional[str] = None, top: int = 25):
+    """
+    Run the block under cProfile when enabled; print the top functions by
+    cumulative time and save the raw stats to output_path.
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if output_path:
+            profiler.dump_stats(output_path)
+            print(f"Profile saved to {output_path}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+import asyncio
+from typing import Optional
+from dotenv import load_dotenv
+
+import gitlab
+
+import gitlib_crawler
+import gitlib_diff_crawler
+from gitlib_crawler import crawl_comments, format_diff, save_text
+from gitlib_diff_crawler import format_changed_code
+from gitlib_utils import create_gitlab_client, make_output_dir, parse_mr_url, fetch_mr_diffs, write_diff_file
+from local_git import GitRepo, fetch_local_diffs
+from diff_filter import get_diff_filter, report_skipped
+from review_state import state_key, get_last_review, record_review, read_previous_result, merge_results
+from azure_ai_caller import init_ai_caller, close_ai_caller
+from ai_prompts import init_prompt_map
+from reviewer import review_code, read_rules
+from coding_rule_reviewer import check_rules, parse_rules, read_text_file
+import ai_cache
+import metrics
+
+def _last_review(diff_url: str, kind: str, incremental: bool, repo: Optional[GitRepo] = None, base: str = None):
+    if repo is not None:
+        # A local review is tracked per clone and target branch
+        key = state_key(repo.path, base, kind)
+    else:
+        project_path, merge_request_iid = parse_mr_url(diff_url, gitlib_crawler.gitlab_url, diffs=True)
+        key = state_key(project_path, merge_request_iid, kind)
+    last_review = get_last_review(key) if incremental else None
+    return key, last_review
+
+def _unchanged(mr_diffs: dict, last_review: Optional[dict]) -> bool:
+    if last_review and mr_diffs["since_sha"] and not mr_diffs["diffs"] and not mr_diffs["skipped"]:
+        print(f"No changes since the last reviewed version {mr_diffs['since_sha'][:8]}; "
+              f"keeping {last_review['result_file']}")
+        return True
+    return False
+
+def _merge_with_last_review(result: str, mr_diffs: dict, last_review: Optional[dict]) -> str:
+    if not mr_diffs["since_sha"]:
+        return result
+    return merge_results(result, read_previous_result(last_review), mr_diffs["since_sha"], mr_diffs["head_sha"])
+
+def _fetch_diffs(gl, diff_url: str, gitlab_url: str, since_sha: Optional[str], diff_filter,
+                 repo: Optional[GitRepo], base: Optional[str], head: str):
+    if repo is not None:
+        return fetch_local_diffs(repo, base, head, since_sha, diff_filter, stream=True)
+    return fetch_mr_diffs(gl, diff_url, gitlab_url, since_sha, diff_filter, stream=True)
+
+async def review_merge_request(gl, comments_url: str, diff_url: str, language: str = "english",
+                               concurrency: Optional[int] = None, shard_tokens: Optional[int] = None,
+                               prompts: Optional[dict] = None, incremental: bool = False,
+                               diff_filter=None, repo: Optional[GitRepo] = None, base: Optional[str] = None,
+                               head: str = "HEAD", per_thread: bool = False) -> Optional[str]:
+    """
+    Crawl the unresolved threads and diff of a merge request and review them
+    in this process. comments.txt, diff.txt and result.md are written to a new
+    review_<timestamp> directory, whose path is returned (None if there was
+    nothing to review). Files left out by diff_filter are listed in skipped_files.txt.
+    With incremental=True only the changes since the last reviewed head commit
+    are reviewed, and the earlier findings are appended to result.md.
+    With a local_git.GitRepo, the diff of head against base is computed in
+    that clone and diff_url is not used.
+    With per_thread=True, every thread is reviewed in its own call (see reviewer.review_threads).
+    """
+    key, last_review = _last_review(diff_url, "review", incremental, repo, base)
+    since_sha = last_review["head_sha"] if last_review else None
+
+    # python-gitlab is synchronous; keep the event loop free while crawling
+    comments, mr_diffs = await asyncio.gather(
+        asyncio.to_thread(crawl_comments, gl, comments_url),
+        asyncio.to_thread(_fetch_diffs, gl, diff_url, gitlib_crawler.gitlab_url, since_sha, diff_filter,
+                          repo, base, head),
+    )
+    if comments is None:
+        print("No unresolved threads found.")
+        return None
+    if mr_diffs is None:
+        print("No diffs found for the provided URL.")
+        return None
+    if _unchanged(mr_diffs, last_review):
+        return last_review["output_dir"]
+
+    review_dir = make_output_dir(gitlib_crawler.workspace_path)
+    save_text(review_dir, "comments.txt", comments)
+    # diff.txt is written a page at a time and read back once as the review input
+    diff = read_text_file(await asyncio.to_thread(write_diff_file, mr_diffs, review_dir, format_diff))
+    report_skipped(mr_diffs["skipped"])
+    print(f"Crawled merge request into {review_dir}")
+
+    print("Running AI reviewer...")
+    result_path = os.path.join(review_dir, "result.md")
+    review_result = await review_code(comments, diff, read_rules(), language, concurrency, shard_tokens, prompts,
+                                      output_path=result_path, per_thread=per_thread)
+    save_text(review_dir, "result.md", _merge_with_last_review(review_result, mr_diffs, last_review))
+    record_review(key, mr_diffs["head_sha"], review_dir, result_path)
+    print(f"AI review result saved to {result_path}")
+    return review_dir
+
+async def check_merge_request_rules(gl, diff_url: str, rules: list, language: str = "english",
+                                    concurrency: Optional[int] = None, batch: bool = False,
+                                    batch_tokens: Optional[int] = None, prompts: Optional[dict] = None,
+                                    incremental: bool = False, diff_filter=None, repo: Optional[GitRepo] = None,
+                                    base: Optional[str] = None, head: str = "HEAD",
+                                    cascade: bool = False) -> Optional[str]:
+    """
+    Crawl the changed code of a merge request and check it against the coding
+    rules in this process. diff.txt and coding_rule_result.md are written to a
+    new coding_rule_<timestamp> directory, whose path is returned (None if the
+    MR has no diffs). Files left out by diff_filter are listed in skipped_files.txt.
+    With incremental=True only the changes since the last checked head commit
+    are checked, and the earlier findings are appended to the result.
+    With a local_git.GitRepo, the diff of head against base is computed in
+    that clone and diff_url is not used.
+    With cascade=True, the fast model screens the rules first (see check_rules).
+    """
+    key, last_review = _last_review(diff_url, "coding_rule", incremental, repo, base)
+    since_sha = last_review["head_sha"] if last_review else None
+
+    mr_diffs = await asyncio.to_thread(_fetch_diffs, gl, diff_url, gitlib_diff_crawler.gitlab_url, since_sha,
+                                       diff_filter, repo, base, head)
+    if mr_diffs is None:
+        print("No diffs found for the provided URL.")
+        return None
+    if _unchanged(mr_diffs, last_review):
+        return last_review["output_dir"]
+
+    out_dir = make_output_dir(gitlib_diff_crawler.workspace_path, "coding_rule")
+    diff_path = await asyncio.to_thread(write_diff_file, mr_diffs, out_dir, format_changed_code)
+    changed_code = read_text_file(diff_path)
+    report_skipped(mr_diffs["skipped"])
+    print(f"Saved changed code to {diff_path}")
+
+    result_path = os.path.join(out_dir, "coding_rule_result.md")
+    final = await check_rules(changed_code, rules, language, concurrency, batch=batch,
+                              batch_tokens=batch_tokens, prompts=prompts, output_path=result_path, cascade=cascade)
+    save_text(out_dir, "coding_rule_result.md", _merge_with_last_review(final, mr_diffs, last_review))
+    record_review(key, mr_diffs["head_sha"], out_dir, result_path)
+    print(f"Result written to {result_path}")
+    return out_dir
+
+def ai_options() -> argparse.ArgumentParser:
+    """
+    Parent parser (argparse parents=[...]) with the options of every review
+    of one merge request, shared by pipeline, batch_review and review_service.
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("-l", "--language", help="Comma-separated list of languages for the AI response (e.g., japanese,english,chinese).", default="english")
+    options.add_argument("-j", "--concurrency", type=int, default=None, help="Maximum number of AI calls at the same time for one merge request (default: AI_MAX_CONCURRENCY or 4).")
+    options.add_argument("--no-cache", action="store_true", help="Bypass the AI response cache for this run.")
+    options.add_argument("-i", "--incremental", action="store_true", help="Only review the changes since the last reviewed version of the MR and merge the result with the earlier findings.")
+    options.add_argument("--no-filter", action="store_true", help="Keep lockfiles, generated, vendored and whitespace-only changes in diff.txt.")
+    return options
+
+def run_options() -> argparse.ArgumentParser:
+    """
+    Parent parser with the options of one command-line run (pipeline, batch_review).
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--clear-cache", action="store_true", help="Empty the AI response cache before running.")
+    options.add_argument("--profile", action="store_true", help="Run under cProfile and save the stats to WORKSPACE_PATH/profile.prof.")
+    return options
+
+def review_options() -> argparse.ArgumentParser:
+    """
+    Parent parser with the options of the comment review (see review_merge_request).
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("-t", "--per-thread", action="store_true", help="Review each unresolved thread in its own call with only the diff hunks that touch it.")
+    options.add_argument("--shard-tokens", type=int, default=None, help="Token budget of the diff in one request (default: REVIEW_SHARD_TOKENS or 60000).")
+    return options
+
+def coding_rule_options() -> argparse.ArgumentParser:
+    """
+    Parent parser with the options of the coding rule check (see check_merge_request_rules).
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("-b", "--batch", action="store_true", help="Check several rules per AI call.")
+    options.add_argument("--batch-tokens", type=int, default=None, help="Prompt-token budget of one batched call (default: CODING_RULE_BATCH_TOKENS or 32000).")
+    options.add_argument("--cascade", action="store_true", help="Screen each rule with the fast model (AI_FAST_MODEL) first and send only flagged or unsure rules to the strong model (AI_MODEL).")
+    return options
+
+def parse_args(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Crawl a GitLab merge request and review it with AI in one process.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False, parents=[ai_options(), run_options()])
+    common.add_argument("--repo", default=None, help="Compute the diff with git in this local clone instead of the GitLab API.")
+    common.add_argument("--base", default=None, help="Target branch or commit the changes are compared with (with --repo).")
+    common.add_argument("--head", default="HEAD", help="Branch or commit with the changes (with --repo, default: HEAD).")
+
+    review = subparsers.add_parser("review", parents=[common, review_options()], help="Check whether the diff addresses the unresolved comments (crawler + reviewer.py).")
+    review.add_argument("-c", "--comments-url", required=True, help="The URL of the merge request for comments")
+    review.add_argument("-d", "--diff-url", default=None, help="The URL of the merge request for diffs (not needed with --repo)")
+
+    coding_rule = subparsers.add_parser("coding-rule", parents=[common, coding_rule_options()], help="Check the changed code against coding rules (diff crawler + coding_rule_reviewer.py).")
+    coding_rule.add_argument("-d", "--diff-url", default=None, help="The URL of the merge request diffs (not needed with --repo)")
+    coding_rule.add_argument("rules_file", help="Path to the file that contains coding rules")
+    args = parser.parse_args(argv)
+    if args.repo and not args.base:
+        parser.error("--repo requires --base")
+    if not args.repo and not args.diff_url:
+        parser.error("either --diff-url or --repo with --base is required")
+    return args
+
+async def run(args) -> int:
+    # Local coding-rule checks need no GitLab access at all
+    needs_gitlab = args.command == "review" or not args.repo
+    gl, request_counter = (create_gitlab_client(gitlib_crawler.gitlab_url, gitlib_crawler.gitlab_private_token)
+                           if needs_gitlab else (None, None))
+    repo = None
+    init_ai_caller(use_cache=not args.no_cache, clear_cache=args.clear_cache)
+    prompts = init_prompt_map()
+    out_dir = None
+    try:
+        repo = GitRepo(args.repo) if args.repo else None
+        if args.command == "review":
+            out_dir = await review_merge_request(gl, args.comments_url, args.diff_url, args.language,
+                                                 args.concurrency, args.shard_tokens, prompts, args.incremental,
+                                                 get_diff_filter(not args.no_filter), repo, args.base, args.head,
+                                                 args.per_thread)
+        else:
+            rules = parse_rules(read_text_file(args.rules_file))
+            out_dir = await check_merge_request_rules(gl, args.diff_url, rules, args.language, args.concurrency,
+                                                      args.batch, args.batch_tokens, prompts, args.incremental,
+                                                      get_diff_filter(not args.no_filter), repo, args.base, args.head,
+                                                      cascade=args.cascade)
+    except ValueError as e:
+        print(e)
+        return 1
+    except gitlab.exceptions.GitlabError as e:
+        print(f"GitLab API error: {e}")
+        return 1
+    finally:
+        if repo is not None:
+            repo.close()
+        if request_counter is not None:
+            request_counter.print_summary()
+        ai_cache.print_stats()
+        await close_ai_caller()
+        metrics.write_trace(out_dir)
+        metrics.print_summary()
+    return 0 if out_dir else 1
+
+def main():
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+    args = parse_args()
+    if args.command == "coding-rule" and not os.path.exists(args.rules_file):
+        print(f"Error: rules file not found at {args.rules_file}", file=sys.stderr)
+        sys.exit(1)
+    profile_path = os.path.join(gitlib_crawler.workspace_path or '.', metrics.PROFILE_FILE_NAME)
+    with metrics.profiled(args.profile, profile_path):
+        exit_code = asyncio.run(run(args))
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
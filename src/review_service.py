@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hmac
+import json
+import time
+import signal
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+from dotenv import load_dotenv
+
+import gitlib_crawler
+from gitlib_utils import create_gitlab_client, get_max_workers, parse_mr_url
+from azure_ai_caller import init_ai_caller, close_ai_caller, set_global_concurrency, get_max_concurrency
+from ai_prompts import init_prompt_map
+from coding_rule_reviewer import parse_rules, read_text_file
+from batch_review import review_one, multi_mr_options
+from job_queue import JobQueue
+import metrics
+
+DEFAULT_PORT = 8080
+DEFAULT_WORKERS = 2
+# Merge request hook actions that mean a new version to review, or no more reviews
+REVIEW_ACTIONS = ("open", "reopen", "update")
+CANCEL_ACTIONS = ("close", "merge")
+
+def parse_merge_request_hook(payload: dict, gitlab_url: str) -> Optional[dict]:
+    """
+    Read a GitLab "Merge Request Hook" payload into {"action", "mr_key",
+    "comments_url", "diff_url", "head_sha"}. Returns None for other events.
+    Raises ValueError with a printable message for payloads that cannot be used.
+    """
+    if payload.get("object_kind") != "merge_request":
+        return None
+    attributes = payload.get("object_attributes") or {}
+    mr_url = attributes.get("url") or ""
+    head_sha = (attributes.get("last_commit") or {}).get("id") or ""
+    if not mr_url or not head_sha:
+        raise ValueError("Merge request hook without object_attributes.url or last_commit.id")
+    project_path, merge_request_iid = parse_mr_url(mr_url, gitlab_url)
+    comments_url = mr_url.rstrip("/")
+    return {
+        "action": attributes.get("action") or "",
+        "mr_key": f"{project_path}!{merge_request_iid}",
+        "comments_url": comments_url,
+        "diff_url": f"{comments_url}/diffs",
+        "head_sha": head_sha,
+    }
+
+class ReviewService:
+    """
+    Turns merge request webhooks into jobs on a JobQueue and reviews them on
+    `workers` concurrent workers that share one GitLab client and the AI
+    caller. A push to an MR supersedes its queued job and cancels its running
+    one; closing or merging the MR cancels both.
+    """
+
+    def __init__(self, queue: JobQueue, gl, args, rules: Optional[list], prompts: dict):
+        self.queue = queue
+        self.gl = gl
+        self.args = args
+        self.rules = rules
+        self.prompts = prompts
+        self.jobs_ready = asyncio.Event()
+        # job id -> (review task, status to record if it gets cancelled)
+        self.running = {}
+
+    def _cancel_running(self, job_ids: list, status: str) -> None:
+        for job_id in job_ids:
+            if job_id in self.running:
+                task, _ = self.running[job_id]
+                self.running[job_id] = (task, status)
+                task.cancel()
+                print(f"Job {job_id}: cancelling ({status})")
+
+    async def handle_hook(self, event: str, payload: dict) -> tuple:
+        """
+        Handle one webhook delivery. Returns (HTTP status, response body).
+        """
+        try:
+            hook = parse_merge_request_hook(payload, gitlib_crawler.gitlab_url)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        if hook is None:
+            return 200, {"ignored": f"not a merge request hook ({event or 'no event'})"}
+
+        if hook["action"] in CANCEL_ACTIONS:
+            running = self.queue.cancel(hook["mr_key"], f"merge request {hook['action']}d")
+            self._cancel_running(running, "cancelled")
+            return 200, {"cancelled": running}
+        if hook["action"] not in REVIEW_ACTIONS:
+            return 200, {"ignored": f"action '{hook['action']}'"}
+
+        job_id, running = self.queue.enqueue(hook["mr_key"], hook["comments_url"], hook["diff_url"], hook["head_sha"])
+        if job_id is None:
+            return 200, {"ignored": f"head {hook['head_sha'][:8]} is already queued or reviewed"}
+        self._cancel_running(running, "superseded")
+        print(f"Job {job_id}: queued {hook['comments_url']} at {hook['head_sha'][:8]}")
+        self.jobs_ready.set()
+        return 202, {"job": job_id, "superseded": running}
+
+    async def run_job(self, job: dict) -> None:
+        job_id = job["id"]
+        print(f"Job {job_id}: reviewing {job['comments_url']} at {job['head_sha'][:8]}")
+        # A scope per job keeps the metrics of two versions of one MR apart
+        scope = f"job {job_id}"
+        task = asyncio.ensure_future(review_one(self.gl, job["comments_url"], job["diff_url"], self.args, self.rules,
+                                                self.prompts, scope=scope))
+        self.running[job_id] = (task, None)
+        try:
+            await asyncio.wait({task})
+        finally:
+            _, cancel_status = self.running.pop(job_id)
+            if not task.done():
+                # The service is stopping; the job stays running and is queued again on restart
+                task.cancel()
+        if task.cancelled():
+            self.queue.finish(job_id, cancel_status or "cancelled")
+        else:
+            row = task.result()
+            status = "failed" if row["status"].startswith("failed") else "done"
+            self.queue.finish(job_id, status, row["output"], row["status"])
+            print(f"Job {job_id}: {row['status']} in {row['seconds']:.1f}s "
+                  f"({row.get('ai_calls', 0)} AI calls, {row.get('tokens', 0)} tokens) {row['output']}")
+        metrics.discard(scope)
+
+    async def worker(self) -> None:
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                self.jobs_ready.clear()
+                await self.jobs_ready.wait()
+                continue
+            await self.run_job(job)
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    # POST /webhook: GitLab merge request hooks; GET /jobs: recent jobs as JSON
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, obj, status: int = 200) -> None:
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def call(self, coroutine):
+        # The queue belongs to the event loop thread; wait there for the answer
+        return asyncio.run_coroutine_threadsafe(coroutine, self.server.loop).result()
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] == "/jobs":
+            async def recent():
+                return self.server.service.queue.recent()
+            return self.send_json(self.call(recent()))
+        if self.path == "/health":
+            return self.send_json({"status": "ok"})
+        self.send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/webhook":
+            return self.send_json({"error": "not found"}, status=404)
+        secret = self.server.secret
+        if secret and not hmac.compare_digest(self.headers.get("X-Gitlab-Token") or "", secret):
+            return self.send_json({"error": "invalid X-Gitlab-Token"}, status=401)
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.send_json({"error": "body is not JSON"}, status=400)
+        if not isinstance(payload, dict):
+            return self.send_json({"error": "body is not a JSON object"}, status=400)
+        status, body = self.call(self.server.service.handle_hook(self.headers.get("X-Gitlab-Event") or "", payload))
+        self.send_json(body, status=status)
+
+def start_webhook_server(service: ReviewService, loop, host: str, port: int, secret: Optional[str]):
+    """
+    Serve the webhook endpoint from a daemon thread; requests are handled on
+    `loop`, which runs the service.
+    """
+    httpd = ThreadingHTTPServer((host, port), _WebhookHandler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    httpd.loop = loop
+    httpd.secret = secret
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def parse_args(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Review merge requests as GitLab merge request webhooks arrive.",
+                                     parents=[multi_mr_options()])
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to listen on (default: {DEFAULT_PORT}).")
+    parser.add_argument("-w", "--workers", type=int, default=DEFAULT_WORKERS, help=f"Merge requests reviewed at the same time (default: {DEFAULT_WORKERS}).")
+    return parser.parse_args(argv)
+
+async def run(args) -> int:
+    rules = parse_rules(read_text_file(args.rules_file)) if args.rules_file else None
+
+    # Crawls run on the default executor; the client below caps their requests
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=args.gitlab_workers or get_max_workers()))
+    set_global_concurrency(args.ai_concurrency or get_max_concurrency())
+
+    # One request limit for the whole process: each crawl's own worker pools
+    # (discussions, file contents) share it instead of multiplying it
+    gl, request_counter = create_gitlab_client(gitlib_crawler.gitlab_url, gitlib_crawler.gitlab_private_token,
+                                               max_in_flight=args.gitlab_workers or get_max_workers())
+    init_ai_caller(use_cache=not args.no_cache)
+    queue = JobQueue()
+    service = ReviewService(queue, gl, args, rules, init_prompt_map())
+    if queue.requeued:
+        print(f"Queued {queue.requeued} jobs again that were running when the service stopped.")
+    service.jobs_ready.set()
+
+    secret = os.getenv("GITLAB_WEBHOOK_SECRET")
+    if not secret:
+        print("Warning: GITLAB_WEBHOOK_SECRET is not set; webhooks are accepted without a token.", file=sys.stderr)
+    httpd = start_webhook_server(service, loop, args.host, args.port, secret)
+    print(f"Listening for merge request webhooks on http://{args.host}:{args.port}/webhook "
+          f"with {args.workers} workers")
+    started = time.perf_counter()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    workers = [asyncio.ensure_future(service.worker()) for _ in range(args.workers)]
+    try:
+        await stop.wait()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await close_ai_caller()
+        set_global_concurrency(None)
+        queue.close()
+        print(f"Stopped after {time.perf_counter() - started:.0f}s.")
+        request_counter.print_summary()
+        metrics.print_summary()
+    return 0
+
+def main():
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
+    args = parse_args()
+    if args.rules_file and not os.path.exists(args.rules_file):
+        print(f"Error: rules file not found at {args.rules_file}", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(asyncio.run(run(args)))
+
+if __name__ == "__main__":
+    main()
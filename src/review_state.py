@@ -0,0 +1,70 @@
+import os
+import json
+import datetime
+from typing import Optional
+
+# Reviewed MR versions, stored in WORKSPACE_PATH
+STATE_FILE_NAME = "review_state.json"
+
+def _state_path() -> str:
+    return os.path.join(os.getenv("WORKSPACE_PATH") or ".", STATE_FILE_NAME)
+
+def _load_all() -> dict:
+    try:
+        with open(_state_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def state_key(project_path: str, merge_request_iid: str, kind: str) -> str:
+    """
+    Key of one merge request and review kind ("review" or "coding_rule").
+    """
+    return f"{project_path}!{merge_request_iid}:{kind}"
+
+def get_last_review(key: str) -> Optional[dict]:
+    """
+    Return the last recorded review of a merge request:
+    {"head_sha", "output_dir", "result_file", "reviewed_at"}, or None.
+    """
+    return _load_all().get(key)
+
+def record_review(key: str, head_sha: str, output_dir: str, result_file: str) -> None:
+    """
+    Remember that the MR version at head_sha was reviewed into result_file.
+    """
+    state = _load_all()
+    state[key] = {
+        "head_sha": head_sha,
+        "output_dir": output_dir,
+        "result_file": result_file,
+        "reviewed_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    path = _state_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def read_previous_result(last_review: Optional[dict]) -> Optional[str]:
+    if not last_review:
+        return None
+    try:
+        with open(last_review["result_file"], "r", encoding="utf-8") as f:
+            return f.read()
+    except (OSError, KeyError):
+        return None
+
+def merge_results(new_result: str, previous_result: Optional[str], since_sha: str, head_sha: str) -> str:
+    """
+    Put the review of the changes since since_sha in front of the earlier findings.
+    """
+    if previous_result is None:
+        return new_result
+    return (
+        f"## Review of changes {since_sha[:8]}..{head_sha[:8]}\n\n"
+        f"{new_result}\n\n"
+        f"## Earlier findings (up to {since_sha[:8]})\n\n"
+        f"{previous_result}"
+    )
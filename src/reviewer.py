@@ -5,64 +5,244 @@ import argparse
 import asyncio
 from dotenv import load_dotenv
 
-from azure_ai_caller import init_ai_caller, generate_response
+from azure_ai_caller import init_ai_caller, close_ai_caller, generate_response, stream_response, get_max_concurrency
 from ai_prompts import init_prompt_map
+from diff_sharder import count_tokens, get_shard_tokens, shard_diff
+from diff_dedup import dedupe_diff, format_repeat_groups
+from thread_index import build_thread_index
+import ai_cache
+import metrics
 
 def read_file_content(file_path):
     """Reads the content of a file and returns it as a string."""
     with open(file_path, 'r', encoding='utf-8') as file:
         return file.read()
 
+def build_messages(template, language, **values):
+    """
+    Fill a prompt template from ai_prompts.yaml and add the answer-language line
+    to the end of the last message, so it does not break the cacheable prefix.
+    """
+    messages = []
+    for message in template:
+        # Replace placeholders in the content
+        formatted_content = message['content'].format(**values)
+        messages.append({
+            "role": message['role'],
+            "content": formatted_content
+        })
+    messages[-1]["content"] += f"\n\nYour answer should be in the following languages, in this order: {language}."
+    return messages
+
+async def respond(messages, output_path=None):
+    """
+    Get the AI answer for messages. With output_path, the answer is streamed
+    and written to that file as it arrives, so partial output survives a failure.
+    """
+    if output_path is None:
+        return await generate_response(messages)
+    parts = []
+    with open(output_path, 'w', encoding='utf-8') as f:
+        async for text in stream_response(messages):
+            f.write(text)
+            f.flush()
+            parts.append(text)
+    return "".join(parts)
+
+async def review_sharded(prompts, shards, comments_content, rules_content, language, concurrency=None, output_path=None,
+                         semaphore=None):
+    """
+    Map-reduce review for diffs that do not fit in one request: every shard is
+    reviewed concurrently, then one reduce call merges the per-shard findings.
+    All calls take a slot of `semaphore` (a new one of `concurrency` slots by
+    default), so a caller can share its own limit.
+    """
+    shard_template = prompts.get("code_review_shard_prompt")
+    reduce_template = prompts.get("code_review_reduce_prompt")
+    if not shard_template or not reduce_template:
+        raise ValueError("'code_review_shard_prompt' or 'code_review_reduce_prompt' not found in ai_prompts.yaml")
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(concurrency or get_max_concurrency())
+    total = len(shards)
+
+    async def review_shard(part, shard):
+        async with semaphore:
+            # Built once a slot is free, so only `concurrency` prompts are held at a time
+            messages = build_messages(shard_template, language, comments=comments_content, diff=shard,
+                                      rules=rules_content, part=part, total=total)
+            print(f"Reviewing part {part}/{total} ({count_tokens(shard)} diff tokens)...")
+            with metrics.label(f"shard {part}/{total}"):
+                return await generate_response(messages)
+
+    shard_results = await asyncio.gather(*(review_shard(i, shard) for i, shard in enumerate(shards, 1)))
+
+    findings = "\n\n".join(f"## Part {i}/{total}\n\n{result or ''}" for i, result in enumerate(shard_results, 1))
+    print("Merging the reviews of all parts...")
+    async with semaphore:
+        with metrics.label("reduce"):
+            return await respond(build_messages(reduce_template, language, findings=findings), output_path)
+
+async def review_threads(prompts, comments_content, diff_content, rules_content, language, concurrency=None,
+                         shard_tokens=None, output_path=None):
+    """
+    Review every unresolved DiffNote thread in its own call with only the
+    hunks that touch it (see thread_index), at most `concurrency` calls at a
+    time. Threads without such hunks (general discussions, files the diff
+    does not change) are reviewed together against the whole diff, within
+    the same `concurrency` limit. Sections
+    are written to output_path in thread order as they finish; a failed
+    thread is marked as not checked and does not stop the others.
+    """
+    thread_template = prompts.get("code_review_thread_prompt")
+    if not thread_template:
+        raise ValueError("'code_review_thread_prompt' not found in ai_prompts.yaml")
+
+    focused, unmatched = build_thread_index(comments_content, diff_content)
+    print(f"Reviewing {len(focused)} threads one by one"
+          + (f" and {len(unmatched)} other threads against the whole diff." if unmatched else "."))
+    semaphore = asyncio.Semaphore(concurrency or get_max_concurrency())
+
+    async def review_thread(thread, hunks):
+        async with semaphore:
+            messages = build_messages(thread_template, language, comments=thread.text, diff=hunks, rules=rules_content)
+            with metrics.label(f"thread {thread.location()}"):
+                return await generate_response(messages)
+
+    thread_tasks = [asyncio.ensure_future(review_thread(thread, hunks)) for thread, hunks in focused]
+    general_task = None
+    if unmatched:
+        general_task = asyncio.ensure_future(
+            review_code("".join(thread.text for thread in unmatched), diff_content, rules_content, language,
+                        concurrency, shard_tokens, prompts, semaphore=semaphore))
+
+    out = open(output_path, 'w', encoding='utf-8') if output_path else None
+    sections = []
+    failed = 0
+    try:
+        named = [(f"## Thread {i}: {thread.location()}", task) for i, ((thread, _), task)
+                 in enumerate(zip(focused, thread_tasks), 1)]
+        if general_task is not None:
+            named.append(("## Other threads", general_task))
+        for title, task in named:
+            try:
+                verdict = await task
+            except Exception as e:
+                print(f"AI call failed for {title[3:]}: {e}", file=sys.stderr)
+                failed += 1
+                verdict = f"Not checked: the AI call failed after retries ({type(e).__name__}: {e})."
+            section = f"{title}\n\n{(verdict or '').strip()}"
+            if out is not None:
+                out.write(("\n\n" if sections else "") + section)
+                out.flush()
+            sections.append(section)
+    finally:
+        if out is not None:
+            out.close()
+    if failed:
+        print(f"Warning: {failed} of {len(named)} thread reviews could not be done.", file=sys.stderr)
+    return "\n\n".join(sections)
+
+async def review_code(comments_content, diff_content, rules_content, language='english',
+                      concurrency=None, shard_tokens=None, prompts=None, output_path=None, per_thread=False,
+                      semaphore=None):
+    """
+    Review whether the diff addresses the comments and return the review text.
+    init_ai_caller() must have run. Diffs over the shard token budget are
+    reviewed with review_sharded. With output_path, the final answer is
+    streamed into that file as it arrives.
+    Hunks that repeat the same change are reviewed once (see diff_dedup),
+    and the locations they stand for are listed after the review.
+    With per_thread=True, each thread is reviewed on its own with the hunks
+    that touch it (see review_threads).
+    With `semaphore`, every AI call takes one of its slots instead of a new
+    limit of `concurrency` calls.
+    """
+    if prompts is None:
+        prompts = init_prompt_map()
+    code_review_prompt_template = prompts.get("code_review_prompt")
+    if not code_review_prompt_template:
+        raise ValueError("'code_review_prompt' not found in ai_prompts.yaml")
+    if per_thread:
+        return await review_threads(prompts, comments_content, diff_content, rules_content, language, concurrency,
+                                    shard_tokens, output_path)
+
+    diff_content, repeat_groups = dedupe_diff(diff_content)
+    # Split the diff on file and hunk boundaries when it is over the token budget
+    shards = shard_diff(diff_content, shard_tokens or get_shard_tokens())
+
+    if len(shards) <= 1:
+        messages = build_messages(code_review_prompt_template, language,
+                                  comments=comments_content, diff=diff_content, rules=rules_content)
+        if semaphore is None:
+            result = await respond(messages, output_path)
+        else:
+            async with semaphore:
+                result = await respond(messages, output_path)
+    else:
+        print(f"Diff is too large for one request; reviewing it in {len(shards)} parts.")
+        result = await review_sharded(prompts, shards, comments_content, rules_content, language, concurrency,
+                                      output_path, semaphore)
+    if repeat_groups:
+        repeated_section = "\n\n" + format_repeat_groups(repeat_groups)
+        result += repeated_section
+        if output_path is not None:
+            with open(output_path, 'a', encoding='utf-8') as f:
+                f.write(repeated_section)
+    return result
+
+def read_rules():
+    """Reads the review rules shipped next to this script (rules.md)."""
+    return read_file_content(os.path.join(os.path.dirname(__file__), 'rules.md'))
+
 async def main():
     """Main function to review code changes."""
     parser = argparse.ArgumentParser(description='Review code changes using AI.')
     parser.add_argument('review_path', help='Path to the directory containing comments.txt and diff.txt.')
     parser.add_argument('-l', '--language', help='Comma-separated list of languages for the AI response (e.g., japanese,english,chinese).', default='english')
+    parser.add_argument('-j', '--concurrency', type=int, default=None, help='Maximum number of diff shards reviewed at the same time (default: AI_MAX_CONCURRENCY or 4).')
+    parser.add_argument('--shard-tokens', type=int, default=None, help='Token budget of the diff in one request; larger diffs are split into shards (default: REVIEW_SHARD_TOKENS or 60000).')
+    parser.add_argument('-t', '--per-thread', action='store_true', help='Review each unresolved thread in its own call with only the diff hunks that touch it.')
+    parser.add_argument('--profile', action='store_true', help='Run under cProfile and save the stats to profile.prof in the review directory.')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the AI response cache for this run.')
+    parser.add_argument('--clear-cache', action='store_true', help='Empty the AI response cache before running.')
     args = parser.parse_args()
 
     try:
         comments_path = os.path.join(args.review_path, 'comments.txt')
         diff_path = os.path.join(args.review_path, 'diff.txt')
-        rules_path = os.path.join(os.path.dirname(__file__), 'rules.md')
         comments_content = read_file_content(comments_path)
         diff_content = read_file_content(diff_path)
-        rules_content = read_file_content(rules_path)
+        rules_content = read_rules()
     except FileNotFoundError as e:
         print(f"Error: {e}")
         sys.exit(1)
 
     # Initialize the AI caller
     load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
-    init_ai_caller()
+    init_ai_caller(use_cache=not args.no_cache, clear_cache=args.clear_cache)
     prompts = init_prompt_map()
-    code_review_prompt_template = prompts.get("code_review_prompt")
 
-    if not code_review_prompt_template:
+    if not prompts.get("code_review_prompt"):
         print("Error: 'code_review_prompt' not found in ai_prompts.yaml")
         sys.exit(1)
 
-    # Create the prompt for the AI
-    messages = []
-    for message in code_review_prompt_template:
-        # Replace placeholders in the content
-        formatted_content = message['content'].format(comments=comments_content, diff=diff_content, rules=rules_content)
-        if message['role'] == 'system':
-            formatted_content += f"\n\nYour answer should be in the following languages, in this order: {args.language}."
-        messages.append({
-            "role": message['role'],
-            "content": formatted_content
-        })
-
-    # Generate the AI response
-    try:
-        review_result = await generate_response(messages)
-        output_path = os.path.join(args.review_path, 'result.md')
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(review_result)
-        print(f"AI review result saved to {output_path}")
-    except Exception as e:
-        print(f"An error occurred while generating the AI response: {e}")
-        sys.exit(1)
+    # Generate the AI response, streaming it into result.md
+    output_path = os.path.join(args.review_path, 'result.md')
+    profile_path = os.path.join(args.review_path, metrics.PROFILE_FILE_NAME)
+    with metrics.profiled(args.profile, profile_path):
+        try:
+            await review_code(comments_content, diff_content, rules_content, args.language,
+                              args.concurrency, args.shard_tokens, prompts, output_path, args.per_thread)
+            print(f"AI review result saved to {output_path}")
+            ai_cache.print_stats()
+        except Exception as e:
+            print(f"An error occurred while generating the AI response: {e}")
+            sys.exit(1)
+        finally:
+            await close_ai_caller()
+            metrics.write_trace(args.review_path)
+            metrics.print_summary()
 
 if __name__ == '__main__':
     asyncio.run(main())
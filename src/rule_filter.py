@@ -0,0 +1,151 @@
+import os
+import re
+import fnmatch
+from typing import List, Optional
+
+from diff_model import parse_diff_text
+from diff_sharder import split_files
+
+# File globs of the names accepted by "languages:"
+LANGUAGE_GLOBS = {
+    "python": ("*.py", "*.pyi"),
+    "java": ("*.java",),
+    "kotlin": ("*.kt", "*.kts"),
+    "scala": ("*.scala",),
+    "javascript": ("*.js", "*.jsx", "*.mjs", "*.cjs"),
+    "typescript": ("*.ts", "*.tsx"),
+    "go": ("*.go",),
+    "rust": ("*.rs",),
+    "c": ("*.c", "*.h"),
+    "cpp": ("*.cc", "*.cpp", "*.cxx", "*.hpp", "*.hh", "*.h"),
+    "csharp": ("*.cs",),
+    "ruby": ("*.rb",),
+    "php": ("*.php",),
+    "swift": ("*.swift",),
+    "dart": ("*.dart",),
+    "shell": ("*.sh", "*.bash"),
+    "sql": ("*.sql",),
+    "yaml": ("*.yaml", "*.yml"),
+    "html": ("*.html", "*.htm"),
+    "css": ("*.css", "*.scss", "*.sass", "*.less"),
+}
+LANGUAGE_ALIASES = {"py": "python", "js": "javascript", "ts": "typescript", "c++": "cpp", "c#": "csharp",
+                    "cs": "csharp", "golang": "go", "bash": "shell", "sh": "shell", "yml": "yaml"}
+
+# " | files: *.java, *.kt" segments at the end of a rule line
+METADATA_RE = re.compile(r"\s+\|\s*(files|languages|trigger)\s*:\s*"
+                         r"((?:(?!\s+\|\s*(?:files|languages|trigger)\s*:).)*?)\s*$", re.IGNORECASE)
+
+class RuleSpec:
+    """
+    A coding rule with its optional applicability metadata, written after the
+    rule as " | files: <globs>", " | languages: <names>" and
+    " | trigger: <regex>" segments. A rule with globs only applies to files
+    matching one of them; a rule with a trigger only to files whose changed
+    lines match it.
+    """
+
+    def __init__(self, line: str, text: str, globs: tuple = (), trigger: Optional[re.Pattern] = None):
+        self.line = line
+        self.text = text
+        self.globs = globs
+        self.trigger = trigger
+
+    def applies_to(self, path: str) -> bool:
+        if not self.globs:
+            return True
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(path, glob) or fnmatch.fnmatch(name, glob) for glob in self.globs)
+
+def parse_rule(line: str) -> RuleSpec:
+    """
+    Split a rules-file line into the rule text and its metadata. Unknown
+    language names and invalid trigger regexes raise ValueError.
+    """
+    text = line
+    globs = []
+    trigger = None
+    while True:
+        match = METADATA_RE.search(text)
+        if not match:
+            break
+        key, value = match.group(1).lower(), match.group(2)
+        text = text[:match.start()]
+        if key == "files":
+            globs.extend(glob.strip() for glob in value.split(",") if glob.strip())
+        elif key == "languages":
+            for name in (name.strip().lower() for name in value.split(",") if name.strip()):
+                name = LANGUAGE_ALIASES.get(name, name)
+                if name not in LANGUAGE_GLOBS:
+                    raise ValueError(f"Unknown language '{name}' in rule: {line}")
+                globs.extend(LANGUAGE_GLOBS[name])
+        else:
+            try:
+                trigger = re.compile(value)
+            except re.error as e:
+                raise ValueError(f"Invalid trigger regex in rule: {line} ({e})")
+    return RuleSpec(line, text.strip(), tuple(globs), trigger)
+
+class RulePlan:
+    """
+    What to send for one rule: `diff` is the full or narrowed diff, or None
+    when the rule cannot apply to any file of the diff (`reason` says why).
+    """
+
+    def __init__(self, spec: RuleSpec, diff: Optional[str], reason: Optional[str] = None):
+        self.spec = spec
+        self.diff = diff
+        self.reason = reason
+
+def plan_rules(rules: List[str], diff_content: str) -> List[RulePlan]:
+    """
+    Match every rule against the "File:" sections of diff.txt. Rules without
+    metadata get the full diff; rules with metadata get only the sections of
+    the files they apply to, or are skipped when there are none. A diff
+    without "File:" sections is sent whole to every rule.
+    """
+    sections = {}
+    for block in split_files(diff_content):
+        first = block.split("\n", 1)[0]
+        if first.startswith("File: "):
+            sections[first[len("File: "):].strip()] = block
+    # Changed lines are only parsed for files a trigger is tested on, and
+    # rules that select the same files share one narrowed diff
+    changed_text = {}
+    narrowed = {}
+
+    def changed_lines(path: str) -> str:
+        if path not in changed_text:
+            file_diffs = parse_diff_text(sections[path])
+            changed_text[path] = "\n".join(line.text for file_diff in file_diffs for hunk in file_diff.hunks
+                                           for line in hunk.lines if line.kind != " ") if file_diffs else sections[path]
+        return changed_text[path]
+
+    plans = []
+    for rule in rules:
+        spec = parse_rule(rule)
+        if not sections or (not spec.globs and spec.trigger is None):
+            plans.append(RulePlan(spec, diff_content))
+            continue
+        paths = [path for path in sections if spec.applies_to(path)]
+        if not paths:
+            plans.append(RulePlan(spec, None, f"no changed file matches {', '.join(spec.globs)}"))
+            continue
+        if spec.trigger is not None:
+            paths = [path for path in paths if spec.trigger.search(changed_lines(path))]
+            if not paths:
+                plans.append(RulePlan(spec, None, f"no changed line matches trigger '{spec.trigger.pattern}'"))
+                continue
+        if len(paths) == len(sections):
+            plans.append(RulePlan(spec, diff_content))
+        else:
+            key = tuple(paths)
+            if key not in narrowed:
+                narrowed[key] = "".join(sections[path] for path in paths)
+            plans.append(RulePlan(spec, narrowed[key]))
+    return plans
+
+def format_skipped_rules(plans: List[RulePlan]) -> str:
+    lines = ["### Skipped rules", "", "Not checked because they cannot apply to the changed files:", ""]
+    lines.extend(f"- {plan.spec.text} ({plan.reason})" for plan in plans)
+    return "\n".join(lines)
@@ -0,0 +1,90 @@
+import re
+from typing import List, Optional
+
+from diff_model import FileDiff, format_file_diffs, parse_diff_text
+
+# First line of every thread in comments.txt (written by gitlib_crawler.crawl_comments)
+THREAD_MARKER = "Thread: "
+LINES_RE = re.compile(r"^Lines: (\d+)-(\d+)$")
+
+class CommentThread:
+    """
+    One unresolved thread of comments.txt: its text, and for DiffNotes the
+    file and new-file line range it is attached to.
+    """
+
+    def __init__(self, text: str, path: Optional[str] = None, start: Optional[int] = None, end: Optional[int] = None):
+        self.text = text
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def location(self) -> str:
+        if self.path and self.start is not None:
+            return f"{self.path}:{self.start}-{self.end}"
+        return self.path or "general"
+
+def _make_thread(lines: List[str]) -> CommentThread:
+    path = start = end = None
+    for line in lines[:3]:
+        if line.startswith("File: "):
+            path = line[len("File: "):].strip()
+        match = LINES_RE.match(line.strip())
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+    return CommentThread("".join(lines), path, start, end)
+
+def parse_comment_threads(comments: str) -> List[CommentThread]:
+    """
+    Split comments.txt into threads. Files written before threads were
+    marked are split on their "File:" lines, with any leading notes kept
+    as one general thread.
+    """
+    lines = comments.splitlines(keepends=True)
+    marked = any(line.startswith(THREAD_MARKER) for line in lines)
+    threads = []
+    current = []
+    for line in lines:
+        starts_thread = line.startswith(THREAD_MARKER) if marked else line.startswith("File: ")
+        if starts_thread and current:
+            threads.append(_make_thread(current))
+            current = []
+        if marked and line.startswith(THREAD_MARKER):
+            continue
+        current.append(line)
+    if current and "".join(current).strip():
+        threads.append(_make_thread(current))
+    return threads
+
+def hunks_for_thread(thread: CommentThread, file_diffs: List[FileDiff]) -> Optional[FileDiff]:
+    """
+    The hunks of the thread's file whose new-file lines overlap the thread's
+    line range; every hunk of the file when none overlaps (the code may have
+    moved) or the thread has no range. None when the file is not in the diff.
+    """
+    file_diff = next((f for f in file_diffs if thread.path in (f.new_path, f.old_path)), None)
+    if file_diff is None or not file_diff.hunks:
+        return None
+    hunks = file_diff.hunks
+    if thread.start is not None:
+        touching = [hunk for hunk in hunks if hunk.new_start <= thread.end and hunk.new_end >= thread.start]
+        hunks = touching or hunks
+    return FileDiff(file_diff.old_path, file_diff.new_path, hunks)
+
+def build_thread_index(comments: str, diff_content: str) -> tuple:
+    """
+    Map every unresolved thread to the diff hunks that touch it.
+    Returns ([(thread, focused diff text)], [threads without hunks]); the
+    latter (general discussions, threads on files the diff does not change)
+    still need the whole diff.
+    """
+    file_diffs = parse_diff_text(diff_content)
+    focused = []
+    unmatched = []
+    for thread in parse_comment_threads(comments):
+        file_diff = hunks_for_thread(thread, file_diffs) if thread.path else None
+        if file_diff is None:
+            unmatched.append(thread)
+        else:
+            focused.append((thread, format_file_diffs([file_diff])))
+    return focused, unmatched
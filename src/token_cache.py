@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Optional
+
+import metrics
+
+# Azure AD scope of the Azure OpenAI data plane
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+# A cached token is replaced this long before it expires
+REFRESH_MARGIN_SECONDS = 300
+DEFAULT_TOKEN_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "ai-review-tool", "azure_token.json")
+# Environment variables that select which identity DefaultAzureCredential signs in as
+IDENTITY_ENV_VARS = ("AZURE_TENANT_ID", "AZURE_CLIENT_ID", "AZURE_USERNAME", "AZURE_FEDERATED_TOKEN_FILE")
+# Without one of these, DefaultAzureCredential signs in as whoever az login,
+# VS Code or the managed identity currently is, which the cache key cannot tell apart
+EXPLICIT_IDENTITY_ENV_VARS = ("AZURE_CLIENT_ID", "AZURE_USERNAME")
+
+def get_token_cache_path() -> Optional[str]:
+    """
+    Token cache file from AZURE_TOKEN_CACHE_PATH (default DEFAULT_TOKEN_CACHE_PATH); "off" disables it.
+    """
+    path = os.getenv("AZURE_TOKEN_CACHE_PATH") or DEFAULT_TOKEN_CACHE_PATH
+    return None if path.lower() == "off" else path
+
+def _cache_key(scope: str) -> Optional[str]:
+    """
+    Cache file key of the identity named by IDENTITY_ENV_VARS, or None when
+    no variable in EXPLICIT_IDENTITY_ENV_VARS names one.
+    """
+    if not any(os.getenv(name) for name in EXPLICIT_IDENTITY_ENV_VARS):
+        return None
+    identity = "\0".join([scope] + [os.getenv(name) or "" for name in IDENTITY_ENV_VARS])
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+class CachedTokenProvider:
+    """
+    Async bearer token provider for AsyncAzureOpenAI. A token that is still
+    valid for REFRESH_MARGIN_SECONDS is reused from memory, then from the
+    cache file shared by every process of the same user and identity; the
+    file is only used when AZURE_CLIENT_ID or AZURE_USERNAME names that
+    identity. Only when both miss is azure.identity imported and
+    DefaultAzureCredential asked for a new token, which is written back to
+    the file (mode 0600).
+    """
+
+    def __init__(self, scope: str = COGNITIVE_SERVICES_SCOPE, cache_path: Optional[str] = None):
+        self.scope = scope
+        self.cache_path = cache_path
+        self.credential = None
+        self._key = _cache_key(scope)
+        self._token = None
+        self._expires_on = 0
+        self._lock = None
+
+    def _valid(self, expires_on: float) -> bool:
+        return expires_on - REFRESH_MARGIN_SECONDS > time.time()
+
+    def _read_disk(self) -> None:
+        if not self.cache_path or self._key is None:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                entry = json.load(f).get(self._key)
+        except (OSError, ValueError, AttributeError):
+            return
+        if isinstance(entry, dict) and self._valid(entry.get("expires_on") or 0):
+            self._token, self._expires_on = entry["token"], entry["expires_on"]
+
+    def _write_disk(self) -> None:
+        if not self.cache_path or self._key is None:
+            return
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        if not isinstance(entries, dict):
+            entries = {}
+        # Drop the expired tokens of other identities while the file is rewritten
+        entries = {key: entry for key, entry in entries.items()
+                   if isinstance(entry, dict) and (entry.get("expires_on") or 0) > time.time()}
+        entries[self._key] = {"token": self._token, "expires_on": self._expires_on}
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Could not save the Azure token cache: {e}")
+
+    async def __call__(self) -> str:
+        if self._token and self._valid(self._expires_on):
+            return self._token
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._token and self._valid(self._expires_on):
+                return self._token
+            started = time.perf_counter()
+            self._read_disk()
+            if self._token and self._valid(self._expires_on):
+                metrics.record_startup("credential (token cache)", time.perf_counter() - started)
+                return self._token
+
+            if self.credential is None:
+                identity = metrics.timed_import("azure.identity.aio")
+                self.credential = identity.DefaultAzureCredential()
+            access_token = await self.credential.get_token(self.scope)
+            self._token, self._expires_on = access_token.token, access_token.expires_on
+            metrics.record_startup("credential (DefaultAzureCredential)", time.perf_counter() - started)
+            self._write_disk()
+            return self._token
+
+    async def close(self) -> None:
+        if self.credential is not None:
+            await self.credential.close()
+            self.credential = None